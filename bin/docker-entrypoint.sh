@@ -5,9 +5,14 @@ set -eu
 # Symlink sv directories and start runit
 rm -rf /etc/service/hypercorn
 rm -rf /etc/service/nginx
+rm -rf /etc/service/inference
 
 ln -s /etc/sv/hypercorn /etc/service/hypercorn
 ln -s /etc/sv/nginx /etc/service/nginx
+# The shared inference server only runs when the workers are configured to use it.
+if [ -n "${INFERENCE_SOCKET:-}" ]; then
+    ln -s /etc/sv/inference /etc/service/inference
+fi
 
 # Create logfiles
 mkdir -p /var/log/hypercorn
@@ -1,15 +1,159 @@
 import bot.webhooks as webhooks
+import bot.catalog as catalog
 import bot.db_service as db
+import bot.dispatcher as dispatcher
+import bot.conversation_state as conversation_state
+import bot.dedup as dedup
+import bot.export as export
+import bot.followups as followups
+import bot.graph_api as graph_api
+import bot.inference as inference
+import bot.job_queue as job_queue
+import bot.log as log
+import bot.metrics as metrics
+import bot.messaging_service as messaging
 import bot.models as models
+import bot.outbound as outbound
+import bot.partitions as partitions
+import bot.profiles as profiles
+import bot.ratings as ratings
+import hmac
+import time
 
-from quart import Quart, jsonify
+from quart import Quart, Response, g, jsonify, request
+
+from bot.settings import (
+    EXPORT_API_TOKEN,
+    FOLLOWUPS_ENABLED,
+    METRICS_ENABLED,
+    WARM_UP_CLASSIFIER,
+    WEBHOOK_BATCH_MODE,
+    WEBHOOK_QUEUE_ENABLED,
+)
 
 app = Quart(__name__)
 
-db.register_request_handlers(app)
 models.create_tables()
 
 
+@app.before_serving
+async def start_logging():
+    # Registered first, so the other startup handlers log through it.
+    log.configure_logging()
+
+
+@app.before_serving
+async def warm_up_classifier():
+    # Runs off the event loop, so the app starts serving while the model loads.
+    if WARM_UP_CLASSIFIER:
+        inference.warm_up_in_background()
+
+
+@app.before_serving
+async def preload_product_catalog():
+    # On a thread, so a slow or failing products API doesn't hold up startup.
+    catalog.get_product_catalog().preload()
+
+
+@app.before_serving
+async def start_message_processing():
+    message_dispatcher = dispatcher.start_dispatcher(messaging.handle_incoming_message)
+    if WEBHOOK_QUEUE_ENABLED:
+        batch_handler = messaging.handle_incoming_messages if WEBHOOK_BATCH_MODE else None
+        job_queue.start_consumers(message_dispatcher.handle, batch_handler=batch_handler)
+
+
+@app.after_serving
+async def stop_message_processing():
+    await job_queue.stop_consumers()
+    await dispatcher.stop_dispatcher()
+
+
+@app.after_serving
+async def flush_conversation_states():
+    # After message processing has stopped, so no more transitions are made.
+    await conversation_state.close_conversation_state_store()
+
+
+@app.before_serving
+async def start_followup_scheduler():
+    if FOLLOWUPS_ENABLED:
+        followups.start_scheduler()
+
+
+@app.after_serving
+async def stop_followup_scheduler():
+    await followups.stop_scheduler()
+
+
+@app.after_serving
+async def stop_outbound_sender():
+    # After message processing has stopped, so no more replies are queued.
+    await outbound.close_outbound_sender()
+
+
+@app.after_serving
+async def stop_profile_enricher():
+    await profiles.close_profile_enricher()
+
+
+@app.before_serving
+async def start_partition_maintenance():
+    partitions.start_maintenance(models.PARTITIONED_MODELS)
+
+
+@app.after_serving
+async def stop_partition_maintenance():
+    await partitions.stop_maintenance()
+
+
+@app.before_serving
+async def start_dedup_pruning():
+    dedup.start_pruning()
+
+
+@app.after_serving
+async def stop_dedup_pruning():
+    await dedup.stop_pruning()
+
+
+@app.after_serving
+async def close_graph_api_client():
+    graph_api.close_graph_api_client()
+
+
+# After every shutdown handler that uses the DB: Quart runs them in registration order.
+db.register_app_handlers(app)
+
+
+@app.after_serving
+async def stop_logging():
+    # Registered last, so it runs after the other shutdown handlers have logged.
+    log.shutdown_logging()
+
+
+@app.before_request
+async def start_request_timer():
+    if METRICS_ENABLED:
+        g.request_started_at = time.perf_counter()
+        metrics.HTTP_REQUESTS_IN_FLIGHT.inc()
+
+
+@app.teardown_request
+async def stop_request_timer(exc):
+    started_at = g.pop('request_started_at', None)
+    if started_at is not None:
+        metrics.HTTP_REQUESTS_IN_FLIGHT.dec()
+        metrics.HTTP_REQUEST_DURATION.observe(time.perf_counter() - started_at, endpoint=request.endpoint or 'unknown')
+
+
+@app.route('/metrics')
+async def prometheus_metrics():
+    if not METRICS_ENABLED:
+        return 'NOT_FOUND', 404
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
 @app.route('/')
 async def root():
     return 'ROOT'
@@ -20,4 +164,41 @@ async def hello():
     return jsonify({'greeting':'Hello World!'})
 
 
+@app.route('/products/<int:product_id>/ratings')
+async def product_ratings(product_id: int):
+    rating = await db.run(ratings.get_product_rating, product_id)
+    if rating is None:
+        return jsonify({'error': 'No ratings for product %s' % product_id}), 404
+    return jsonify(rating)
+
+
+@app.route('/exports/reviews')
+async def export_reviews():
+    """
+    Stream every review matching the `from`, `until` and `product_id` query parameters,
+    as `format` csv (default) or jsonl, gzipped if `gzip` is 1.
+    """
+    authorization = request.headers.get('Authorization', '')
+    if not EXPORT_API_TOKEN or not hmac.compare_digest(authorization, 'Bearer %s' % EXPORT_API_TOKEN):
+        return jsonify({'error': 'Unauthorized'}), 401
+    format = request.args.get('format', 'csv')
+    if format not in export.EXPORT_FORMATS:
+        return jsonify({'error': 'Unknown format %r' % format}), 400
+    try:
+        filters = export.parse_filter(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    compress = request.args.get('gzip') == '1'
+
+    filename = 'reviews.%s%s' % (format, '.gz' if compress else '')
+    response = Response(
+        export.stream_reviews(filters, format, compress),
+        mimetype='application/gzip' if compress else export.CONTENT_TYPES[format],
+        headers={'Content-Disposition': 'attachment; filename=%s' % filename},
+    )
+    # Large exports take longer than the default response timeout.
+    response.timeout = None
+    return response
+
+
 app.add_url_rule('/messenger-webhooks', 'messenger-webhooks', webhooks.post, methods=['GET', 'POST'])
\ No newline at end of file
@@ -0,0 +1,153 @@
+import asyncio
+import os
+
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Dict, Iterable, Iterator, List, Optional, Set, TextIO
+
+import bot.db_service as db
+import bot.messaging_service as messaging
+
+from bot.models import Conversation, Person
+from bot.profiles import get_profile_enricher
+from bot.rate_limit import TokenBucket
+from bot.settings import CAMPAIGN_BATCH_SIZE, CAMPAIGN_CONCURRENCY, CAMPAIGN_RATE_PER_SEC
+
+
+@dataclass
+class CampaignStats:
+    sent: int = 0
+    skipped: int = 0
+    failed: int = 0
+
+
+class CampaignProgress:
+    """
+    Append-only log of the person ids a campaign has already reached, so that an interrupted
+    campaign can be re-run with the same progress file and pick up where it left off.
+    """
+
+    def __init__(self, path: Optional[str]):
+        self._path = path
+
+    def load(self) -> Set[int]:
+        if self._path is None or not os.path.exists(self._path):
+            return set()
+        with open(self._path) as f:
+            return {int(line) for line in f if line.strip()}
+
+    def record(self, person_ids: Iterable[int]) -> None:
+        if self._path is None:
+            return
+        with open(self._path, 'a') as f:
+            f.writelines('%s\n' % person_id for person_id in person_ids)
+            f.flush()
+            os.fsync(f.fileno())
+
+
+def read_person_ids(stream: TextIO) -> Iterator[int]:
+    """
+    Lazily read one person id per line, ignoring blank lines and # comments.
+    """
+    for line in stream:
+        line = line.split('#', 1)[0].strip()
+        if line:
+            yield int(line)
+
+
+def batched(person_ids: Iterable[int], batch_size: int) -> Iterator[List[int]]:
+    batch: List[int] = []
+    for person_id in person_ids:
+        batch.append(person_id)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+async def run_campaign(
+    person_ids: Iterable[int],
+    progress: CampaignProgress,
+    batch_size: int = CAMPAIGN_BATCH_SIZE,
+    concurrency: int = CAMPAIGN_CONCURRENCY,
+    rate_per_sec: float = CAMPAIGN_RATE_PER_SEC,
+) -> CampaignStats:
+    """
+    Proactively solicit a review from every person in `person_ids`.
+
+    Ids are processed in batches: persons and conversations are loaded and created with bulk
+    queries, missing names are fetched in batch requests by the profile enricher, and solicitations are sent with at most
+    `concurrency` requests in flight and at most `rate_per_sec` requests per second. Each person is
+    recorded in `progress` as soon as their solicitation is sent, so an interrupted campaign re-sends
+    at most the solicitations that were in flight.
+    """
+    stats = CampaignStats()
+    done = progress.load()
+    limit = asyncio.Semaphore(concurrency)
+    bucket = TokenBucket(rate_per_sec)
+    for batch in batched(person_ids, batch_size):
+        pending = list(dict.fromkeys(person_id for person_id in batch if person_id not in done))
+        stats.skipped += len(batch) - len(pending)
+        if not pending:
+            continue
+        persons = await _load_or_create_persons(pending)
+        stats.failed += len(pending) - len(persons)
+        await db.run(messaging.insert_missing_conversations, list(persons))
+
+        results = await asyncio.gather(*[_solicit(person, progress, limit, bucket) for person in persons.values()])
+        sent = [person_id for person_id, ok in zip(persons, results) if ok]
+        stats.sent += len(sent)
+        stats.failed += len(persons) - len(sent)
+        done.update(sent)
+        print('Campaign progress: %s sent, %s skipped, %s failed' % (stats.sent, stats.skipped, stats.failed))
+    return stats
+
+
+async def _load_or_create_persons(person_ids: List[int]) -> Dict[int, Person]:
+    """
+    The persons of `person_ids` with names, creating them as needed. Persons whose name can't be
+    fetched are left out.
+    """
+    persons = await db.run(_find_or_insert_persons, person_ids)
+    unnamed = [person_id for person_id, person in persons.items() if person.first_name is None]
+    profiles = await get_profile_enricher().get_many(unnamed)
+    for person_id in unnamed:
+        info = profiles.get(person_id)
+        if info is None:
+            print('Error fetching profile for %s' % person_id)
+            del persons[person_id]
+        else:
+            persons[person_id].first_name = info.first_name
+            persons[person_id].last_name = info.last_name
+    return persons
+
+
+def _find_or_insert_persons(person_ids: List[int]) -> Dict[int, Person]:
+    messaging.insert_missing_persons(person_ids)
+    persons = {person.id: person for person in Person.select().where(Person.id.in_(person_ids))}
+    return {person_id: persons[person_id] for person_id in person_ids}
+
+
+async def _solicit(person: Person, progress: CampaignProgress, limit: asyncio.Semaphore, bucket: TokenBucket) -> bool:
+    message = messaging.SOLICIT_REVIEW_PROACTIVE_TEMPLATE.format(person.first_name)
+    outgoing = messaging.OutgoingMessage(recipient_id=person.id, text=message, is_response=False)
+    async with limit:
+        await bucket.acquire()
+        try:
+            await messaging.handle_outgoing_message(outgoing)
+        except Exception as e:
+            print('Error soliciting review from %s [%s]' % (person.id, e))
+            return False
+    await db.run(_mark_review_requested, [person.id])
+    progress.record([person.id])
+    return True
+
+
+def _mark_review_requested(person_ids: List[int]) -> None:
+    if not person_ids:
+        return
+    (Conversation
+        .update(review_requested_at=datetime.now(), review_recieved_at=None, declined_review_at=None)
+        .where(Conversation.person.in_(person_ids))
+        .execute())
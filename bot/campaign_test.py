@@ -0,0 +1,67 @@
+import asyncio
+import io
+
+import pytest
+
+from bot.campaign import CampaignProgress, batched, read_person_ids, run_campaign
+from bot.models import Conversation, Person
+from datetime import datetime
+from unittest import mock
+
+
+class Interrupted(BaseException):
+    pass
+
+
+@pytest.fixture
+def clear_database():
+    try:
+        yield
+    finally:
+        Conversation.delete().execute()
+        Person.delete().execute()
+
+
+def test_read_person_ids__skips_blank_lines_and_comments():
+    stream = io.StringIO('1\n\n2  # vip\n# header\n3\n')
+    assert list(read_person_ids(stream)) == [1, 2, 3]
+
+
+def test_batched():
+    assert list(batched(range(5), 2)) == [[0, 1], [2, 3], [4]]
+
+
+def test_progress__resumes_from_recorded_ids(tmp_path):
+    path = str(tmp_path / 'progress.txt')
+    assert CampaignProgress(path).load() == set()
+
+    CampaignProgress(path).record([1, 2])
+    CampaignProgress(path).record([3])
+    assert CampaignProgress(path).load() == {1, 2, 3}
+
+
+def test_progress__disabled_without_path():
+    progress = CampaignProgress(None)
+    progress.record([1])
+    assert progress.load() == set()
+
+
+def test_run_campaign__records_each_send_before_the_batch_ends(tmp_path, clear_database):
+    Person.insert_many([
+        {'id': person_id, 'first_name': 'First', 'last_name': 'Last', 'created_at': datetime.now()} for person_id in (1, 2, 3)
+    ]).execute()
+    progress = CampaignProgress(str(tmp_path / 'progress.txt'))
+
+    async def send(outgoing):
+        if outgoing.recipient_id == 3:
+            # Once the earlier sends have been recorded.
+            await asyncio.sleep(0.5)
+            raise Interrupted()
+
+    with mock.patch('bot.messaging_service.handle_outgoing_message', side_effect=send):
+        with pytest.raises(Interrupted):
+            asyncio.run(run_campaign([1, 2, 3], progress, batch_size=10, concurrency=1, rate_per_sec=1000))
+
+    assert progress.load() == {1, 2}
+    requested = {convo.person_id for convo in Conversation.select() if convo.review_requested_at is not None}
+    assert requested == {1, 2}
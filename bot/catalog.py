@@ -0,0 +1,195 @@
+import asyncio
+import dataclasses
+import threading
+import time
+import requests
+
+import bot.log as log
+
+from dataclasses import dataclass
+from typing import Callable, Dict, Optional
+
+from bot.settings import PRODUCT_CATALOG_RETRY_SECS, PRODUCT_CATALOG_TTL_SECS, PRODUCTS_URL
+
+
+PRODUCT_CHOOSE_TEMPLATE = 'Which product would you like to provide a review for? Please respond with the number of your chosen product: {}'
+
+
+class CatalogUnavailableError(Exception):
+    """
+    No catalog has been loaded yet, and the products API couldn't provide one.
+    """
+
+
+@dataclass(frozen=True)
+class Product:
+    id: int
+    product_name: str
+    manufacturer: str
+    vehicle: str
+
+    @classmethod
+    def from_json(cls, obj):
+        return Product(
+            id=int(obj['id']),
+            product_name=obj['productName'],
+            manufacturer=obj['manufacturer'],
+            vehicle=obj['vehicle']
+        )
+
+
+def fetch_products() -> Dict[int, Product]:
+    response = requests.get(url=PRODUCTS_URL, timeout=3)
+    response.raise_for_status()
+    products = {}
+    for obj in response.json():
+        product = Product.from_json(obj)
+        products[product.id] = product
+    return products
+
+
+def format_product_selection_message(products: Dict[int, Product]) -> str:
+    product_strings = []
+    for id in products:
+        product = products[id]
+        product_strings.append('(%s: %s %s)' % (product.id, product.manufacturer, product.vehicle))
+    product_string = ', '.join(product_strings)
+    return PRODUCT_CHOOSE_TEMPLATE.format(product_string)
+
+
+@dataclass(frozen=True)
+class CatalogSnapshot:
+    version: int
+    products: Dict[int, Product]
+    selection_message: str
+    fetched_at: float
+
+
+class ProductCatalog:
+    """
+    In-process cache of the product catalog.
+
+    Only the very first load blocks on the upstream API; preload() starts it in the background at
+    startup, and load() waits for it off the event loop. Once the cached snapshot is older than
+    ttl_secs it keeps being served while a single background refresh fetches a new one
+    (stale-while-revalidate), so a slow or failing upstream never delays a reply once a catalog has
+    been loaded. A failed refresh is retried after retry_secs. So is a failed first load: until
+    then, reads raise CatalogUnavailableError without calling the upstream API. The product
+    selection message is formatted once per catalog version rather than once per request.
+    """
+
+    def __init__(
+        self,
+        fetch: Callable[[], Dict[int, Product]] = fetch_products,
+        ttl_secs: float = PRODUCT_CATALOG_TTL_SECS,
+        retry_secs: float = PRODUCT_CATALOG_RETRY_SECS,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self._fetch = fetch
+        self._ttl_secs = ttl_secs
+        self._retry_secs = retry_secs
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._snapshot: Optional[CatalogSnapshot] = None
+        self._refresh_after = 0.0
+        self._refreshing = False
+
+    def get_products(self) -> Dict[int, Product]:
+        return self.snapshot().products
+
+    def get_selection_message(self) -> str:
+        return self.snapshot().selection_message
+
+    def snapshot(self) -> CatalogSnapshot:
+        snapshot = self._snapshot
+        if snapshot is None:
+            return self._load_initial()
+        if self._clock() >= self._refresh_after:
+            self._start_background_refresh()
+        return snapshot
+
+    async def load(self) -> CatalogSnapshot:
+        """
+        The current snapshot, loading the first one on a worker thread rather than the event loop.
+        Raises CatalogUnavailableError.
+        """
+        if self._snapshot is None:
+            return await asyncio.get_running_loop().run_in_executor(None, self._load_initial)
+        return self.snapshot()
+
+    def preload(self) -> None:
+        """
+        Load the first snapshot on a background thread, so the first messages don't wait for it.
+        """
+        thread = threading.Thread(target=self._preload, name='product-catalog-preload', daemon=True)
+        thread.start()
+
+    def _load_initial(self) -> CatalogSnapshot:
+        with self._lock:
+            if self._snapshot is None:
+                if self._clock() < self._refresh_after:
+                    raise CatalogUnavailableError('Product catalog load failed, retrying in %.0fs' % (
+                        self._refresh_after - self._clock()))
+                try:
+                    products = self._fetch()
+                except Exception as e:
+                    log.error('catalog.load_failed')
+                    self._refresh_after = self._clock() + self._retry_secs
+                    raise CatalogUnavailableError('Product catalog load failed') from e
+                self._store(products)
+            return self._snapshot
+
+    def _preload(self) -> None:
+        try:
+            self._load_initial()
+        except CatalogUnavailableError:
+            # Logged; loaded on demand once retry_secs have passed.
+            pass
+
+    def _start_background_refresh(self) -> None:
+        with self._lock:
+            if self._refreshing or self._clock() < self._refresh_after:
+                return
+            self._refreshing = True
+        thread = threading.Thread(target=self._refresh, name='product-catalog-refresh', daemon=True)
+        thread.start()
+
+    def _refresh(self) -> None:
+        try:
+            products = self._fetch()
+        except Exception:
+            log.error('catalog.refresh_failed')
+            with self._lock:
+                self._refresh_after = self._clock() + self._retry_secs
+                self._refreshing = False
+            return
+        with self._lock:
+            self._store(products)
+            self._refreshing = False
+
+    def _store(self, products: Dict[int, Product]) -> None:
+        # Must be called with the lock held.
+        now = self._clock()
+        current = self._snapshot
+        if current is not None and current.products == products:
+            self._snapshot = dataclasses.replace(current, fetched_at=now)
+        else:
+            self._snapshot = CatalogSnapshot(
+                version=1 if current is None else current.version + 1,
+                products=products,
+                selection_message=format_product_selection_message(products),
+                fetched_at=now,
+            )
+        self._refresh_after = now + self._ttl_secs
+
+
+_catalog: Optional[ProductCatalog] = None
+_catalog_lock = threading.Lock()
+
+
+def get_product_catalog() -> ProductCatalog:
+    global _catalog
+    with _catalog_lock:
+        if _catalog is None:
+            _catalog = ProductCatalog()
+        return _catalog
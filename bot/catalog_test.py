@@ -0,0 +1,159 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from bot.catalog import CatalogSnapshot, CatalogUnavailableError, Product, ProductCatalog
+
+
+PRODUCT_1 = Product(id=1, product_name='Model 3', manufacturer='Tesla', vehicle='Model 3')
+PRODUCT_2 = Product(id=2, product_name='Civic', manufacturer='Honda', vehicle='Civic')
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class FakeFetch:
+
+    def __init__(self, *results):
+        self.results = list(results)
+        self.calls = 0
+        self.fetched = threading.Event()
+
+    def __call__(self):
+        self.calls += 1
+        result = self.results.pop(0)
+        self.fetched.set()
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+
+def wait_for_refresh(catalog: ProductCatalog, fetch: FakeFetch) -> None:
+    fetch.fetched.wait(timeout=5)
+    fetch.fetched.clear()
+    while catalog._refreshing:
+        time.sleep(0.001)
+
+
+def test_catalog__serves_cached_snapshot_within_ttl():
+    clock = FakeClock()
+    fetch = FakeFetch({1: PRODUCT_1})
+    catalog = ProductCatalog(fetch=fetch, ttl_secs=60, clock=clock)
+
+    assert catalog.get_products() == {1: PRODUCT_1}
+    clock.now = 59
+    assert catalog.get_products() == {1: PRODUCT_1}
+    assert catalog.get_selection_message().endswith('(1: Tesla Model 3)')
+    assert fetch.calls == 1
+
+
+def test_catalog__serves_stale_snapshot_while_refreshing():
+    clock = FakeClock()
+    fetch = FakeFetch({1: PRODUCT_1}, {1: PRODUCT_1, 2: PRODUCT_2})
+    catalog = ProductCatalog(fetch=fetch, ttl_secs=60, clock=clock)
+
+    first = catalog.snapshot()
+    fetch.fetched.clear()
+    clock.now = 61
+    assert catalog.snapshot() is first
+    wait_for_refresh(catalog, fetch)
+
+    refreshed = catalog.snapshot()
+    assert refreshed.version == first.version + 1
+    assert refreshed.products == {1: PRODUCT_1, 2: PRODUCT_2}
+    assert refreshed.selection_message.endswith('(1: Tesla Model 3), (2: Honda Civic)')
+
+
+def test_catalog__keeps_version_when_products_unchanged():
+    clock = FakeClock()
+    fetch = FakeFetch({1: PRODUCT_1}, {1: PRODUCT_1})
+    catalog = ProductCatalog(fetch=fetch, ttl_secs=60, clock=clock)
+
+    first = catalog.snapshot()
+    fetch.fetched.clear()
+    clock.now = 61
+    catalog.snapshot()
+    wait_for_refresh(catalog, fetch)
+
+    refreshed: CatalogSnapshot = catalog.snapshot()
+    assert refreshed.version == first.version
+    assert refreshed.selection_message is first.selection_message
+    assert refreshed.fetched_at == 61
+
+
+def test_catalog__failed_refresh_keeps_stale_snapshot_and_retries_later():
+    clock = FakeClock()
+    fetch = FakeFetch({1: PRODUCT_1}, Exception('upstream down'), {2: PRODUCT_2})
+    catalog = ProductCatalog(fetch=fetch, ttl_secs=60, retry_secs=10, clock=clock)
+
+    catalog.snapshot()
+    fetch.fetched.clear()
+    clock.now = 61
+    catalog.snapshot()
+    wait_for_refresh(catalog, fetch)
+
+    assert catalog.get_products() == {1: PRODUCT_1}
+    assert fetch.calls == 2
+
+    clock.now = 72
+    catalog.snapshot()
+    wait_for_refresh(catalog, fetch)
+    assert catalog.get_products() == {2: PRODUCT_2}
+
+
+def test_catalog__failed_first_load_is_retried_after_retry_secs():
+    clock = FakeClock()
+    fetch = FakeFetch(Exception('upstream down'), {1: PRODUCT_1})
+    catalog = ProductCatalog(fetch=fetch, ttl_secs=60, retry_secs=10, clock=clock)
+
+    with pytest.raises(CatalogUnavailableError):
+        catalog.get_products()
+    clock.now = 9
+    with pytest.raises(CatalogUnavailableError):
+        catalog.get_products()
+    assert fetch.calls == 1
+
+    clock.now = 10
+    assert catalog.get_products() == {1: PRODUCT_1}
+    assert fetch.calls == 2
+
+
+def test_load__fetches_the_first_snapshot_off_the_event_loop():
+    fetch_threads = []
+
+    def fetch():
+        fetch_threads.append(threading.current_thread())
+        return {1: PRODUCT_1}
+
+    catalog = ProductCatalog(fetch=fetch, clock=FakeClock())
+
+    async def load():
+        return await catalog.load(), await catalog.load()
+
+    first, second = asyncio.run(load())
+
+    assert first is second
+    assert first.products == {1: PRODUCT_1}
+    [fetch_thread] = fetch_threads
+    assert fetch_thread is not threading.current_thread()
+
+
+def test_preload__loads_in_the_background():
+    fetch = FakeFetch({1: PRODUCT_1})
+    catalog = ProductCatalog(fetch=fetch, clock=FakeClock())
+
+    catalog.preload()
+    fetch.fetched.wait(timeout=5)
+    while catalog._snapshot is None:
+        time.sleep(0.001)
+
+    assert catalog.get_products() == {1: PRODUCT_1}
+    assert fetch.calls == 1
@@ -0,0 +1,251 @@
+import asyncio
+import time
+import weakref
+
+from collections import OrderedDict
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+from uuid import UUID
+
+import bot.db_service as db
+import bot.log as log
+import bot.metrics as metrics
+
+from bot.models import Conversation
+from bot.settings import CONVERSATION_STATE_FLUSH_DELAY_MS, CONVERSATION_STATE_SIZE, CONVERSATION_STATE_TTL_SECS
+
+
+# The conversation columns the state machine reads and changes.
+STATE_FIELDS = (
+    Conversation.selected_product_id,
+    Conversation.review_requested_at,
+    Conversation.product_selected_at,
+    Conversation.review_recieved_at,
+    Conversation.declined_review_at,
+)
+
+StateValues = Tuple[Optional[Any], ...]
+
+
+class ConversationState:
+    """
+    Compact in-memory copy of a conversation's state. Has the attributes of Conversation that
+    messaging_service.plan_step() and the review insert read, plus the values last persisted.
+    """
+
+    __slots__ = (
+        'id',
+        'started_at',
+        'person_id',
+        'selected_product_id',
+        'review_requested_at',
+        'product_selected_at',
+        'review_recieved_at',
+        'declined_review_at',
+        'persisted',
+        'loaded_at',
+    )
+
+    def __init__(self, convo: Conversation):
+        self.id: UUID = convo.id
+        self.started_at: datetime = convo.started_at
+        self.person_id: int = convo.person_id
+        self.selected_product_id: Optional[int] = convo.selected_product_id
+        self.review_requested_at: Optional[datetime] = convo.review_requested_at
+        self.product_selected_at: Optional[datetime] = convo.product_selected_at
+        self.review_recieved_at: Optional[datetime] = convo.review_recieved_at
+        self.declined_review_at: Optional[datetime] = convo.declined_review_at
+        self.persisted: StateValues = self.values()
+        self.loaded_at = time.monotonic()
+
+    def values(self) -> StateValues:
+        return tuple(getattr(self, field.name) for field in STATE_FIELDS)
+
+
+def write_states(pending: List[Tuple[ConversationState, StateValues]]) -> Set[UUID]:
+    """
+    Write each conversation's state values, if its row still holds the values last persisted.
+    Returns the ids of the conversations written; the others were changed by someone else.
+    """
+    written = set()
+    for state, values in pending:
+        changes = {field: value for field, value, old in zip(STATE_FIELDS, values, state.persisted) if value != old}
+        guard = (Conversation.id == state.id) & (Conversation.started_at == state.started_at)
+        for field, old in zip(STATE_FIELDS, state.persisted):
+            guard &= field.is_null() if old is None else field == old
+        if not changes or list(Conversation.update(changes).where(guard).returning(Conversation.id).execute()):
+            written.add(state.id)
+    return written
+
+
+class ConversationStateStore:
+    """
+    State of the conversations of up to `max_size` recently active senders, so handling their
+    messages needs no conversation reads or writes on the way to the reply.
+
+    Transitions apply to the in-memory state straight away and are written behind, in one
+    transaction per flush, at most `flush_delay_secs` after they were made. Flushes run one at a
+    time and each write is guarded on the values the previous one persisted, so:
+
+    - A conversation's transitions reach the database in order. If its row was changed by someone
+      else meanwhile, the write is dropped and the state evicted, to be reloaded.
+    - flush(also=...) commits every pending transition together with `also`, which is how reviews
+      are written: a review is never committed before the transition that produced it.
+    - A crash loses at most the last `flush_delay_secs` of transitions, and never a review. Those
+      conversations resume from their persisted state. A failed flush(also=...) drops the
+      unwritten transitions of its conversations the same way. The webhook job queue deletes
+      jobs with flush(also=...), so the messages of lost transitions are handled again.
+
+    Least recently used states are evicted beyond `max_size`, once flushed. States older than
+    `ttl_secs` are reloaded, which bounds how long changes made by other processes go unseen.
+    """
+
+    def __init__(
+        self,
+        max_size: int = CONVERSATION_STATE_SIZE,
+        flush_delay_secs: float = CONVERSATION_STATE_FLUSH_DELAY_MS / 1000.0,
+        ttl_secs: float = CONVERSATION_STATE_TTL_SECS,
+    ):
+        self._max_size = max_size
+        self._flush_delay_secs = flush_delay_secs
+        self._ttl_secs = ttl_secs
+        self._states: 'OrderedDict[int, ConversationState]' = OrderedDict()
+        # States with transitions not yet written, by conversation id, in the order first changed.
+        self._dirty: Dict[UUID, ConversationState] = {}
+        self._flush_lock = asyncio.Lock()
+        self._flush_timer: Optional[asyncio.Task] = None
+
+    def get(self, person_id: int) -> Optional[ConversationState]:
+        state = self._states.get(person_id)
+        if state is not None and state.id not in self._dirty and time.monotonic() - state.loaded_at > self._ttl_secs:
+            del self._states[person_id]
+            state = None
+        metrics.CONVERSATION_STATE_LOOKUPS.inc(result='miss' if state is None else 'hit')
+        if state is not None:
+            self._states.move_to_end(person_id)
+        return state
+
+    def put(self, convo: Conversation) -> ConversationState:
+        """
+        Hold the state of a conversation just read from the database, unless a state is already held.
+        """
+        state = self._states.get(convo.person_id)
+        if state is None or state.id not in self._dirty:
+            state = self._states[convo.person_id] = ConversationState(convo)
+        self._states.move_to_end(convo.person_id)
+        self._evict()
+        return state
+
+    def update(self, state: ConversationState, **changes) -> None:
+        """
+        Apply a transition to `state`, to be written by the next flush.
+        """
+        for name, value in changes.items():
+            setattr(state, name, value)
+        self._dirty[state.id] = state
+        if self._flush_timer is None:
+            self._flush_timer = log.start_uncorrelated_task(self._flush_later(), name='conversation-state-flush')
+
+    async def flush(self, also: Optional[Callable[[Set[UUID]], None]] = None) -> Set[UUID]:
+        """
+        Write every pending transition in one transaction, together with `also` if given. `also` runs
+        on a DB thread, in the transaction, with the ids of the conversations written. Returns those.
+        """
+        async with self._flush_lock:
+            pending = [(state, state.values()) for state in self._dirty.values()]
+            if not pending and also is None:
+                return set()
+            self._dirty.clear()
+            try:
+                written = await db.run(_write, pending, also)
+            except BaseException:
+                for state, _ in pending:
+                    if also is None:
+                        # Written by the next flush instead, merged with transitions made meanwhile.
+                        self._dirty.setdefault(state.id, state)
+                    else:
+                        # As after a crash: drop the unwritten transitions, so the transition of a
+                        # failed review isn't written without it, and reload the state when needed.
+                        self._dirty.pop(state.id, None)
+                        if self._states.get(state.person_id) is state:
+                            del self._states[state.person_id]
+                raise
+            if pending:
+                metrics.CONVERSATION_STATE_FLUSH_SIZE.observe(len(pending))
+            for state, values in pending:
+                if state.id in written:
+                    state.persisted = values
+                else:
+                    log.warning('conversation_state.conflict', conversation_id=state.id)
+                    self._dirty.pop(state.id, None)
+                    if self._states.get(state.person_id) is state:
+                        del self._states[state.person_id]
+            self._evict()
+            return written
+
+    async def evict(self, person_id: int) -> None:
+        """
+        Stop holding a sender's state, after writing its pending transitions. Call this before
+        changing the conversation's row directly.
+        """
+        state = self._states.get(person_id)
+        if state is not None and state.id in self._dirty:
+            await self.flush()
+        self._states.pop(person_id, None)
+
+    async def close(self) -> None:
+        if self._flush_timer is not None:
+            self._flush_timer.cancel()
+            await asyncio.gather(self._flush_timer, return_exceptions=True)
+            self._flush_timer = None
+        await self.flush()
+
+    async def _flush_later(self) -> None:
+        try:
+            await asyncio.sleep(self._flush_delay_secs)
+            # Transitions made during this flush start the next timer.
+            self._flush_timer = None
+            await self.flush()
+        except Exception:
+            log.error('conversation_state.flush_failed', pending=len(self._dirty))
+            if self._dirty and self._flush_timer is None:
+                self._flush_timer = log.start_uncorrelated_task(self._flush_later(), name='conversation-state-flush')
+
+    def _evict(self) -> None:
+        # States with pending transitions stay until flushed.
+        excess = len(self._states) - self._max_size
+        if excess <= 0:
+            return
+        for person_id in [person_id for person_id, state in self._states.items() if state.id not in self._dirty][:excess]:
+            del self._states[person_id]
+
+
+def _write(pending: List[Tuple[ConversationState, StateValues]], also: Optional[Callable[[Set[UUID]], None]]) -> Set[UUID]:
+    with db.atomic():
+        written = write_states(pending)
+        if also is not None:
+            also(written)
+    return written
+
+
+_stores: 'weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, ConversationStateStore]' = weakref.WeakKeyDictionary()
+
+
+def get_conversation_state_store() -> ConversationStateStore:
+    """
+    The store of the running event loop, whose flush timer belongs to that loop.
+    """
+    loop = asyncio.get_running_loop()
+    store = _stores.get(loop)
+    if store is None:
+        store = _stores[loop] = ConversationStateStore()
+    return store
+
+
+async def close_conversation_state_store() -> None:
+    """
+    Write every pending transition, then drop the store.
+    """
+    store = _stores.pop(asyncio.get_running_loop(), None)
+    if store is not None:
+        await store.close()
@@ -0,0 +1,118 @@
+import asyncio
+
+import pytest
+
+from bot.conversation_state import ConversationState, ConversationStateStore
+from bot.models import Conversation, Person
+from datetime import datetime
+
+
+@pytest.fixture(scope='function', autouse=True)
+def clear_database():
+    try:
+        yield
+    finally:
+        Conversation.delete().execute()
+        Person.delete().execute()
+
+
+def create_conversation(person_id: int) -> Conversation:
+    person = Person.create(id=person_id, created_at=datetime.now())
+    return Conversation.create(person=person, started_at=datetime(2022, 10, 20))
+
+
+def persisted(person_id: int) -> Conversation:
+    return Conversation.get(Conversation.person == person_id)
+
+
+def test_state__is_compact():
+    state = ConversationState(Conversation(person=1, started_at=datetime(2022, 10, 20)))
+    assert not hasattr(state, '__dict__')
+    assert state.values() == (None, None, None, None, None)
+
+
+def test_update__is_written_behind_by_the_next_flush():
+    create_conversation(1)
+    create_conversation(2)
+    requested_at = datetime(2022, 10, 20, 12, 0, 0)
+
+    async def run():
+        store = ConversationStateStore(flush_delay_secs=60)
+        for person_id in (1, 2):
+            store.update(store.put(persisted(person_id)), review_requested_at=requested_at)
+        assert persisted(1).review_requested_at is None
+        written = await store.flush()
+        await store.close()
+        return store, written
+
+    store, written = asyncio.run(run())
+
+    assert len(written) == 2
+    assert persisted(1).review_requested_at == requested_at
+    assert persisted(2).review_requested_at == requested_at
+
+
+def test_update__is_flushed_after_the_flush_delay():
+    create_conversation(1)
+
+    async def run():
+        store = ConversationStateStore(flush_delay_secs=0.01)
+        store.update(store.put(persisted(1)), review_requested_at=datetime(2022, 10, 20, 12, 0, 0))
+        await asyncio.sleep(0.2)
+        return persisted(1).review_requested_at
+
+    assert asyncio.run(run()) is not None
+
+
+def test_flush__drops_states_changed_by_someone_else():
+    create_conversation(1)
+
+    async def run():
+        store = ConversationStateStore(flush_delay_secs=60)
+        state = store.put(persisted(1))
+        Conversation.update(declined_review_at=datetime(2022, 10, 20, 13, 0, 0)).execute()
+        store.update(state, review_requested_at=datetime(2022, 10, 20, 12, 0, 0))
+        written = await store.flush()
+        return written, store.get(1)
+
+    written, held = asyncio.run(run())
+
+    assert written == set()
+    assert held is None
+    assert persisted(1).review_requested_at is None
+
+
+def test_flush__commits_the_extra_work_with_pending_transitions():
+    create_conversation(1)
+
+    async def run():
+        store = ConversationStateStore(flush_delay_secs=60)
+        state = store.put(persisted(1))
+        store.update(state, review_requested_at=datetime(2022, 10, 20, 12, 0, 0))
+
+        def fail(written):
+            raise RuntimeError('review insert failed')
+
+        with pytest.raises(RuntimeError):
+            await store.flush(also=fail)
+        return store.get(1)
+
+    # The transition is dropped along with the failed work, as after a crash.
+    assert asyncio.run(run()) is None
+    assert persisted(1).review_requested_at is None
+
+
+def test_put__evicts_least_recently_used_flushed_states():
+    convos = [create_conversation(person_id) for person_id in (1, 2, 3)]
+
+    async def run():
+        store = ConversationStateStore(max_size=2, flush_delay_secs=60)
+        store.update(store.put(convos[0]), review_requested_at=datetime(2022, 10, 20, 12, 0, 0))
+        store.put(convos[1])
+        store.put(convos[2])
+        # The first state's transition isn't written yet, so it is kept.
+        held = [person_id for person_id in (1, 2, 3) if store.get(person_id) is not None]
+        await store.close()
+        return held
+
+    assert asyncio.run(run()) == [1, 3]
@@ -1,9 +1,15 @@
-import peewee
+import asyncio
+import functools
 import quart
+import threading
+import weakref
 
+import bot.metrics as metrics
+
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
 from playhouse import pool
-from typing import Optional, Iterable, Union
+from typing import Any, Callable, Dict, Optional, Iterable, TypeVar, Union
 
 from bot.constants import (
     POSTGRES_DB,
@@ -14,23 +20,39 @@ from bot.constants import (
     POSTGRES_MAX_CONNECTIONS,
     POSTGRES_CONNECTION_TIMEOUT_SECS,
 )
+from bot.settings import DB_MAX_QUEUED, DB_POOL_WAIT_SECS, DB_QUEUE_TIMEOUT_SECS
+
+T = TypeVar('T')
 
 _db: Optional[pool.PooledPostgresqlExtDatabase] = None
 
 
+class InstrumentedPooledPostgresqlExtDatabase(pool.PooledPostgresqlExtDatabase):
+    """
+    Records the duration of every query as the "db_query" stage.
+    """
+
+    def execute_sql(self, sql, params=None, *args, **kwargs):
+        with metrics.time_stage('db_query'):
+            return super().execute_sql(sql, params, *args, **kwargs)
+
+
 def get_db_instance() -> pool.PooledPostgresqlExtDatabase:
     global _db
     if _db is None:
-        _db = pool.PooledPostgresqlExtDatabase(
+        _db = InstrumentedPooledPostgresqlExtDatabase(
             POSTGRES_DB,
             user=POSTGRES_USER,
             password=POSTGRES_PASSWORD,
             host=POSTGRES_HOST,
             port=POSTGRES_PORT,
-            # If the number of open connections exceeds max_connections, a ValueError will be raised.
+            # Callers beyond max_connections wait up to DB_POOL_WAIT_SECS for a free connection,
+            # then get a MaxConnectionsExceeded (a ValueError).
             max_connections=POSTGRES_MAX_CONNECTIONS,
             stale_timeout=POSTGRES_CONNECTION_TIMEOUT_SECS,  # 5 minutes.
+            timeout=DB_POOL_WAIT_SECS,
         )
+        metrics.register_db_pool_gauges(_db)
     return _db
 
 
@@ -52,21 +74,118 @@ def execute_sql(sql: str, params: Optional[Iterable[Union[str, int]]] = None):
     return get_db_instance().execute_sql(sql, params=params)
 
 
-def register_request_handlers(app: quart.Quart) -> None:
+class DbQueueTimeout(Exception):
     """
-    Register handlers for opening and closing DB connections for each request.
-    This must be called only once, when the ASGI app starts.
+    Raised when DB work waited longer than the queue timeout for a free connection, or when too
+    much work was already waiting.
     """
 
-    def connect_db() -> None:
-        db = get_db_instance()
-        if db.is_closed():
-            db.connect()
 
-    def close_db(exc: Optional[BaseException]) -> None:
-        db = get_db_instance()
-        if not db.is_closed():
-            db.close()
+class DbExecutor:
+    """
+    Runs blocking peewee work off the event loop, on a dedicated thread pool with one thread per
+    pooled connection.
+
+    Each call checks a connection out of the pool for the duration of the work only, and returns it
+    afterwards, so connections are bound to units of work rather than to HTTP requests. When every
+    connection is busy, callers wait on the event loop (not on a thread) for up to
+    `queue_timeout_secs`, and at most `max_queued` of them wait at once; beyond either limit,
+    DbQueueTimeout is raised.
+    """
+
+    def __init__(
+        self,
+        max_workers: int = POSTGRES_MAX_CONNECTIONS,
+        queue_timeout_secs: float = DB_QUEUE_TIMEOUT_SECS,
+        max_queued: int = DB_MAX_QUEUED,
+    ):
+        self._max_workers = max_workers
+        self._queue_timeout_secs = queue_timeout_secs
+        self._max_queued = max_queued
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='db')
+        # Semaphores belong to the event loop they are awaited on, so keep one per loop.
+        self._slots: 'weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, asyncio.Semaphore]' = weakref.WeakKeyDictionary()
+        self.queued = 0
+
+    async def run(self, func: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+        """
+        Run `func(*args, **kwargs)` on a DB thread with a pooled connection, and return its result.
+        A transaction must begin and end inside `func`.
+        """
+        loop = asyncio.get_running_loop()
+        slots = self._slots.get(loop)
+        if slots is None:
+            slots = self._slots[loop] = asyncio.Semaphore(self._max_workers)
+        if slots.locked():
+            await self._wait_for_slot(slots)
+        else:
+            await slots.acquire()
+        try:
+            return await loop.run_in_executor(self._executor, functools.partial(_run_with_connection, func, args, kwargs))
+        finally:
+            slots.release()
+
+    def close(self) -> None:
+        self._executor.shutdown(wait=True)
+
+    async def _wait_for_slot(self, slots: asyncio.Semaphore) -> None:
+        if self.queued >= self._max_queued:
+            raise DbQueueTimeout('%s DB calls already waiting for a connection' % self.queued)
+        self.queued += 1
+        try:
+            await asyncio.wait_for(slots.acquire(), timeout=self._queue_timeout_secs)
+        except asyncio.TimeoutError:
+            raise DbQueueTimeout('No DB connection free within %ss' % self._queue_timeout_secs) from None
+        finally:
+            self.queued -= 1
+
+
+def _run_with_connection(func: Callable[..., T], args: tuple, kwargs: Dict[str, Any]) -> T:
+    with get_db_instance().connection_context():
+        return func(*args, **kwargs)
+
+
+_executor: Optional[DbExecutor] = None
+_executor_lock = threading.Lock()
+
+
+def get_db_executor() -> DbExecutor:
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = DbExecutor()
+        return _executor
+
+
+metrics.REGISTRY.register(metrics.Gauge(
+    'bot_db_calls_queued', 'DB calls waiting for a free connection.',
+    function=lambda: _executor.queued if _executor is not None else 0))
+
+
+async def run(func: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+    """
+    Run blocking DB work without blocking the event loop. See DbExecutor.run.
+    """
+    return await get_db_executor().run(func, *args, **kwargs)
+
+
+def close_db_executor() -> None:
+    global _executor
+    with _executor_lock:
+        if _executor is not None:
+            _executor.close()
+            _executor = None
+
+
+def register_app_handlers(app: quart.Quart) -> None:
+    """
+    Shut down the DB threads and close pooled connections when the ASGI app stops.
+    This must be called only once, when the ASGI app starts, after registering the other
+    after_serving handlers that use the DB: Quart runs them in registration order.
+    """
+
+    async def close_db() -> None:
+        close_db_executor()
+        get_db_instance().close_all()
 
-    app.before_request(connect_db)
-    app.teardown_request(close_db)  # type: ignore [arg-type]
\ No newline at end of file
+    app.after_serving(close_db)
@@ -0,0 +1,65 @@
+import asyncio
+import pytest
+import threading
+
+import bot.db_service as db
+
+
+def test_run__executes_on_a_db_thread_with_a_connection():
+    executor = db.DbExecutor(max_workers=2)
+
+    def query():
+        assert not db.get_db_instance().is_closed()
+        return threading.current_thread().name, db.execute_sql('SELECT 1').fetchone()[0]
+
+    try:
+        thread_name, value = asyncio.run(executor.run(query))
+    finally:
+        executor.close()
+
+    assert thread_name.startswith('db')
+    assert value == 1
+
+
+def test_run__times_out_when_every_connection_is_busy():
+    executor = db.DbExecutor(max_workers=1, queue_timeout_secs=0.05)
+    release = threading.Event()
+
+    async def main():
+        busy = asyncio.ensure_future(executor.run(release.wait, 5))
+        await asyncio.sleep(0.01)
+        try:
+            with pytest.raises(db.DbQueueTimeout):
+                await executor.run(lambda: None)
+        finally:
+            release.set()
+            await busy
+
+    try:
+        asyncio.run(main())
+    finally:
+        executor.close()
+    assert executor.queued == 0
+
+
+def test_run__rejects_work_beyond_max_queued():
+    executor = db.DbExecutor(max_workers=1, queue_timeout_secs=5, max_queued=1)
+    release = threading.Event()
+
+    async def main():
+        busy = asyncio.ensure_future(executor.run(release.wait, 5))
+        await asyncio.sleep(0.01)
+        waiting = asyncio.ensure_future(executor.run(lambda: 'done'))
+        await asyncio.sleep(0.01)
+        try:
+            with pytest.raises(db.DbQueueTimeout):
+                await executor.run(lambda: None)
+        finally:
+            release.set()
+            await busy
+        assert await waiting == 'done'
+
+    try:
+        asyncio.run(main())
+    finally:
+        executor.close()
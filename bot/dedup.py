@@ -0,0 +1,149 @@
+import asyncio
+import threading
+
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Iterable, List, Optional
+
+import bot.db_service as db
+import bot.log as log
+
+from bot.messaging_service import IncomingMessage
+from bot.models import ProcessedMessage
+from bot.settings import DEDUP_CACHE_SIZE, DEDUP_PRUNE_INTERVAL_SECS, DEDUP_RETENTION_SECS
+
+
+class RecentIds:
+    """
+    Bounded set of recently seen ids, evicting the least recently seen one when full.
+    Safe to share between the DB threads.
+    """
+
+    def __init__(self, capacity: int):
+        self._capacity = capacity
+        self._ids: 'OrderedDict[str, None]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, id: str) -> bool:
+        return id in self._ids
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def add(self, id: str) -> bool:
+        """
+        Record an id. Returns False if it had already been seen.
+        """
+        with self._lock:
+            if id in self._ids:
+                self._ids.move_to_end(id)
+                return False
+            self._ids[id] = None
+            if len(self._ids) > self._capacity:
+                self._ids.popitem(last=False)
+            return True
+
+    def discard(self, id: str) -> None:
+        with self._lock:
+            self._ids.pop(id, None)
+
+
+class MessageDeduplicator:
+    """
+    Drops Messenger redeliveries of messages that have already been accepted, keyed on message id.
+
+    Recently seen ids are rejected in memory without touching the database. Anything else is
+    claimed with a single INSERT ... ON CONFLICT DO NOTHING into processed_messages, whose primary
+    key makes the claim safe across workers and restarts.
+    """
+
+    def __init__(self, cache_size: int = DEDUP_CACHE_SIZE):
+        self._recent = RecentIds(cache_size)
+
+    def filter_new(self, messages: List[IncomingMessage]) -> List[IncomingMessage]:
+        """
+        Claim the given messages, returning only the ones that weren't accepted before.
+        """
+        candidates = [message for message in messages if self._recent.add(message.message_id)]
+        if not candidates:
+            return []
+        try:
+            received_at = datetime.now()
+            claimed = (ProcessedMessage
+                .insert_many([{'message_id': message.message_id, 'received_at': received_at} for message in candidates])
+                .on_conflict_ignore()
+                .returning(ProcessedMessage.message_id)
+                .execute())
+            claimed_ids = {row.message_id for row in claimed}
+        except Exception:
+            self.forget_recent(candidates)
+            raise
+        return [message for message in candidates if message.message_id in claimed_ids]
+
+    def forget(self, messages: List[IncomingMessage]) -> None:
+        """
+        Release claimed messages, e.g. because handling them failed, so that a redelivery is accepted.
+        """
+        if not messages:
+            return
+        self.forget_recent(messages)
+        message_ids = [message.message_id for message in messages]
+        ProcessedMessage.delete().where(ProcessedMessage.message_id.in_(message_ids)).execute()
+
+    def forget_recent(self, messages: Iterable[IncomingMessage]) -> None:
+        """
+        Release messages from the in-memory cache only, e.g. because the transaction claiming them rolled back.
+        """
+        for message in messages:
+            self._recent.discard(message.message_id)
+
+
+def prune_processed_messages(older_than: datetime) -> int:
+    """
+    Delete claims for messages received before `older_than`, once Messenger can no longer redeliver them.
+    """
+    return ProcessedMessage.delete().where(ProcessedMessage.received_at < older_than).execute()
+
+
+def prune_expired_claims(retention_secs: float = DEDUP_RETENTION_SECS) -> int:
+    return prune_processed_messages(datetime.now() - timedelta(seconds=retention_secs))
+
+
+_deduplicator: Optional[MessageDeduplicator] = None
+
+
+def get_deduplicator() -> MessageDeduplicator:
+    global _deduplicator
+    if _deduplicator is None:
+        _deduplicator = MessageDeduplicator()
+    return _deduplicator
+
+
+_pruning_task: Optional[asyncio.Task] = None
+
+
+def start_pruning(interval_secs: float = DEDUP_PRUNE_INTERVAL_SECS) -> None:
+    """
+    Keep deleting claims older than the redelivery window on the running event loop, every `interval_secs`.
+    """
+    global _pruning_task
+    _pruning_task = asyncio.create_task(_prune(interval_secs), name='dedup-pruning')
+
+
+async def stop_pruning() -> None:
+    global _pruning_task
+    if _pruning_task is None:
+        return
+    _pruning_task.cancel()
+    await asyncio.gather(_pruning_task, return_exceptions=True)
+    _pruning_task = None
+
+
+async def _prune(interval_secs: float) -> None:
+    while True:
+        await asyncio.sleep(interval_secs)
+        try:
+            deleted = await db.run(prune_expired_claims)
+            log.event('dedup.pruned', deleted=deleted)
+        except Exception:
+            log.error('dedup.prune_failed')
@@ -0,0 +1,74 @@
+import pytest
+
+from bot.dedup import MessageDeduplicator, RecentIds, prune_expired_claims
+from bot.messaging_service import IncomingMessage
+from bot.models import ProcessedMessage
+from datetime import datetime, timedelta
+
+
+@pytest.fixture(scope='function', autouse=True)
+def clear_database():
+    try:
+        yield
+    finally:
+        ProcessedMessage.delete().execute()
+
+
+def test_recent_ids__evicts_least_recently_seen():
+    recent = RecentIds(capacity=2)
+    assert recent.add('a')
+    assert recent.add('b')
+    assert not recent.add('a')
+    assert recent.add('c')
+
+    assert 'a' in recent
+    assert 'b' not in recent
+    assert len(recent) == 2
+
+
+def test_filter_new__drops_repeats_within_and_across_deliveries():
+    deduplicator = MessageDeduplicator()
+
+    new = deduplicator.filter_new([incoming('m1'), incoming('m2'), incoming('m1')])
+    assert [message.message_id for message in new] == ['m1', 'm2']
+
+    new = deduplicator.filter_new([incoming('m2'), incoming('m3')])
+    assert [message.message_id for message in new] == ['m3']
+    assert len(ProcessedMessage.select()) == 3
+
+
+def test_filter_new__drops_messages_claimed_by_another_worker():
+    MessageDeduplicator().filter_new([incoming('m1')])
+
+    assert MessageDeduplicator().filter_new([incoming('m1')]) == []
+
+
+def test_forget__accepts_redelivery():
+    deduplicator = MessageDeduplicator()
+    [message] = deduplicator.filter_new([incoming('m1')])
+
+    deduplicator.forget([message])
+
+    assert deduplicator.filter_new([incoming('m1')]) == [message]
+
+
+def test_prune_expired_claims__deletes_claims_older_than_the_window():
+    now = datetime.now()
+    ProcessedMessage.insert_many([
+        {'message_id': 'old', 'received_at': now - timedelta(hours=2)},
+        {'message_id': 'recent', 'received_at': now - timedelta(minutes=30)},
+    ]).execute()
+
+    assert prune_expired_claims(retention_secs=60 * 60) == 1
+
+    assert [claim.message_id for claim in ProcessedMessage.select()] == ['recent']
+
+
+def incoming(message_id: str) -> IncomingMessage:
+    return IncomingMessage(
+        sender_id=1,
+        recipient_id=0,
+        timestamp=datetime(2022, 10, 20, 11, 22, 33),
+        message_id=message_id,
+        text='Hi!'
+    )
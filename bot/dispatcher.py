@@ -0,0 +1,109 @@
+import asyncio
+
+from typing import Awaitable, Callable, List, Optional, Tuple
+
+from bot.messaging_service import IncomingMessage
+from bot.settings import DISPATCHER_SHARDS, DISPATCHER_SHARD_QUEUE_SIZE
+
+
+MessageHandler = Callable[[IncomingMessage], Awaitable[None]]
+
+
+class SenderDispatcher:
+    """
+    Runs incoming messages on a fixed pool of worker tasks, sharded by sender.
+
+    Every message from a sender goes to the same shard and each shard handles one message at a time,
+    so a sender's messages are processed in the order they were submitted (each one advances that
+    sender's conversation) while different senders are processed in parallel. Each shard has a
+    bounded queue; submitting to a full shard waits for room, which pushes back on the caller.
+    """
+
+    def __init__(
+        self,
+        handler: MessageHandler,
+        num_shards: int = DISPATCHER_SHARDS,
+        shard_queue_size: int = DISPATCHER_SHARD_QUEUE_SIZE,
+    ):
+        if num_shards < 1:
+            raise ValueError('num_shards must be at least 1')
+        self._handler = handler
+        self._queues: List['asyncio.Queue[Tuple[IncomingMessage, asyncio.Future]]'] = [
+            asyncio.Queue(maxsize=shard_queue_size) for _ in range(num_shards)
+        ]
+        self._workers: List[asyncio.Task] = []
+
+    def start(self) -> None:
+        if self._workers:
+            return
+        for i, queue in enumerate(self._queues):
+            self._workers.append(asyncio.create_task(self._work(queue), name='dispatcher-shard-%s' % i))
+
+    async def stop(self) -> None:
+        """
+        Wait for every submitted message to be handled, then stop the workers.
+        """
+        await asyncio.gather(*[queue.join() for queue in self._queues])
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers.clear()
+
+    async def submit(self, message: IncomingMessage) -> asyncio.Future:
+        """
+        Queue a message on its sender's shard, waiting while that shard is full.
+        The returned future resolves once the message has been handled.
+        """
+        future = asyncio.get_running_loop().create_future()
+        await self._shard(message.sender_id).put((message, future))
+        return future
+
+    async def handle(self, message: IncomingMessage) -> None:
+        await (await self.submit(message))
+
+    def _shard(self, sender_id: int) -> 'asyncio.Queue[Tuple[IncomingMessage, asyncio.Future]]':
+        return self._queues[sender_id % len(self._queues)]
+
+    async def _work(self, queue: 'asyncio.Queue[Tuple[IncomingMessage, asyncio.Future]]') -> None:
+        while True:
+            message, future = await queue.get()
+            try:
+                if future.cancelled():
+                    continue
+                try:
+                    await self._handler(message)
+                except Exception as e:
+                    if not future.cancelled():
+                        future.set_exception(e)
+                else:
+                    if not future.cancelled():
+                        future.set_result(None)
+            finally:
+                queue.task_done()
+
+
+_dispatcher: Optional[SenderDispatcher] = None
+
+
+def start_dispatcher(handler: MessageHandler) -> SenderDispatcher:
+    """
+    Create and start the process-wide dispatcher on the running event loop.
+    """
+    global _dispatcher
+    if _dispatcher is None:
+        _dispatcher = SenderDispatcher(handler)
+        _dispatcher.start()
+    return _dispatcher
+
+
+def get_dispatcher() -> SenderDispatcher:
+    if _dispatcher is None:
+        raise RuntimeError('Dispatcher has not been started')
+    return _dispatcher
+
+
+async def stop_dispatcher() -> None:
+    global _dispatcher
+    if _dispatcher is not None:
+        await _dispatcher.stop()
+        _dispatcher = None
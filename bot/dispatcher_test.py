@@ -0,0 +1,86 @@
+import asyncio
+import random
+
+from bot.dispatcher import SenderDispatcher
+from bot.messaging_service import IncomingMessage
+from datetime import datetime
+from typing import List, Tuple
+
+
+def test_dispatcher__keeps_sender_order_and_runs_senders_in_parallel():
+    handled: List[Tuple[int, str]] = []
+    in_flight = 0
+    max_in_flight = 0
+
+    async def handler(message: IncomingMessage):
+        nonlocal in_flight, max_in_flight
+        in_flight += 1
+        max_in_flight = max(max_in_flight, in_flight)
+        await asyncio.sleep(random.uniform(0, 0.01))
+        handled.append((message.sender_id, message.text))
+        in_flight -= 1
+
+    async def run():
+        dispatcher = SenderDispatcher(handler, num_shards=4, shard_queue_size=100)
+        dispatcher.start()
+        futures = [await dispatcher.submit(incoming(sender_id, str(i))) for i in range(10) for sender_id in range(4)]
+        await asyncio.gather(*futures)
+        await dispatcher.stop()
+
+    asyncio.run(run())
+
+    for sender_id in range(4):
+        assert [text for sender, text in handled if sender == sender_id] == [str(i) for i in range(10)]
+    assert max_in_flight > 1
+
+
+def test_dispatcher__applies_backpressure_when_shard_is_full():
+    release = asyncio.Event()
+
+    async def handler(message: IncomingMessage):
+        await release.wait()
+
+    async def run():
+        dispatcher = SenderDispatcher(handler, num_shards=1, shard_queue_size=1)
+        dispatcher.start()
+        first = await dispatcher.submit(incoming(1, 'first'))
+        await asyncio.sleep(0)  # Let the worker take the first message off the queue.
+        await dispatcher.submit(incoming(1, 'second'))
+
+        blocked = asyncio.create_task(dispatcher.submit(incoming(1, 'third')))
+        await asyncio.sleep(0.01)
+        assert not blocked.done()
+
+        release.set()
+        await first
+        await asyncio.wait_for(blocked, timeout=1)
+        await dispatcher.stop()
+
+    asyncio.run(run())
+
+
+def test_dispatcher__propagates_handler_errors():
+    async def handler(message: IncomingMessage):
+        raise RuntimeError('boom')
+
+    async def run():
+        dispatcher = SenderDispatcher(handler, num_shards=2)
+        dispatcher.start()
+        try:
+            await dispatcher.handle(incoming(1, 'hello'))
+        except RuntimeError as e:
+            return e
+        finally:
+            await dispatcher.stop()
+
+    assert str(asyncio.run(run())) == 'boom'
+
+
+def incoming(sender_id: int, text: str) -> IncomingMessage:
+    return IncomingMessage(
+        sender_id=sender_id,
+        recipient_id=0,
+        timestamp=datetime(2022, 10, 20, 11, 22, 33),
+        message_id='<messageid>',
+        text=text
+    )
@@ -0,0 +1,248 @@
+import asyncio
+import concurrent.futures
+import csv
+import io
+import json
+import threading
+import weakref
+import zlib
+
+from contextlib import closing
+from dataclasses import dataclass
+from datetime import datetime
+from decimal import Decimal
+from typing import Any, AsyncIterator, Iterable, Iterator, Mapping, Optional, Sequence, Tuple
+from uuid import UUID
+
+import bot.db_service as db
+
+from peewee import JOIN, Select
+from playhouse.postgres_ext import ServerSide
+
+from bot.models import Conversation, Person, Review
+from bot.settings import EXPORT_CHUNK_ROWS, EXPORT_CURSOR_ARRAY_SIZE, EXPORT_MAX_CONCURRENT, EXPORT_STREAM_QUEUE_SIZE
+
+
+EXPORT_FORMATS = ('csv', 'jsonl')
+EXPORT_COLUMNS = (
+    'review_id',
+    'created_at',
+    'product_id',
+    'estimated_review_stars',
+    'raw_message',
+    'person_id',
+    'first_name',
+    'last_name',
+    'conversation_id',
+    'conversation_started_at',
+)
+CONTENT_TYPES = {
+    'csv': 'text/csv; charset=utf-8',
+    'jsonl': 'application/x-ndjson',
+}
+
+
+@dataclass(frozen=True)
+class ExportFilter:
+    # Reviews created in [created_from, created_until).
+    created_from: Optional[datetime] = None
+    created_until: Optional[datetime] = None
+    product_id: Optional[int] = None
+
+
+def parse_filter(params: Mapping[str, str]) -> ExportFilter:
+    """
+    Build a filter from the `from`, `until` (ISO 8601) and `product_id` parameters.
+    Raises ValueError if any of them is malformed.
+    """
+    created_from = params.get('from')
+    created_until = params.get('until')
+    product_id = params.get('product_id')
+    return ExportFilter(
+        created_from=datetime.fromisoformat(created_from) if created_from else None,
+        created_until=datetime.fromisoformat(created_until) if created_until else None,
+        product_id=int(product_id) if product_id else None,
+    )
+
+
+def review_export_query(filters: ExportFilter) -> Select:
+    query = (Review
+        .select(
+            Review.id,
+            Review.created_at,
+            Review.product_id,
+            Review.estimated_review_stars,
+            Review.raw_message,
+            Person.id,
+            Person.first_name,
+            Person.last_name,
+            Conversation.id,
+            Conversation.started_at)
+        .join(Person, on=(Review.person == Person.id))
+        .switch(Review)
+        # The conversation may already be archived; its columns are then empty.
+        .join(Conversation, JOIN.LEFT_OUTER, on=(Review.conversation_id == Conversation.id)))
+    if filters.created_from is not None:
+        query = query.where(Review.created_at >= filters.created_from)
+    if filters.created_until is not None:
+        query = query.where(Review.created_at < filters.created_until)
+    if filters.product_id is not None:
+        query = query.where(Review.product_id == filters.product_id)
+    return query.order_by(Review.created_at, Review.id).tuples()
+
+
+def iter_review_rows(filters: ExportFilter, array_size: int = EXPORT_CURSOR_ARRAY_SIZE) -> Iterator[Tuple]:
+    """
+    Rows of review_export_query() as plain tuples, fetched `array_size` at a time through a named
+    (server-side) cursor, so only one batch is held in memory however many rows match.
+
+    The cursor lives in a transaction on the calling thread's connection until the iterator is
+    exhausted or closed.
+    """
+    return ServerSide(review_export_query(filters), array_size=array_size)
+
+
+def encode_csv(rows: Iterable[Sequence[Any]], chunk_rows: int = EXPORT_CHUNK_ROWS) -> Iterator[bytes]:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_COLUMNS)
+    for i, row in enumerate(rows, start=1):
+        writer.writerow([_to_text(value) for value in row])
+        if i % chunk_rows == 0:
+            yield _drain(buffer)
+    chunk = _drain(buffer)
+    if chunk:
+        yield chunk
+
+
+def encode_jsonl(rows: Iterable[Sequence[Any]], chunk_rows: int = EXPORT_CHUNK_ROWS) -> Iterator[bytes]:
+    buffer = io.StringIO()
+    for i, row in enumerate(rows, start=1):
+        buffer.write(json.dumps(dict(zip(EXPORT_COLUMNS, row)), default=_to_json, ensure_ascii=False))
+        buffer.write('\n')
+        if i % chunk_rows == 0:
+            yield _drain(buffer)
+    chunk = _drain(buffer)
+    if chunk:
+        yield chunk
+
+
+def gzip_chunks(chunks: Iterable[bytes], level: int = 6) -> Iterator[bytes]:
+    # wbits=31 writes a gzip header and trailer around the deflate stream.
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def export_reviews(
+    filters: ExportFilter,
+    format: str = 'csv',
+    compress: bool = False,
+    chunk_rows: int = EXPORT_CHUNK_ROWS,
+) -> Iterator[bytes]:
+    """
+    Encoded export of the reviews matching `filters`, as a stream of byte chunks.
+    """
+    if format not in EXPORT_FORMATS:
+        raise ValueError('Unknown export format %r, expected one of %s' % (format, ', '.join(EXPORT_FORMATS)))
+    rows = iter_review_rows(filters)
+    encode = encode_csv if format == 'csv' else encode_jsonl
+    chunks = encode(rows, chunk_rows)
+    return gzip_chunks(chunks) if compress else chunks
+
+
+_DONE = object()
+_export_slots: 'weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, asyncio.Semaphore]' = weakref.WeakKeyDictionary()
+
+
+async def stream_reviews(
+    filters: ExportFilter,
+    format: str = 'csv',
+    compress: bool = False,
+    queue_size: int = EXPORT_STREAM_QUEUE_SIZE,
+) -> AsyncIterator[bytes]:
+    """
+    export_reviews() for an HTTP response. The export runs as a single db.run() call, whose DB
+    thread owns the cursor's connection for the whole export, and hands chunks over through a
+    bounded queue, so a slow client pauses the cursor instead of piling up rows. At most
+    EXPORT_MAX_CONCURRENT exports run at once, so they never take every DB thread; others wait.
+    """
+    loop = asyncio.get_running_loop()
+    chunks: 'asyncio.Queue[Any]' = asyncio.Queue(maxsize=queue_size)
+    stop = threading.Event()
+
+    def put(item: Any) -> bool:
+        # On the DB thread: wait for room in the queue, unless the client has gone.
+        future = asyncio.run_coroutine_threadsafe(chunks.put(item), loop)
+        while True:
+            try:
+                future.result(timeout=0.1)
+                return True
+            except concurrent.futures.TimeoutError:
+                if stop.is_set():
+                    future.cancel()
+                    return False
+
+    def produce() -> None:
+        try:
+            with closing(export_reviews(filters, format, compress)) as export:
+                for chunk in export:
+                    if not put(chunk):
+                        return
+            put(_DONE)
+        except Exception as e:
+            put(e)
+
+    def check_started(producer: asyncio.Future) -> None:
+        # db.run() fails without running produce() if no DB thread frees up in time.
+        if not producer.cancelled() and producer.exception() is not None:
+            chunks.put_nowait(producer.exception())
+
+    async with _export_slot():
+        producer = asyncio.ensure_future(db.run(produce))
+        producer.add_done_callback(check_started)
+        try:
+            while True:
+                item = await chunks.get()
+                if item is _DONE:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            stop.set()
+            await asyncio.gather(producer, return_exceptions=True)
+
+
+def _export_slot() -> asyncio.Semaphore:
+    loop = asyncio.get_running_loop()
+    slots = _export_slots.get(loop)
+    if slots is None:
+        slots = _export_slots[loop] = asyncio.Semaphore(EXPORT_MAX_CONCURRENT)
+    return slots
+
+
+def _drain(buffer: io.StringIO) -> bytes:
+    data = buffer.getvalue().encode()
+    buffer.seek(0)
+    buffer.truncate()
+    return data
+
+
+def _to_text(value: Any) -> Any:
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+
+def _to_json(value: Any) -> Any:
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, UUID):
+        return str(value)
+    raise TypeError('%r is not JSON serializable' % (value,))
@@ -0,0 +1,137 @@
+import asyncio
+import csv
+import gzip
+import io
+import json
+import pytest
+
+import bot.export as export
+
+from bot.models import Conversation, Person, Review
+from datetime import datetime
+from decimal import Decimal
+from uuid import UUID
+
+
+@pytest.fixture(scope='function', autouse=True)
+def clear_database():
+    try:
+        yield
+    finally:
+        Review.delete().execute()
+        Conversation.delete().execute()
+        Person.delete().execute()
+
+
+ROW = (
+    UUID('00000000-0000-0000-0000-000000000001'),
+    datetime(2022, 10, 20, 12, 30),
+    7,
+    Decimal('4.250'),
+    'Great, "really"',
+    1,
+    'Jane',
+    None,
+    UUID('00000000-0000-0000-0000-000000000002'),
+    datetime(2022, 10, 20, 12),
+)
+
+
+def test_encode_csv__writes_header_and_rows_in_chunks():
+    chunks = list(export.encode_csv([ROW] * 5, chunk_rows=2))
+
+    assert len(chunks) == 3
+    rows = list(csv.reader(io.StringIO(b''.join(chunks).decode())))
+    assert rows[0] == list(export.EXPORT_COLUMNS)
+    assert len(rows) == 6
+    assert rows[1][1] == '2022-10-20T12:30:00'
+    assert rows[1][4] == 'Great, "really"'
+    assert rows[1][7] == ''
+
+
+def test_encode_jsonl__writes_one_object_per_line():
+    lines = b''.join(export.encode_jsonl([ROW] * 3, chunk_rows=2)).decode().splitlines()
+
+    assert len(lines) == 3
+    assert json.loads(lines[0]) == {
+        'review_id': '00000000-0000-0000-0000-000000000001',
+        'created_at': '2022-10-20T12:30:00',
+        'product_id': 7,
+        'estimated_review_stars': 4.25,
+        'raw_message': 'Great, "really"',
+        'person_id': 1,
+        'first_name': 'Jane',
+        'last_name': None,
+        'conversation_id': '00000000-0000-0000-0000-000000000002',
+        'conversation_started_at': '2022-10-20T12:00:00',
+    }
+
+
+def test_gzip_chunks__round_trips():
+    chunks = [b'a' * 1000, b'b' * 1000, b'']
+
+    assert gzip.decompress(b''.join(export.gzip_chunks(chunks))) == b''.join(chunks)
+
+
+def test_parse_filter__rejects_malformed_values():
+    assert export.parse_filter({}) == export.ExportFilter()
+    assert export.parse_filter({'from': '2022-10-01', 'product_id': '7'}) == export.ExportFilter(
+        created_from=datetime(2022, 10, 1), product_id=7)
+    with pytest.raises(ValueError):
+        export.parse_filter({'until': 'yesterday'})
+
+
+def test_export_reviews__streams_filtered_reviews():
+    create_reviews()
+
+    data = b''.join(export.export_reviews(
+        export.ExportFilter(created_from=datetime(2022, 10, 2), product_id=7), format='jsonl', compress=True))
+
+    rows = [json.loads(line) for line in gzip.decompress(data).decode().splitlines()]
+    assert [row['raw_message'] for row in rows] == ['second', 'third']
+    assert rows[0]['first_name'] == 'Jane'
+
+
+def test_stream_reviews__yields_the_same_bytes():
+    create_reviews()
+
+    async def collect():
+        return b''.join([chunk async for chunk in export.stream_reviews(export.ExportFilter(), 'csv')])
+
+    assert asyncio.run(collect()) == b''.join(export.export_reviews(export.ExportFilter(), 'csv'))
+
+
+def test_stream_reviews__waits_for_a_free_export_slot(monkeypatch):
+    create_reviews()
+    monkeypatch.setattr(export, 'EXPORT_MAX_CONCURRENT', 1)
+
+    async def collect():
+        return b''.join([chunk async for chunk in export.stream_reviews(export.ExportFilter(), 'csv')])
+
+    async def run():
+        first = export.stream_reviews(export.ExportFilter(), 'csv')
+        await first.__anext__()
+        second = asyncio.ensure_future(collect())
+        await asyncio.sleep(0.2)
+        waited = not second.done()
+        # As when the first client disconnects.
+        await first.aclose()
+        return waited, await second
+
+    waited, data = asyncio.run(run())
+
+    assert waited
+    assert data == b''.join(export.export_reviews(export.ExportFilter(), 'csv'))
+
+
+def create_reviews():
+    person = Person.create(id=1, first_name='Jane', last_name='Doe', created_at=datetime.now())
+    convo = Conversation.create(person=person, started_at=datetime.now())
+    for message, product_id, created_at in [
+        ('first', 7, datetime(2022, 10, 1)),
+        ('second', 7, datetime(2022, 10, 2)),
+        ('other', 8, datetime(2022, 10, 3)),
+        ('third', 7, datetime(2022, 10, 4)),
+    ]:
+        Review.create(conversation_id=convo.id, person=person, product_id=product_id, created_at=created_at,
+            estimated_review_stars=4, raw_message=message)
@@ -0,0 +1,156 @@
+import math
+import re
+
+from dataclasses import asdict, dataclass
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+import bot.metrics as metrics
+
+from bot.inference import get_inference_engine
+from bot.sentiment_cache import get_sentiment_cache
+from bot.settings import (
+    FAST_SENTIMENT_CONFIDENCE_THRESHOLD,
+    FAST_SENTIMENT_ENABLED,
+    FAST_SENTIMENT_INTERCEPT,
+    FAST_SENTIMENT_MAX_LENGTH,
+    FAST_SENTIMENT_SLOPE,
+)
+
+
+# Polarity of common review words, from -2 (very negative) to +2 (very positive).
+LEXICON: Dict[str, float] = {
+    'amazing': 2.0, 'awesome': 2.0, 'best': 2.0, 'excellent': 2.0, 'fantastic': 2.0, 'incredible': 2.0,
+    'love': 2.0, 'loved': 2.0, 'outstanding': 2.0, 'perfect': 2.0, 'superb': 2.0, 'wonderful': 2.0,
+    'brilliant': 2.0, 'flawless': 2.0, 'impressive': 1.5, 'recommend': 1.5, 'great': 1.5,
+    'happy': 1.0, 'good': 1.0, 'nice': 1.0, 'helpful': 1.0, 'friendly': 1.0, 'easy': 1.0, 'quick': 1.0,
+    'smooth': 1.0, 'pleased': 1.0, 'satisfied': 1.0, 'thanks': 0.5, 'thank': 0.5, 'fine': 0.5, 'ok': 0.0,
+    'okay': 0.0, 'average': 0.0, 'meh': -0.5, 'slow': -1.0, 'late': -1.0, 'expensive': -1.0,
+    'disappointed': -1.5, 'disappointing': -1.5, 'poor': -1.5, 'rude': -1.5, 'unhelpful': -1.5,
+    'broken': -1.5, 'broke': -1.5, 'bad': -1.5, 'problem': -1.0, 'problems': -1.0, 'issue': -0.5,
+    'awful': -2.0, 'horrible': -2.0, 'terrible': -2.0, 'worst': -2.0, 'hate': -2.0, 'hated': -2.0,
+    'useless': -2.0, 'scam': -2.0,
+}
+NEGATIONS = {'not', 'no', 'never', 'nothing', 'hardly', 'without'}
+# How many tokens after a negation have their polarity flipped.
+NEGATION_SCOPE = 3
+
+_TOKEN = re.compile(r"[a-z']+")
+
+
+@dataclass(frozen=True)
+class FastPrediction:
+    stars: float
+    confidence: float
+
+
+class LexiconSentimentClassifier:
+    """
+    Cheap first-stage sentiment estimate from a word polarity lexicon.
+
+    The mean polarity of the matched words is mapped linearly onto the 1-5 star scale (slope and
+    intercept can be calibrated against the model with scripts/calibrate_fast_sentiment.py). The
+    confidence is high when several matched words agree in sign and there is no negation, which the
+    lexicon handles only crudely.
+    """
+
+    def __init__(self, slope: float = FAST_SENTIMENT_SLOPE, intercept: float = FAST_SENTIMENT_INTERCEPT):
+        self.slope = slope
+        self.intercept = intercept
+
+    def polarity(self, text: str) -> Optional[Tuple[float, float]]:
+        """
+        Mean polarity of the matched words in [-2, 2] and the confidence in it,
+        or None if no lexicon word occurs in the text.
+        """
+        polarities: List[float] = []
+        negated_for = 0
+        saw_negation = False
+        for token in _TOKEN.findall(text.lower()):
+            if token in NEGATIONS or token.endswith("n't"):
+                negated_for = NEGATION_SCOPE
+                saw_negation = True
+                continue
+            polarity = LEXICON.get(token)
+            if polarity is not None:
+                polarities.append(-polarity if negated_for > 0 else polarity)
+            negated_for = max(0, negated_for - 1)
+        if not polarities:
+            return None
+        mean = sum(polarities) / len(polarities)
+        signs = [math.copysign(1, p) for p in polarities if p != 0]
+        agreement = abs(sum(signs)) / len(signs) if signs else 0.0
+        coverage = min(1.0, len(polarities) / 2.0)
+        confidence = agreement * (0.5 + 0.5 * coverage) * (0.5 if saw_negation else 1.0)
+        return mean, confidence
+
+    def predict(self, text: str) -> Optional[FastPrediction]:
+        scored = self.polarity(text)
+        if scored is None:
+            return None
+        polarity, confidence = scored
+        stars = min(5.0, max(1.0, 3.0 + self.slope * polarity + self.intercept))
+        return FastPrediction(stars=stars, confidence=confidence)
+
+
+@dataclass
+class TierStats:
+    fast: int = 0
+    model: int = 0
+
+    def hit_rates(self) -> Dict[str, float]:
+        total = self.fast + self.model
+        if total == 0:
+            return {'fast': 0.0, 'model': 0.0}
+        return {'fast': self.fast / total, 'model': self.model / total}
+
+
+class TieredSentimentClassifier:
+    """
+    Answers short texts the lexicon is confident about directly, and sends everything else
+    (low confidence, or longer than max_length characters) on to the model. By default the model's
+    scores go through the sentiment cache; lexicon estimates don't, so changing or disabling the
+    fast path never leaves its estimates cached as model scores.
+    """
+
+    def __init__(
+        self,
+        model: Optional[Callable[[str], Awaitable[float]]] = None,
+        fast: Optional[LexiconSentimentClassifier] = None,
+        confidence_threshold: float = FAST_SENTIMENT_CONFIDENCE_THRESHOLD,
+        max_length: int = FAST_SENTIMENT_MAX_LENGTH,
+        enabled: bool = FAST_SENTIMENT_ENABLED,
+    ):
+        self._model = model if model is not None else _classify_with_model
+        self._fast = fast if fast is not None else LexiconSentimentClassifier()
+        self._confidence_threshold = confidence_threshold
+        self._max_length = max_length
+        self._enabled = enabled
+        self.stats = TierStats()
+
+    async def classify(self, text: str) -> float:
+        if self._enabled and len(text) <= self._max_length:
+            prediction = self._fast.predict(text)
+            if prediction is not None and prediction.confidence >= self._confidence_threshold:
+                self.stats.fast += 1
+                metrics.SENTIMENT_TIER_SCORES.inc(tier='fast')
+                return prediction.stars
+        self.stats.model += 1
+        metrics.SENTIMENT_TIER_SCORES.inc(tier='model')
+        return await self._model(text)
+
+    def stats_dict(self) -> Dict[str, int]:
+        return asdict(self.stats)
+
+
+async def _classify_with_model(text: str) -> float:
+    return await get_sentiment_cache().get_or_compute(text, get_inference_engine().classify_async)
+
+
+_classifier: Optional[TieredSentimentClassifier] = None
+
+
+def get_tiered_classifier() -> TieredSentimentClassifier:
+    global _classifier
+    if _classifier is None:
+        _classifier = TieredSentimentClassifier()
+    return _classifier
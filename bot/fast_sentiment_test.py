@@ -0,0 +1,85 @@
+import asyncio
+
+import bot.metrics as metrics
+
+from bot.fast_sentiment import LexiconSentimentClassifier, TieredSentimentClassifier
+from bot.sentiment_cache import SentimentCache
+from typing import List
+from unittest import mock
+
+
+class FakeModel:
+
+    def __init__(self):
+        self.texts: List[str] = []
+
+    async def __call__(self, text: str) -> float:
+        self.texts.append(text)
+        return 3.5
+
+
+def test_lexicon__maps_polarity_to_stars():
+    lexicon = LexiconSentimentClassifier()
+
+    assert lexicon.predict('Incredible, just incredible').stars == 5.0
+    assert lexicon.predict('terrible, worst ever').stars == 1.0
+    assert lexicon.predict('the car was red') is None
+
+
+def test_lexicon__negation_flips_polarity_and_lowers_confidence():
+    lexicon = LexiconSentimentClassifier()
+    plain = lexicon.predict('good')
+    negated = lexicon.predict('not good')
+
+    assert negated.stars < 3.0 < plain.stars
+    assert negated.confidence < plain.confidence
+
+
+def test_lexicon__mixed_polarity_has_low_confidence():
+    assert LexiconSentimentClassifier().predict('great car but rude staff').confidence == 0.0
+
+
+def test_tiered__routes_by_confidence_and_length():
+    model = FakeModel()
+    tiered = TieredSentimentClassifier(model, confidence_threshold=0.9, max_length=30, enabled=True)
+    fast_scores = metrics.SENTIMENT_TIER_SCORES.value(tier='fast')
+    model_scores = metrics.SENTIMENT_TIER_SCORES.value(tier='model')
+
+    async def run():
+        return [
+            await tiered.classify('Excellent, loved it'),
+            await tiered.classify('great car but rude staff'),
+            await tiered.classify('excellent excellent excellent excellent'),
+        ]
+
+    assert asyncio.run(run()) == [5.0, 3.5, 3.5]
+    assert model.texts == ['great car but rude staff', 'excellent excellent excellent excellent']
+    assert tiered.stats.hit_rates() == {'fast': 1 / 3, 'model': 2 / 3}
+    assert metrics.SENTIMENT_TIER_SCORES.value(tier='fast') == fast_scores + 1
+    assert metrics.SENTIMENT_TIER_SCORES.value(tier='model') == model_scores + 2
+
+
+def test_tiered__disabled_always_uses_model():
+    model = FakeModel()
+    tiered = TieredSentimentClassifier(model, enabled=False)
+
+    assert asyncio.run(tiered.classify('Excellent, loved it')) == 3.5
+    assert tiered.stats_dict() == {'fast': 0, 'model': 1}
+
+
+def test_tiered__caches_only_model_scores():
+    cache = SentimentCache(persistent=False)
+    model = FakeModel()
+
+    with (mock.patch('bot.fast_sentiment.get_sentiment_cache', return_value=cache),
+        mock.patch('bot.fast_sentiment.get_inference_engine', return_value=mock.MagicMock(classify_async=model))):
+
+        tiered = TieredSentimentClassifier(confidence_threshold=0.9, max_length=30, enabled=True)
+
+        async def run():
+            return [await tiered.classify(text) for text in ['Excellent, loved it', 'great car but rude staff'] * 2]
+
+        assert asyncio.run(run()) == [5.0, 3.5, 5.0, 3.5]
+
+    assert model.texts == ['great car but rude staff']
+    assert cache.stats_dict() == {'memory_hits': 1, 'persistent_hits': 0, 'misses': 1}
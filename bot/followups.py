@@ -0,0 +1,149 @@
+import asyncio
+
+from datetime import datetime, timedelta
+from typing import List, Optional, Tuple
+
+from peewee import Tuple as ValuesTuple
+
+import bot.db_service as db
+import bot.log as log
+import bot.messaging_service as messaging
+import bot.metrics as metrics
+
+from bot.models import AWAITING_PRODUCT, AWAITING_REVIEW, Conversation
+from bot.settings import (
+    FOLLOWUP_BATCH_SIZE,
+    FOLLOWUP_CONCURRENCY,
+    FOLLOWUP_DELAY_SECS,
+    FOLLOWUP_MAX_AGE_SECS,
+    FOLLOWUP_POLL_INTERVAL_SECS,
+)
+
+
+PRODUCT_STAGE = 'product'
+REVIEW_STAGE = 'review'
+FOLLOWUP_PRODUCT_TEMPLATE = 'Still there? Reply with the number of the product you would like to review.'
+FOLLOWUP_REVIEW_TEMPLATE = 'We\'d still love to hear what you thought, or reply NO if you\'d rather not.'
+
+# Per stage: the conversations waiting in it, and the column holding when they started waiting.
+STAGES = (
+    (PRODUCT_STAGE, AWAITING_PRODUCT, Conversation.review_requested_at),
+    (REVIEW_STAGE, AWAITING_REVIEW, Conversation.product_selected_at),
+)
+
+
+def claim_due_followups(now: datetime, delay_secs: float = FOLLOWUP_DELAY_SECS, limit: int = FOLLOWUP_BATCH_SIZE) -> List[Conversation]:
+    """
+    Claim up to `limit` conversations that have been waiting on the person for at least
+    `delay_secs`, longest waiting first, by setting their followed_up_at. That takes them out of
+    the partial indexes the lookup goes through, so each is claimed once per stage. Rows locked by
+    another instance's claim are skipped rather than waited on.
+    """
+    claimed: List[Conversation] = []
+    due_before = now - timedelta(seconds=delay_secs)
+    for _, awaiting, waiting_since in STAGES:
+        if len(claimed) >= limit:
+            break
+        due = (Conversation
+            .select(Conversation.id, Conversation.started_at)
+            .where(awaiting & (waiting_since < due_before))
+            .order_by(waiting_since)
+            .limit(limit - len(claimed))
+            .for_update('FOR UPDATE SKIP LOCKED'))
+        claimed.extend(Conversation
+            .update(followed_up_at=now)
+            .where(ValuesTuple(Conversation.id, Conversation.started_at).in_(due))
+            .returning(Conversation)
+            .execute())
+    return claimed
+
+
+def followup_stage(convo: Conversation) -> Tuple[str, datetime]:
+    """
+    The stage a claimed conversation is stalled in, and when it started waiting.
+    """
+    if convo.product_selected_at is None:
+        return PRODUCT_STAGE, convo.review_requested_at
+    return REVIEW_STAGE, convo.product_selected_at
+
+
+class FollowupScheduler:
+    """
+    Reminds persons of conversations stalled waiting on them, once per stage.
+
+    Due conversations are claimed in pages of `batch_size` (see claim_due_followups), so any number
+    of app processes can run a scheduler. Reminders are sent with at most `concurrency` in flight.
+    A claimed conversation isn't claimed again, so a reminder that fails to send, or is lost to a
+    crash, isn't retried. Conversations stalled for longer than `max_age_secs` are claimed without
+    a reminder, which Messenger would reject anyway. Every stage starts with a message from the
+    person, so that age runs from it; proactively restarted conversations wait for the person's
+    reply instead (see messaging_service._restart_review).
+    """
+
+    def __init__(
+        self,
+        delay_secs: float = FOLLOWUP_DELAY_SECS,
+        max_age_secs: float = FOLLOWUP_MAX_AGE_SECS,
+        batch_size: int = FOLLOWUP_BATCH_SIZE,
+        concurrency: int = FOLLOWUP_CONCURRENCY,
+        poll_interval_secs: float = FOLLOWUP_POLL_INTERVAL_SECS,
+    ):
+        self._delay_secs = delay_secs
+        self._max_age_secs = max_age_secs
+        self._batch_size = batch_size
+        self._limit = asyncio.Semaphore(concurrency)
+        self._poll_interval_secs = poll_interval_secs
+
+    async def run(self) -> None:
+        while True:
+            try:
+                claimed = await self.run_once()
+            except Exception:
+                log.error('followup.claim_failed')
+                claimed = 0
+            # A full page means more may be due already.
+            if claimed < self._batch_size:
+                await asyncio.sleep(self._poll_interval_secs)
+
+    async def run_once(self) -> int:
+        now = datetime.now()
+        convos = await db.run(claim_due_followups, now, self._delay_secs, self._batch_size)
+        await asyncio.gather(*[self._follow_up(convo, now) for convo in convos])
+        return len(convos)
+
+    async def _follow_up(self, convo: Conversation, now: datetime) -> None:
+        stage, waiting_since = followup_stage(convo)
+        if waiting_since < now - timedelta(seconds=self._max_age_secs):
+            metrics.FOLLOWUPS.inc(stage=stage, outcome='expired')
+            return
+        text = FOLLOWUP_PRODUCT_TEMPLATE if stage == PRODUCT_STAGE else FOLLOWUP_REVIEW_TEMPLATE
+        async with self._limit:
+            try:
+                await messaging.handle_outgoing_message(
+                    messaging.OutgoingMessage(recipient_id=convo.person_id, text=text, is_response=False))
+            except Exception as e:
+                metrics.FOLLOWUPS.inc(stage=stage, outcome='failed')
+                log.warning('followup.failed', conversation_id=convo.id, stage=stage, error=str(e))
+                return
+        metrics.FOLLOWUPS.inc(stage=stage, outcome='sent')
+        log.event('followup.sent', conversation_id=convo.id, person_id=convo.person_id, stage=stage)
+
+
+_scheduler_task: Optional[asyncio.Task] = None
+
+
+def start_scheduler() -> None:
+    """
+    Run a follow-up scheduler on the running event loop.
+    """
+    global _scheduler_task
+    _scheduler_task = asyncio.create_task(FollowupScheduler().run(), name='followup-scheduler')
+
+
+async def stop_scheduler() -> None:
+    global _scheduler_task
+    if _scheduler_task is None:
+        return
+    _scheduler_task.cancel()
+    await asyncio.gather(_scheduler_task, return_exceptions=True)
+    _scheduler_task = None
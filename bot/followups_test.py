@@ -0,0 +1,89 @@
+import asyncio
+
+import pytest
+
+import bot.followups as followups
+import bot.messaging_service as messaging
+
+from bot.models import Conversation, Person
+from datetime import datetime, timedelta
+from unittest import mock
+
+
+NOW = datetime(2022, 10, 20, 12, 0, 0)
+
+
+@pytest.fixture(scope='function', autouse=True)
+def clear_database():
+    try:
+        yield
+    finally:
+        Conversation.delete().execute()
+        Person.delete().execute()
+
+
+def create_conversation(person_id: int, **states) -> Conversation:
+    person = Person.create(id=person_id, created_at=NOW - timedelta(days=1))
+    return Conversation.create(person=person, started_at=NOW - timedelta(days=1), **states)
+
+
+def hours_ago(hours: float) -> datetime:
+    return NOW - timedelta(hours=hours)
+
+
+def test_claim_due_followups__claims_each_stalled_conversation_once():
+    create_conversation(1, review_requested_at=hours_ago(7))
+    create_conversation(2, review_requested_at=hours_ago(8), product_selected_at=hours_ago(7))
+    # Not waiting long enough yet.
+    create_conversation(3, review_requested_at=hours_ago(1))
+    # Not waiting on the person.
+    create_conversation(4)
+    create_conversation(5, review_requested_at=hours_ago(9), product_selected_at=hours_ago(8), review_recieved_at=hours_ago(7))
+    create_conversation(6, review_requested_at=hours_ago(9), declined_review_at=hours_ago(8))
+
+    claimed = followups.claim_due_followups(NOW, delay_secs=6 * 60 * 60)
+
+    assert sorted(convo.person_id for convo in claimed) == [1, 2]
+    assert all(convo.followed_up_at == NOW for convo in claimed)
+    assert followups.claim_due_followups(NOW, delay_secs=6 * 60 * 60) == []
+
+
+def test_claim_due_followups__claims_again_at_the_next_stage():
+    convo = create_conversation(1, review_requested_at=NOW - timedelta(hours=10))
+    [claimed] = followups.claim_due_followups(NOW - timedelta(hours=3), delay_secs=6 * 60 * 60)
+    assert followups.followup_stage(claimed) == (followups.PRODUCT_STAGE, convo.review_requested_at)
+
+    Conversation.update(product_selected_at=NOW - timedelta(hours=2)).where(Conversation.person == 1).execute()
+
+    assert followups.claim_due_followups(NOW, delay_secs=60 * 60, limit=1)[0].person_id == 1
+
+
+def test_claim_due_followups__leaves_out_proactively_restarted_conversations():
+    convo = create_conversation(1, review_requested_at=hours_ago(30), product_selected_at=hours_ago(29))
+    messaging._restart_review(convo)
+    now = datetime.now() + timedelta(hours=7)
+
+    assert followups.claim_due_followups(now, delay_secs=6 * 60 * 60) == []
+
+    # Until the person replies.
+    Conversation.update(product_selected_at=datetime.now()).where(Conversation.person == 1).execute()
+
+    [claimed] = followups.claim_due_followups(now, delay_secs=6 * 60 * 60)
+    assert followups.followup_stage(claimed)[0] == followups.REVIEW_STAGE
+
+
+def test_scheduler__sends_reminders_and_expires_old_conversations():
+    create_conversation(1, review_requested_at=datetime.now() - timedelta(hours=7))
+    create_conversation(2, review_requested_at=datetime.now() - timedelta(hours=8), product_selected_at=datetime.now() - timedelta(hours=7))
+    create_conversation(3, review_requested_at=datetime.now() - timedelta(days=3))
+    scheduler = followups.FollowupScheduler(delay_secs=6 * 60 * 60, max_age_secs=24 * 60 * 60, batch_size=10)
+
+    with mock.patch('bot.messaging_service.handle_outgoing_message') as mock_outgoing:
+        assert asyncio.run(scheduler.run_once()) == 3
+
+    sent = {call.args[0].recipient_id: call.args[0] for call in mock_outgoing.call_args_list}
+    assert sorted(sent) == [1, 2]
+    assert sent[1].text == followups.FOLLOWUP_PRODUCT_TEMPLATE
+    assert sent[2].text == followups.FOLLOWUP_REVIEW_TEMPLATE
+    assert not sent[1].is_response
+    assert Conversation.select().where(Conversation.followed_up_at.is_null()).count() == 0
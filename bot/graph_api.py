@@ -0,0 +1,100 @@
+import asyncio
+import functools
+import threading
+import weakref
+import requests
+
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from typing import Any, Dict, Optional
+from urllib.parse import urlsplit
+
+import bot.metrics as metrics
+
+from bot.settings import (
+    GRAPH_API_MAX_CONNECTIONS,
+    GRAPH_API_MAX_CONNECTIONS_PER_HOST,
+    GRAPH_API_TIMEOUT_SECS,
+)
+
+
+class GraphApiClient:
+    """
+    Awaitable HTTP client for the Graph API (Send API and profile API).
+
+    Requests run on a dedicated thread pool over a shared requests.Session, so the calling event loop
+    is never blocked and TLS connections are kept alive and reused across calls. Concurrency is
+    bounded per host by an asyncio semaphore; callers beyond the limit wait on the event loop rather
+    than tying up a pool thread. The host is taken from the request URL, so the client can be pointed
+    at a local stub server in tests.
+    """
+
+    def __init__(
+        self,
+        max_connections: int = GRAPH_API_MAX_CONNECTIONS,
+        max_connections_per_host: int = GRAPH_API_MAX_CONNECTIONS_PER_HOST,
+        timeout_secs: float = GRAPH_API_TIMEOUT_SECS,
+    ):
+        self._max_connections_per_host = max_connections_per_host
+        self._timeout_secs = timeout_secs
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=max_connections, pool_maxsize=max_connections_per_host, pool_block=True)
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+        self._executor = ThreadPoolExecutor(max_workers=max_connections, thread_name_prefix='graph-api')
+        # Semaphores belong to the event loop they are awaited on, so keep one set per loop.
+        self._host_limits: 'weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Dict[str, asyncio.Semaphore]]' = weakref.WeakKeyDictionary()
+
+    async def get(self, url: str, params: Optional[Dict[str, Any]] = None) -> requests.Response:
+        return await self.request('GET', url, params=params)
+
+    async def post(
+        self,
+        url: str,
+        params: Optional[Dict[str, Any]] = None,
+        headers: Optional[Dict[str, str]] = None,
+        json: Optional[Any] = None,
+    ) -> requests.Response:
+        return await self.request('POST', url, params=params, headers=headers, json=json)
+
+    async def request(self, method: str, url: str, **kwargs) -> requests.Response:
+        loop = asyncio.get_running_loop()
+        send = functools.partial(self._session.request, method, url, timeout=self._timeout_secs, **kwargs)
+        async with self._host_limit(loop, urlsplit(url).netloc):
+            try:
+                response = await loop.run_in_executor(self._executor, send)
+            except Exception:
+                metrics.GRAPH_API_REQUESTS.inc(method=method, outcome='error')
+                raise
+        metrics.GRAPH_API_REQUESTS.inc(method=method, outcome='ok' if response.ok else 'http_error')
+        return response
+
+    def close(self) -> None:
+        self._executor.shutdown(wait=True)
+        self._session.close()
+
+    def _host_limit(self, loop: asyncio.AbstractEventLoop, host: str) -> asyncio.Semaphore:
+        limits = self._host_limits.setdefault(loop, {})
+        if host not in limits:
+            limits[host] = asyncio.Semaphore(self._max_connections_per_host)
+        return limits[host]
+
+
+_client: Optional[GraphApiClient] = None
+_client_lock = threading.Lock()
+
+
+def get_graph_api_client() -> GraphApiClient:
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = GraphApiClient()
+        return _client
+
+
+def close_graph_api_client() -> None:
+    global _client
+    with _client_lock:
+        if _client is not None:
+            _client.close()
+            _client = None
@@ -0,0 +1,136 @@
+import asyncio
+import json
+import threading
+import time
+
+import pytest
+
+from bot.graph_api import GraphApiClient
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class StubGraphApi(ThreadingHTTPServer):
+
+    def __init__(self, delay_secs: float = 0.0):
+        super().__init__(('127.0.0.1', 0), StubHandler)
+        self.delay_secs = delay_secs
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.client_ports = set()
+
+    @property
+    def url(self) -> str:
+        return 'http://127.0.0.1:%s' % self.server_address[1]
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self._respond({'first_name': 'Fake', 'last_name': 'Person'})
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        self._respond({'echo': json.loads(body)})
+
+    def _respond(self, obj):
+        server: StubGraphApi = self.server
+        with server.lock:
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight, server.in_flight)
+            server.client_ports.add(self.client_address[1])
+        time.sleep(server.delay_secs)
+        with server.lock:
+            server.in_flight -= 1
+        body = json.dumps(obj).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def stub_server():
+    servers = []
+
+    def start(delay_secs: float = 0.0) -> StubGraphApi:
+        server = StubGraphApi(delay_secs)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def test_get_and_post(stub_server):
+    server = stub_server()
+    client = GraphApiClient()
+    try:
+        async def run():
+            profile = await client.get(server.url + '/1', params={'fields': 'first_name,last_name'})
+            sent = await client.post(server.url + '/v15.0/me/messages', json={'message': {'text': 'hi'}})
+            return profile.json(), sent.json()
+
+        profile, sent = asyncio.run(run())
+        assert profile == {'first_name': 'Fake', 'last_name': 'Person'}
+        assert sent == {'echo': {'message': {'text': 'hi'}}}
+    finally:
+        client.close()
+
+
+def test_concurrency_is_limited_per_host(stub_server):
+    server = stub_server(delay_secs=0.05)
+    client = GraphApiClient(max_connections=8, max_connections_per_host=2)
+    try:
+        async def run():
+            await asyncio.gather(*[client.get(server.url + '/%s' % i) for i in range(8)])
+
+        asyncio.run(run())
+        assert server.max_in_flight == 2
+    finally:
+        client.close()
+
+
+def test_connections_are_reused(stub_server):
+    server = stub_server()
+    client = GraphApiClient(max_connections=4, max_connections_per_host=1)
+    try:
+        async def run():
+            for i in range(5):
+                await client.get(server.url + '/%s' % i)
+
+        asyncio.run(run())
+        assert len(server.client_ports) == 1
+    finally:
+        client.close()
+
+
+def test_event_loop_is_not_blocked(stub_server):
+    server = stub_server(delay_secs=0.2)
+    client = GraphApiClient()
+    try:
+        async def run():
+            ticks = 0
+
+            async def tick():
+                nonlocal ticks
+                while True:
+                    await asyncio.sleep(0.01)
+                    ticks += 1
+
+            ticker = asyncio.create_task(tick())
+            await client.get(server.url + '/1')
+            ticker.cancel()
+            return ticks
+
+        assert asyncio.run(run()) > 5
+    finally:
+        client.close()
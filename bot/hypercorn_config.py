@@ -1,6 +1,12 @@
+import bot.settings as settings
+
 bind = '127.0.0.1'
 # bind = '0.0.0.0'
 worker_class = 'asyncio'
+workers = settings.HYPERCORN_WORKERS
+if settings.CONVERSATION_STATE_ENABLED and workers > 1:
+    # Each worker would hold its own, diverging copy of the same conversations.
+    raise ValueError('CONVERSATION_STATE_ENABLED requires HYPERCORN_WORKERS=1, got %s' % workers)
 loglevel = 'info'
 accesslog = '-'
 errorlog = '-'
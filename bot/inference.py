@@ -0,0 +1,350 @@
+import asyncio
+import json
+import queue
+import socket
+import threading
+import time
+
+from concurrent.futures import Future
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List, Optional, Sequence, Union
+
+import bot.metrics as metrics
+
+from bot.settings import (
+    INFERENCE_BACKEND,
+    INFERENCE_MAX_BATCH_SIZE,
+    INFERENCE_MAX_WAIT_MS,
+    INFERENCE_NUM_THREADS,
+    INFERENCE_REQUEST_TIMEOUT_SECS,
+    INFERENCE_SOCKET,
+)
+
+
+MODEL_NAME = 'nlptown/bert-base-multilingual-uncased-sentiment'
+TOP_K = 5
+WARM_UP_TEXT = 'Thanks, this was a great experience!'
+# fp32: the model as published. int8: Linear layers dynamically quantized to int8, for faster CPU inference.
+INFERENCE_BACKENDS = ('fp32', 'int8')
+
+LabelScores = List[Dict[str, float]]
+# Takes a list of texts and returns the top-k label scores for each of them, in order.
+BatchClassifier = Callable[[List[str]], List[LabelScores]]
+
+
+_sentiment_classifier: Optional[Any] = None
+_classifier_lock = threading.Lock()
+
+
+def load_sentiment_classifier(backend: str = INFERENCE_BACKEND, num_threads: int = INFERENCE_NUM_THREADS) -> Any:
+    """
+    Build the sentiment pipeline for one of INFERENCE_BACKENDS.
+    num_threads sets torch's intra-op thread count for the whole process; 0 keeps torch's default.
+    """
+    if backend not in INFERENCE_BACKENDS:
+        raise ValueError('Unknown inference backend %s, expected one of %s' % (backend, INFERENCE_BACKENDS))
+
+    import torch
+    from transformers import AutoTokenizer, AutoModelForSequenceClassification, pipeline
+
+    if num_threads > 0:
+        torch.set_num_threads(num_threads)
+    tokenizer = AutoTokenizer.from_pretrained(MODEL_NAME)
+    model = AutoModelForSequenceClassification.from_pretrained(MODEL_NAME)
+    if backend == 'int8':
+        model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    return pipeline('sentiment-analysis', model=model, tokenizer=tokenizer)
+
+
+def get_sentiment_classifier() -> Any:
+    """
+    Load the tokenizer, model and pipeline on first use rather than at import time, so that
+    processes which never classify anything don't pay for importing torch and the model weights.
+    """
+    global _sentiment_classifier
+    with _classifier_lock:
+        if _sentiment_classifier is None:
+            _sentiment_classifier = load_sentiment_classifier()
+        return _sentiment_classifier
+
+
+def classify_batch(texts: List[str], classifier: Optional[Any] = None) -> List[LabelScores]:
+    """
+    Run a list of texts through the sentiment pipeline as a single padded batch.
+    """
+    classifier = classifier if classifier is not None else get_sentiment_classifier()
+    return classifier(texts, top_k=TOP_K, batch_size=len(texts), truncation=True)
+
+
+def weighted_stars(label_scores: LabelScores) -> float:
+    """
+    Collapse the "N stars" label scores of the nlptown model into a single expected star rating.
+    """
+    weighted_average_stars = 0.0
+    for label_score in label_scores:
+        stars = int(label_score['label'][0])
+        score = label_score['score']
+        weighted_average_stars += stars * score
+    return weighted_average_stars
+
+
+@dataclass
+class _PendingText:
+    text: str
+    future: Future
+
+
+class BatchingInferenceEngine:
+    """
+    Gathers texts submitted concurrently (from threads or coroutines) and runs them through the
+    classifier together. A batch is flushed as soon as it holds max_batch_size texts, or once the
+    oldest text in it has waited max_wait_secs, which bounds the latency added by batching.
+    """
+
+    def __init__(
+        self,
+        classifier: BatchClassifier,
+        max_batch_size: int = INFERENCE_MAX_BATCH_SIZE,
+        max_wait_secs: float = INFERENCE_MAX_WAIT_MS / 1000.0,
+    ):
+        if max_batch_size < 1:
+            raise ValueError('max_batch_size must be at least 1')
+        self._classifier = classifier
+        self._max_batch_size = max_batch_size
+        self._max_wait_secs = max(0.0, max_wait_secs)
+        self._queue: 'queue.Queue[Optional[_PendingText]]' = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._closed = False
+
+    def submit(self, text: str) -> Future:
+        """
+        Queue a text for classification. The returned future resolves to its weighted star score.
+        """
+        future: Future = Future()
+        with self._lock:
+            if self._closed:
+                raise RuntimeError('Inference engine is closed')
+            self._ensure_started()
+            self._queue.put(_PendingText(text=text, future=future))
+        return future
+
+    def classify(self, text: str) -> float:
+        return self.submit(text).result()
+
+    async def classify_async(self, text: str) -> float:
+        return await asyncio.wrap_future(self.submit(text))
+
+    def close(self) -> None:
+        """
+        Stop the batching thread once every text queued so far has been classified.
+        """
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            thread = self._thread
+            if thread is not None:
+                self._queue.put(None)
+        if thread is not None:
+            thread.join()
+
+    def _ensure_started(self) -> None:
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='inference-batcher', daemon=True)
+            self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            first = self._queue.get()
+            if first is None:
+                return
+            batch = [first]
+            stop = self._fill_batch(batch)
+            self._flush(batch)
+            if stop:
+                return
+
+    def _fill_batch(self, batch: List[_PendingText]) -> bool:
+        """
+        Add queued texts to the batch until it is full or the wait deadline passes.
+        Returns True if the engine was closed while filling.
+        """
+        deadline = time.monotonic() + self._max_wait_secs
+        while len(batch) < self._max_batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining > 0:
+                    item = self._queue.get(timeout=remaining)
+                else:
+                    item = self._queue.get_nowait()
+            except queue.Empty:
+                return False
+            if item is None:
+                return True
+            batch.append(item)
+        return False
+
+    def _flush(self, batch: Sequence[_PendingText]) -> None:
+        pending = [item for item in batch if item.future.set_running_or_notify_cancel()]
+        if not pending:
+            return
+        metrics.INFERENCE_BATCH_SIZE.observe(len(pending))
+        try:
+            results = self._classifier([item.text for item in pending])
+            scores = [weighted_stars(label_scores) for label_scores in results]
+        except Exception as e:
+            for item in pending:
+                item.future.set_exception(e)
+            return
+        for item, score in zip(pending, scores):
+            item.future.set_result(score)
+
+
+class InferenceError(Exception):
+    """
+    The inference server failed to score a text, or rejected it because it was overloaded.
+    """
+
+
+def encode_message(message: Dict[str, Any]) -> bytes:
+    # The inference server protocol: one JSON object per line, in both directions.
+    return json.dumps(message).encode() + b'\n'
+
+
+class InferenceClient:
+    """
+    Scores texts on the inference server (bot.inference_server) over a Unix socket, instead of
+    loading the model in this process. Same interface as BatchingInferenceEngine.
+
+    Requests from every thread and coroutine share one connection, opened on first use and again
+    after it drops; a reader thread resolves their futures as responses arrive.
+    """
+
+    def __init__(self, socket_path: str, timeout_secs: float = INFERENCE_REQUEST_TIMEOUT_SECS):
+        self._socket_path = socket_path
+        self._timeout_secs = timeout_secs
+        self._lock = threading.Lock()
+        self._socket: Optional[socket.socket] = None
+        self._pending: Dict[int, Future] = {}
+        self._next_id = 0
+        self._closed = False
+
+    def submit(self, text: str) -> Future:
+        """
+        Send a text to the server. The returned future resolves to its weighted star score.
+        Raises OSError if the server can't be reached.
+        """
+        future: Future = Future()
+        with self._lock:
+            if self._closed:
+                raise RuntimeError('Inference client is closed')
+            connection = self._connect()
+            self._next_id += 1
+            self._pending[self._next_id] = future
+            try:
+                connection.sendall(encode_message({'id': self._next_id, 'text': text}))
+                return future
+            except OSError as e:
+                error = e
+        self._disconnect(connection, error)
+        return future
+
+    def classify(self, text: str) -> float:
+        return self.submit(text).result(timeout=self._timeout_secs)
+
+    async def classify_async(self, text: str) -> float:
+        return await asyncio.wait_for(asyncio.wrap_future(self.submit(text)), timeout=self._timeout_secs)
+
+    def close(self) -> None:
+        with self._lock:
+            self._closed = True
+            connection = self._socket
+        if connection is not None:
+            self._disconnect(connection, RuntimeError('Inference client is closed'))
+
+    def _connect(self) -> socket.socket:
+        if self._socket is None:
+            connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                connection.settimeout(self._timeout_secs)
+                connection.connect(self._socket_path)
+                connection.settimeout(None)
+            except OSError:
+                connection.close()
+                raise
+            self._socket = connection
+            threading.Thread(target=self._read, args=(connection,), name='inference-client', daemon=True).start()
+        return self._socket
+
+    def _read(self, connection: socket.socket) -> None:
+        error: Exception = ConnectionError('Inference server closed the connection')
+        try:
+            with connection.makefile('rb') as responses:
+                for line in responses:
+                    response = json.loads(line)
+                    with self._lock:
+                        future = self._pending.pop(response['id'], None)
+                    # Gone if the connection was reset meanwhile.
+                    if future is None or not future.set_running_or_notify_cancel():
+                        continue
+                    if 'error' in response:
+                        future.set_exception(InferenceError(response['error']))
+                    else:
+                        future.set_result(response['stars'])
+        except (OSError, ValueError, KeyError) as e:
+            error = e
+        self._disconnect(connection, error)
+
+    def _disconnect(self, connection: socket.socket, error: Exception) -> None:
+        """
+        Close `connection`, failing the requests still waiting on it. The next submit() reconnects.
+        """
+        with self._lock:
+            if self._socket is not connection:
+                return
+            self._socket = None
+            pending, self._pending = self._pending, {}
+        try:
+            connection.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        connection.close()
+        for future in pending.values():
+            if future.set_running_or_notify_cancel():
+                future.set_exception(error)
+
+
+InferenceEngine = Union[BatchingInferenceEngine, InferenceClient]
+
+_engine: Optional[InferenceEngine] = None
+_engine_lock = threading.Lock()
+
+
+def get_inference_engine() -> InferenceEngine:
+    """
+    The inference server's client if INFERENCE_SOCKET is set, otherwise an in-process engine.
+    """
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            if INFERENCE_SOCKET:
+                _engine = InferenceClient(INFERENCE_SOCKET)
+            else:
+                _engine = BatchingInferenceEngine(classify_batch)
+        return _engine
+
+
+def warm_up() -> None:
+    """
+    Load the model and run a dummy inference through the engine, so the first real review
+    doesn't pay for loading weights or for the first (slowest) forward pass. With an inference
+    server, this checks that it is reachable instead.
+    """
+    get_inference_engine().classify(WARM_UP_TEXT)
+
+
+def warm_up_in_background() -> threading.Thread:
+    thread = threading.Thread(target=warm_up, name='inference-warm-up', daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,92 @@
+import asyncio
+import json
+import os
+
+from typing import Any, Dict, Set
+
+import bot.log as log
+
+from bot.inference import InferenceEngine, encode_message
+from bot.settings import INFERENCE_SERVER_MAX_PENDING
+
+
+OVERLOADED = 'overloaded'
+# Longest request line accepted; Messenger texts are far shorter.
+MAX_REQUEST_BYTES = 1 << 20
+
+
+class InferenceServer:
+    """
+    Serves weighted star scores from a single model to every web worker and script on the host,
+    over a Unix socket speaking newline-delimited JSON (see bot.inference.InferenceClient):
+
+        request:  {"id": 1, "text": "Great car"}
+        response: {"id": 1, "stars": 4.6} or {"id": 1, "error": "..."}
+
+    Requests from all connections go through one engine, so they share batched forward passes.
+    Responses are written as texts finish, not in request order. At most `max_pending` texts are
+    queued or being scored at once; further requests get an "overloaded" error straight away rather
+    than waiting behind the backlog.
+    """
+
+    def __init__(self, engine: InferenceEngine, max_pending: int = INFERENCE_SERVER_MAX_PENDING):
+        self._engine = engine
+        self._max_pending = max_pending
+        self.pending = 0
+
+    async def serve(self, socket_path: str) -> None:
+        # A socket file left behind by a previous run would make binding fail.
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        server = await asyncio.start_unix_server(self.handle_connection, path=socket_path, limit=MAX_REQUEST_BYTES)
+        log.event('inference_server.started', socket_path=socket_path, max_pending=self._max_pending)
+        async with server:
+            await server.serve_forever()
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        write_lock = asyncio.Lock()
+        in_flight: Set[asyncio.Task] = set()
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    request = json.loads(line)
+                    request_id, text = request['id'], request['text']
+                except (ValueError, KeyError, TypeError):
+                    log.warning('inference_server.bad_request', request=line[:200])
+                    break
+                if self.pending >= self._max_pending:
+                    await _respond(writer, write_lock, {'id': request_id, 'error': OVERLOADED})
+                    continue
+                self.pending += 1
+                task = asyncio.create_task(self._classify(request_id, text, writer, write_lock))
+                in_flight.add(task)
+                task.add_done_callback(in_flight.discard)
+        except (ConnectionError, ValueError) as e:
+            # ValueError: a request line longer than MAX_REQUEST_BYTES.
+            log.warning('inference_server.connection_failed', error=str(e))
+        finally:
+            await asyncio.gather(*in_flight, return_exceptions=True)
+            writer.close()
+
+    async def _classify(self, request_id: Any, text: str, writer: asyncio.StreamWriter, write_lock: asyncio.Lock) -> None:
+        try:
+            response: Dict[str, Any] = {'id': request_id, 'stars': await self._engine.classify_async(text)}
+        except Exception as e:
+            log.error('inference_server.classify_failed')
+            response = {'id': request_id, 'error': str(e) or type(e).__name__}
+        finally:
+            self.pending -= 1
+        try:
+            await _respond(writer, write_lock, response)
+        except ConnectionError:
+            pass
+
+
+async def _respond(writer: asyncio.StreamWriter, write_lock: asyncio.Lock, response: Dict[str, Any]) -> None:
+    writer.write(encode_message(response))
+    # Concurrent drain() calls on one writer aren't supported.
+    async with write_lock:
+        await writer.drain()
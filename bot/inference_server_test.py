@@ -0,0 +1,82 @@
+import asyncio
+import os
+import threading
+import time
+
+import pytest
+
+from bot.inference import BatchingInferenceEngine, InferenceClient, InferenceError
+from bot.inference_server import InferenceServer
+from bot.inference_test import FakeClassifier
+
+
+@pytest.fixture
+def serve(tmp_path):
+    """
+    Start an InferenceServer on its own event loop thread, returning its socket path.
+    """
+    running = []
+
+    def start(engine: BatchingInferenceEngine, max_pending: int = 16) -> str:
+        socket_path = str(tmp_path / 'inference.sock')
+        loop = asyncio.new_event_loop()
+        thread = threading.Thread(target=loop.run_forever, daemon=True)
+        thread.start()
+        server = InferenceServer(engine, max_pending)
+        serving = asyncio.run_coroutine_threadsafe(start_task(server.serve(socket_path)), loop).result()
+        deadline = time.monotonic() + 5
+        while not os.path.exists(socket_path) and time.monotonic() < deadline:
+            time.sleep(0.01)
+        running.append((loop, thread, serving, engine))
+        return socket_path
+
+    yield start
+    for loop, thread, serving, engine in running:
+        asyncio.run_coroutine_threadsafe(stop_task(serving), loop).result(timeout=5)
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join(timeout=5)
+        engine.close()
+
+
+async def start_task(coroutine) -> asyncio.Task:
+    return asyncio.create_task(coroutine)
+
+
+async def stop_task(task: asyncio.Task) -> None:
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+
+
+def test_client__batches_texts_from_every_client(serve):
+    classifier = FakeClassifier()
+    socket_path = serve(BatchingInferenceEngine(classifier, max_batch_size=4, max_wait_secs=1.0))
+    clients = [InferenceClient(socket_path), InferenceClient(socket_path)]
+    try:
+        futures = [clients[n % 2].submit('x' * n) for n in range(1, 5)]
+        classifier.release.set()
+        assert [f.result(timeout=5) for f in futures] == [1.0, 2.0, 3.0, 4.0]
+        assert len(classifier.batches) == 1
+        assert asyncio.run(clients[0].classify_async('xxxxx')) == 5.0
+    finally:
+        for client in clients:
+            client.close()
+
+
+def test_client__overloaded_server_rejects_requests(serve):
+    classifier = FakeClassifier()
+    socket_path = serve(BatchingInferenceEngine(classifier, max_batch_size=1, max_wait_secs=0.0), max_pending=1)
+    client = InferenceClient(socket_path)
+    try:
+        first = client.submit('x')
+        with pytest.raises(InferenceError, match='overloaded'):
+            client.classify('xx')
+        classifier.release.set()
+        assert first.result(timeout=5) == 1.0
+    finally:
+        client.close()
+
+
+def test_client__unreachable_server(tmp_path):
+    client = InferenceClient(str(tmp_path / 'missing.sock'))
+    with pytest.raises(OSError):
+        client.submit('x')
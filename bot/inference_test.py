@@ -0,0 +1,65 @@
+import threading
+
+import pytest
+
+from bot.inference import BatchingInferenceEngine, weighted_stars
+from typing import List
+
+
+def label_scores(stars: int):
+    return [{'label': '%s stars' % stars, 'score': 1.0}]
+
+
+class FakeClassifier:
+
+    def __init__(self):
+        self.batches: List[List[str]] = []
+        self.release = threading.Event()
+
+    def __call__(self, texts):
+        self.release.wait(timeout=5)
+        self.batches.append(list(texts))
+        return [label_scores(len(text)) for text in texts]
+
+
+def test_weighted_stars():
+    assert weighted_stars([
+        {'label': '5 stars', 'score': 0.5},
+        {'label': '4 stars', 'score': 0.25},
+        {'label': '1 star', 'score': 0.25},
+    ]) == 3.75
+
+
+def test_engine__batches_concurrent_texts():
+    classifier = FakeClassifier()
+    engine = BatchingInferenceEngine(classifier, max_batch_size=4, max_wait_secs=1.0)
+    try:
+        futures = [engine.submit('x' * n) for n in range(1, 5)]
+        classifier.release.set()
+        assert [f.result(timeout=5) for f in futures] == [1.0, 2.0, 3.0, 4.0]
+        assert classifier.batches == [['x', 'xx', 'xxx', 'xxxx']]
+    finally:
+        engine.close()
+
+
+def test_engine__flushes_partial_batch_after_max_wait():
+    classifier = FakeClassifier()
+    classifier.release.set()
+    engine = BatchingInferenceEngine(classifier, max_batch_size=64, max_wait_secs=0.01)
+    try:
+        assert engine.classify('xx') == 2.0
+        assert classifier.batches == [['xx']]
+    finally:
+        engine.close()
+
+
+def test_engine__propagates_classifier_errors():
+    def failing_classifier(texts):
+        raise RuntimeError('boom')
+
+    engine = BatchingInferenceEngine(failing_classifier, max_batch_size=2, max_wait_secs=0.0)
+    try:
+        with pytest.raises(RuntimeError):
+            engine.classify('text')
+    finally:
+        engine.close()
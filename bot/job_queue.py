@@ -0,0 +1,248 @@
+import asyncio
+
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable, List, Optional, Set
+
+from peewee import SQL, fn
+
+import bot.db_service as db
+import bot.log as log
+
+from bot.conversation_state import get_conversation_state_store
+from bot.messaging_service import IncomingMessage
+from bot.models import WebhookJob
+from bot.settings import (
+    CONVERSATION_STATE_ENABLED,
+    WEBHOOK_QUEUE_BATCH_SIZE,
+    WEBHOOK_QUEUE_CONSUMERS,
+    WEBHOOK_QUEUE_MAX_ATTEMPTS,
+    WEBHOOK_QUEUE_POLL_INTERVAL_SECS,
+    WEBHOOK_QUEUE_RETRY_DELAY_SECS,
+    WEBHOOK_QUEUE_VISIBILITY_TIMEOUT_SECS,
+)
+
+
+MessageHandler = Callable[[IncomingMessage], Awaitable[None]]
+BatchHandler = Callable[[List[IncomingMessage]], Awaitable[None]]
+
+
+def to_incoming_message(job: WebhookJob) -> IncomingMessage:
+    return IncomingMessage(
+        sender_id=job.sender_id,
+        recipient_id=job.recipient_id,
+        timestamp=job.sent_at,
+        message_id=job.message_id,
+        text=job.text
+    )
+
+
+def enqueue_messages(messages: List[IncomingMessage]) -> None:
+    """
+    Persist a batch of incoming messages as jobs with a single INSERT.
+    Call notify_consumers() from the event loop once the jobs are committed.
+    """
+    if not messages:
+        return
+    enqueued_at = datetime.now()
+    WebhookJob.insert_many([
+        {
+            'sender_id': message.sender_id,
+            'recipient_id': message.recipient_id,
+            'message_id': message.message_id,
+            'text': message.text,
+            'sent_at': message.timestamp,
+            'enqueued_at': enqueued_at,
+        }
+        for message in messages
+    ]).execute()
+
+
+def claim_jobs(
+    limit: int = WEBHOOK_QUEUE_BATCH_SIZE,
+    visibility_timeout_secs: float = WEBHOOK_QUEUE_VISIBILITY_TIMEOUT_SECS,
+) -> List[WebhookJob]:
+    """
+    Claim up to `limit` runnable jobs in one round-trip, hiding them from other consumers until the
+    visibility timeout passes. Only the oldest pending job of each sender is runnable, which keeps a
+    sender's messages in order even with several consumers. Rows locked by another consumer's
+    claim are skipped rather than waited on.
+    """
+    now = datetime.now()
+    earlier = WebhookJob.alias()
+    runnable = (WebhookJob
+        .select(WebhookJob.id)
+        .where(
+            WebhookJob.failed_at.is_null()
+            & (WebhookJob.locked_until.is_null() | (WebhookJob.locked_until < now))
+            & ~fn.EXISTS(earlier
+                .select(SQL('1'))
+                .where(
+                    (earlier.sender_id == WebhookJob.sender_id)
+                    & (earlier.id < WebhookJob.id)
+                    & earlier.failed_at.is_null())))
+        .order_by(WebhookJob.id)
+        .limit(limit)
+        .for_update('FOR UPDATE SKIP LOCKED'))
+    claimed = (WebhookJob
+        .update(
+            attempts=WebhookJob.attempts + 1,
+            locked_until=now + timedelta(seconds=visibility_timeout_secs))
+        .where(WebhookJob.id.in_(runnable))
+        .returning(WebhookJob)
+        .execute())
+    return sorted(claimed, key=lambda job: job.id)
+
+
+def complete_job(job: WebhookJob) -> None:
+    WebhookJob.delete().where(WebhookJob.id == job.id).execute()
+
+
+def complete_jobs(jobs: List[WebhookJob]) -> None:
+    WebhookJob.delete().where(WebhookJob.id.in_([job.id for job in jobs])).execute()
+
+
+def retry_or_fail_job(
+    job: WebhookJob,
+    error: BaseException,
+    max_attempts: int = WEBHOOK_QUEUE_MAX_ATTEMPTS,
+    retry_delay_secs: float = WEBHOOK_QUEUE_RETRY_DELAY_SECS,
+) -> None:
+    """
+    Make a failed job visible again after a delay that grows with its attempt count,
+    or mark it as failed once it has used up its attempts.
+    """
+    now = datetime.now()
+    if job.attempts >= max_attempts:
+        update = {WebhookJob.failed_at: now, WebhookJob.locked_until: None}
+    else:
+        update = {WebhookJob.locked_until: now + timedelta(seconds=retry_delay_secs * job.attempts)}
+    update[WebhookJob.last_error] = repr(error)
+    WebhookJob.update(update).where(WebhookJob.id == job.id).execute()
+
+
+class JobQueueConsumer:
+    """
+    Drains the webhook job queue, handling each claimed batch concurrently, or as a whole with
+    `batch_handler` if one is given. Every job in a batch belongs to a different sender (see
+    claim_jobs), so ordering is preserved.
+    """
+
+    def __init__(
+        self,
+        handler: MessageHandler,
+        batch_size: int = WEBHOOK_QUEUE_BATCH_SIZE,
+        poll_interval_secs: float = WEBHOOK_QUEUE_POLL_INTERVAL_SECS,
+        max_attempts: int = WEBHOOK_QUEUE_MAX_ATTEMPTS,
+        batch_handler: Optional[BatchHandler] = None,
+    ):
+        self._handler = handler
+        self._batch_handler = batch_handler
+        self._batch_size = batch_size
+        self._poll_interval_secs = poll_interval_secs
+        self._max_attempts = max_attempts
+        self._wakeup = asyncio.Event()
+
+    def wake_up(self) -> None:
+        self._wakeup.set()
+
+    async def run(self) -> None:
+        while True:
+            try:
+                processed = await self.run_once()
+            except Exception:
+                log.error('job_queue.claim_failed')
+                processed = 0
+            if processed == 0:
+                await self._wait_for_jobs()
+
+    async def run_once(self) -> int:
+        jobs = await db.run(claim_jobs, self._batch_size)
+        if self._batch_handler is not None:
+            await self._process_batch(jobs)
+        else:
+            await asyncio.gather(*[self._process(job) for job in jobs])
+        return len(jobs)
+
+    async def _process(self, job: WebhookJob) -> None:
+        if await self._expire(job):
+            return
+        try:
+            await self._handler(to_incoming_message(job))
+            await self._complete([job])
+        except Exception as e:
+            log.error('job_queue.job_failed', job_id=job.id, message_id=job.message_id, attempts=job.attempts)
+            await db.run(retry_or_fail_job, job, e, max_attempts=self._max_attempts)
+
+    async def _process_batch(self, jobs: List[WebhookJob]) -> None:
+        jobs = [job for job in jobs if not await self._expire(job)]
+        if not jobs:
+            return
+        try:
+            await self._batch_handler([to_incoming_message(job) for job in jobs])
+            await self._complete(jobs)
+        except Exception as e:
+            log.error('job_queue.batch_failed', job_ids=[job.id for job in jobs])
+            await db.run(_retry_or_fail_jobs, jobs, e, self._max_attempts)
+
+    async def _complete(self, jobs: List[WebhookJob]) -> None:
+        if CONVERSATION_STATE_ENABLED:
+            # In the transaction that writes the jobs' transitions behind, so a job is only deleted
+            # once its transition is committed, and handled again if the process dies before then.
+            await get_conversation_state_store().flush(also=lambda written: complete_jobs(jobs))
+        else:
+            await db.run(complete_jobs, jobs)
+
+    async def _expire(self, job: WebhookJob) -> bool:
+        if job.attempts <= self._max_attempts:
+            return False
+        # Claimed again after its visibility timeout expired on the last allowed attempt,
+        # e.g. because the worker crashed while handling it.
+        await db.run(retry_or_fail_job, job, TimeoutError('Visibility timeout expired'), max_attempts=self._max_attempts)
+        return True
+
+    async def _wait_for_jobs(self) -> None:
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout=self._poll_interval_secs)
+        except asyncio.TimeoutError:
+            pass
+        self._wakeup.clear()
+
+
+def _retry_or_fail_jobs(jobs: List[WebhookJob], error: BaseException, max_attempts: int) -> None:
+    for job in jobs:
+        retry_or_fail_job(job, error, max_attempts=max_attempts)
+
+
+_consumers: Set[JobQueueConsumer] = set()
+_consumer_tasks: List[asyncio.Task] = []
+
+
+def notify_consumers() -> None:
+    """
+    Wake up this process's idle consumers instead of letting them wait for their next poll.
+    Consumers in other processes pick the jobs up on their next poll.
+    """
+    for consumer in _consumers:
+        consumer.wake_up()
+
+
+def start_consumers(
+    handler: MessageHandler,
+    count: int = WEBHOOK_QUEUE_CONSUMERS,
+    batch_handler: Optional[BatchHandler] = None,
+) -> None:
+    """
+    Start `count` consumers on the running event loop.
+    """
+    for i in range(count):
+        consumer = JobQueueConsumer(handler, batch_handler=batch_handler)
+        _consumers.add(consumer)
+        _consumer_tasks.append(asyncio.create_task(consumer.run(), name='webhook-job-consumer-%s' % i))
+
+
+async def stop_consumers() -> None:
+    for task in _consumer_tasks:
+        task.cancel()
+    await asyncio.gather(*_consumer_tasks, return_exceptions=True)
+    _consumer_tasks.clear()
+    _consumers.clear()
@@ -0,0 +1,126 @@
+import asyncio
+import pytest
+
+import bot.db_service as db
+import bot.job_queue as job_queue
+
+from datetime import datetime, timedelta
+from bot.messaging_service import IncomingMessage
+from bot.models import WebhookJob
+from typing import List
+from unittest import mock
+
+
+@pytest.fixture(scope='function', autouse=True)
+def clear_database():
+    try:
+        yield
+    finally:
+        WebhookJob.delete().execute()
+
+
+def test_claim_jobs__one_job_per_sender_in_order():
+    job_queue.enqueue_messages([
+        incoming(1, 'first from 1'),
+        incoming(2, 'first from 2'),
+        incoming(1, 'second from 1'),
+    ])
+
+    claimed = job_queue.claim_jobs(limit=10)
+    assert [job.text for job in claimed] == ['first from 1', 'first from 2']
+    assert all(job.attempts == 1 for job in claimed)
+
+    # Claimed jobs are hidden, and sender 1's second message waits for its first.
+    assert job_queue.claim_jobs(limit=10) == []
+
+    job_queue.complete_job(claimed[0])
+    [next_job] = job_queue.claim_jobs(limit=10)
+    assert next_job.text == 'second from 1'
+
+
+def test_claim_jobs__reclaims_after_visibility_timeout():
+    job_queue.enqueue_messages([incoming(1, 'hello')])
+    [job] = job_queue.claim_jobs(limit=10)
+
+    WebhookJob.update(locked_until=datetime.now() - timedelta(seconds=1)).where(WebhookJob.id == job.id).execute()
+
+    [reclaimed] = job_queue.claim_jobs(limit=10)
+    assert reclaimed.id == job.id
+    assert reclaimed.attempts == 2
+
+
+def test_retry_or_fail_job__marks_failed_after_max_attempts():
+    job_queue.enqueue_messages([incoming(1, 'hello'), incoming(1, 'world')])
+    [job] = job_queue.claim_jobs(limit=10)
+
+    job_queue.retry_or_fail_job(job, RuntimeError('boom'), max_attempts=1)
+
+    [failed] = list(WebhookJob.select().where(WebhookJob.failed_at.is_null(False)))
+    assert failed.id == job.id
+    assert 'boom' in failed.last_error
+
+    # A dead job no longer blocks the rest of its sender's messages.
+    [next_job] = job_queue.claim_jobs(limit=10)
+    assert next_job.text == 'world'
+
+
+def test_consumer__handles_and_deletes_jobs():
+    handled: List[IncomingMessage] = []
+
+    async def handler(message: IncomingMessage):
+        handled.append(message)
+
+    job_queue.enqueue_messages([incoming(1, 'hello'), incoming(2, 'hi')])
+    processed = asyncio.run(job_queue.JobQueueConsumer(handler).run_once())
+
+    assert processed == 2
+    assert sorted(message.text for message in handled) == ['hello', 'hi']
+    assert len(WebhookJob.select()) == 0
+
+
+def test_consumer__completes_jobs_with_the_conversation_state_flush():
+    flushes: List[int] = []
+
+    class Store:
+        async def flush(self, also=None):
+            # The jobs are still there until the flush commits their transitions.
+            flushes.append(len(WebhookJob.select()))
+            await db.run(also, set())
+
+    async def batch_handler(messages: List[IncomingMessage]):
+        pass
+
+    job_queue.enqueue_messages([incoming(1, 'hello'), incoming(2, 'hi')])
+    with (mock.patch('bot.job_queue.CONVERSATION_STATE_ENABLED', True),
+        mock.patch('bot.job_queue.get_conversation_state_store', return_value=Store())):
+        asyncio.run(job_queue.JobQueueConsumer(None, batch_handler=batch_handler).run_once())
+
+    assert flushes == [2]
+    assert len(WebhookJob.select()) == 0
+
+
+def test_consumer__retries_jobs_whose_conversation_state_flush_failed():
+    class Store:
+        async def flush(self, also=None):
+            raise ConnectionError('database is down')
+
+    async def handler(message: IncomingMessage):
+        pass
+
+    job_queue.enqueue_messages([incoming(1, 'hello')])
+    with (mock.patch('bot.job_queue.CONVERSATION_STATE_ENABLED', True),
+        mock.patch('bot.job_queue.get_conversation_state_store', return_value=Store())):
+        asyncio.run(job_queue.JobQueueConsumer(handler).run_once())
+
+    [job] = list(WebhookJob.select())
+    assert 'database is down' in job.last_error
+
+
+def incoming(sender_id: int, text: str) -> IncomingMessage:
+    return IncomingMessage(
+        sender_id=sender_id,
+        recipient_id=0,
+        timestamp=datetime(2022, 10, 20, 11, 22, 33),
+        message_id='<messageid-%s-%s>' % (sender_id, text),
+        text=text
+    )
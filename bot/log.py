@@ -0,0 +1,218 @@
+import asyncio
+import atexit
+import contextlib
+import contextvars
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import sys
+import threading
+import time
+
+from typing import Any, Coroutine, Dict, FrozenSet, Iterator, Optional
+
+import bot.metrics as metrics
+
+from bot.settings import (
+    LOG_DEFAULT_SAMPLE_RATE,
+    LOG_LEVEL,
+    LOG_MAX_FIELD_LENGTH,
+    LOG_QUEUE_SIZE,
+    LOG_REDACT_FIELDS,
+    LOG_SAMPLE_RATES,
+)
+
+
+LOGGER_NAME = 'bot'
+REDACTED = '[REDACTED]'
+
+_correlation_id: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar('correlation_id', default=None)
+
+
+def parse_sample_rates(spec: str) -> Dict[str, float]:
+    """
+    Parse "event=rate,event=rate" into a mapping, e.g. "webhook.received=0.01,message.sent=0.1".
+    """
+    rates = {}
+    for item in spec.split(','):
+        if item.strip():
+            event, rate = item.split('=', 1)
+            rates[event.strip()] = float(rate)
+    return rates
+
+
+class EventSampler:
+    """
+    Keeps a random fraction of each event type's records. Warnings and errors are never dropped.
+    """
+
+    def __init__(self, rates: Dict[str, float], default_rate: float = 1.0):
+        self._rates = rates
+        self._default_rate = default_rate
+
+    def keep(self, event: str, level: int) -> bool:
+        if level >= logging.WARNING:
+            return True
+        rate = self._rates.get(event, self._default_rate)
+        return rate >= 1.0 or random.random() < rate
+
+
+def sanitize(value: Any, max_length: int, redact: FrozenSet[str]) -> Any:
+    """
+    Copy of `value` with the values of `redact` keys replaced and long strings truncated, at any depth.
+    """
+    if isinstance(value, dict):
+        return {
+            key: REDACTED if key in redact else sanitize(item, max_length, redact)
+            for key, item in value.items()
+        }
+    if isinstance(value, (list, tuple)):
+        return [sanitize(item, max_length, redact) for item in value]
+    if isinstance(value, str) and len(value) > max_length:
+        return '%s...(%s chars)' % (value[:max_length], len(value))
+    return value
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    One JSON object per line, with the event name, correlation id and sanitized fields of bot.log.event() records.
+    """
+
+    def __init__(self, max_length: int = LOG_MAX_FIELD_LENGTH, redact: Optional[FrozenSet[str]] = None):
+        super().__init__()
+        self._max_length = max_length
+        self._redact = redact if redact is not None else frozenset(
+            field.strip() for field in LOG_REDACT_FIELDS.split(',') if field.strip())
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(record.created)) + '.%03dZ' % record.msecs,
+            'level': record.levelname,
+            'event': getattr(record, 'event', record.getMessage()),
+        }
+        correlation_id = getattr(record, 'correlation_id', None)
+        if correlation_id is not None:
+            entry['correlation_id'] = correlation_id
+        entry.update(sanitize(getattr(record, 'fields', {}), self._max_length, self._redact))
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """
+    Hands records to the writer thread without formatting them, and drops them rather than wait if
+    the writer has fallen behind, so logging never blocks the event loop.
+
+    Records are formatted later on the writer thread, so callers must not mutate the fields they log.
+    """
+
+    def __init__(self, records: queue.Queue):
+        super().__init__(records)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+_listener: Optional[logging.handlers.QueueListener] = None
+_handler: Optional[NonBlockingQueueHandler] = None
+_sampler = EventSampler(parse_sample_rates(LOG_SAMPLE_RATES), LOG_DEFAULT_SAMPLE_RATE)
+_configure_lock = threading.Lock()
+
+
+def configure_logging(stream=None) -> None:
+    """
+    Route the "bot" logger through a bounded queue to a background thread writing JSON lines to
+    `stream` (stdout by default). Safe to call more than once.
+    """
+    global _listener, _handler
+    with _configure_lock:
+        if _listener is not None:
+            return
+        writer = logging.StreamHandler(stream if stream is not None else sys.stdout)
+        writer.setFormatter(JsonFormatter())
+        _handler = NonBlockingQueueHandler(queue.Queue(maxsize=LOG_QUEUE_SIZE))
+        _listener = logging.handlers.QueueListener(_handler.queue, writer)
+        logger = logging.getLogger(LOGGER_NAME)
+        logger.setLevel(LOG_LEVEL)
+        logger.addHandler(_handler)
+        logger.propagate = False
+        _listener.start()
+    # Scripts don't call shutdown_logging(); flush their queued records on exit.
+    atexit.register(shutdown_logging)
+
+
+def shutdown_logging() -> None:
+    """
+    Write out every queued record and stop the writer thread.
+    """
+    global _listener, _handler
+    with _configure_lock:
+        if _listener is None:
+            return
+        _listener.stop()
+        logging.getLogger(LOGGER_NAME).removeHandler(_handler)
+        _listener = None
+        _handler = None
+
+
+def event(name: str, level: int = logging.INFO, exc_info: bool = False, **fields: Any) -> None:
+    """
+    Log a structured event, subject to the sampling rate configured for `name`.
+    """
+    if _listener is None:
+        configure_logging()
+    logger = logging.getLogger(LOGGER_NAME)
+    if not logger.isEnabledFor(level) or not _sampler.keep(name, level):
+        return
+    extra = {'event': name, 'fields': fields, 'correlation_id': _correlation_id.get()}
+    logger.log(level, name, exc_info=exc_info, extra=extra)
+
+
+def warning(name: str, **fields: Any) -> None:
+    event(name, logging.WARNING, **fields)
+
+
+def error(name: str, exc_info: bool = True, **fields: Any) -> None:
+    event(name, logging.ERROR, exc_info=exc_info, **fields)
+
+
+@contextlib.contextmanager
+def correlation(correlation_id: Optional[str]) -> Iterator[None]:
+    """
+    Tag every event logged in this context (including tasks it starts) with `correlation_id`.
+    """
+    token = _correlation_id.set(correlation_id)
+    try:
+        yield
+    finally:
+        _correlation_id.reset(token)
+
+
+def current_correlation_id() -> Optional[str]:
+    return _correlation_id.get()
+
+
+def start_uncorrelated_task(coroutine: Coroutine, name: Optional[str] = None) -> asyncio.Task:
+    """
+    Start a task in an empty context, so the events it logs aren't tagged with the caller's
+    correlation id. For long-lived tasks doing work on behalf of many messages.
+    """
+    return contextvars.Context().run(asyncio.create_task, coroutine, name=name)
+
+
+def dropped_records() -> int:
+    return _handler.dropped if _handler is not None else 0
+
+
+metrics.REGISTRY.register(metrics.Gauge(
+    'bot_log_records_dropped', 'Log records dropped because the writer thread fell behind.', function=dropped_records))
@@ -0,0 +1,67 @@
+import asyncio
+import io
+import json
+import logging
+
+import bot.log as log
+
+
+def test_sanitize__redacts_and_truncates_nested_fields():
+    value = {'access_token': 'secret', 'entry': [{'message': {'text': 'x' * 20}}], 'count': 3}
+
+    assert log.sanitize(value, max_length=5, redact=frozenset({'access_token'})) == {
+        'access_token': log.REDACTED,
+        'entry': [{'message': {'text': 'xxxxx...(20 chars)'}}],
+        'count': 3,
+    }
+
+
+def test_event_sampler__applies_rates_but_keeps_warnings():
+    sampler = log.EventSampler({'noisy': 0.0, 'quiet': 1.0}, default_rate=1.0)
+
+    assert not sampler.keep('noisy', logging.INFO)
+    assert sampler.keep('noisy', logging.WARNING)
+    assert sampler.keep('quiet', logging.INFO)
+    assert sampler.keep('other', logging.INFO)
+
+
+def test_parse_sample_rates():
+    assert log.parse_sample_rates('a=0.5, b=1') == {'a': 0.5, 'b': 1.0}
+    assert log.parse_sample_rates('') == {}
+
+
+def test_event__writes_json_lines_with_correlation_id():
+    stream = io.StringIO()
+    log.shutdown_logging()
+    log.configure_logging(stream)
+    try:
+        async def handle():
+            with log.correlation('mid.1'):
+                log.event('test.event', person_id=1, first_name='Jane')
+            log.warning('test.uncorrelated')
+
+        asyncio.run(handle())
+    finally:
+        log.shutdown_logging()
+
+    lines = [json.loads(line) for line in stream.getvalue().splitlines()]
+    assert lines[0]['event'] == 'test.event'
+    assert lines[0]['level'] == 'INFO'
+    assert lines[0]['correlation_id'] == 'mid.1'
+    assert lines[0]['person_id'] == 1
+    assert lines[0]['first_name'] == log.REDACTED
+    assert lines[1]['event'] == 'test.uncorrelated'
+    assert 'correlation_id' not in lines[1]
+
+
+def test_start_uncorrelated_task__drops_the_callers_correlation_id():
+    async def current():
+        return log.current_correlation_id()
+
+    async def run():
+        with log.correlation('mid.1'):
+            inherited = await asyncio.create_task(current())
+            uncorrelated = await log.start_uncorrelated_task(current())
+        return inherited, uncorrelated
+
+    assert asyncio.run(run()) == ('mid.1', None)
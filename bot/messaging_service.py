@@ -1,24 +1,32 @@
-import requests
+import asyncio
 
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from datetime import datetime
-from transformers import AutoTokenizer, AutoModelForSequenceClassification, pipeline
+from typing import Any, Dict, Iterable, List, Optional, Tuple, Union
 
-from bot.constants import ACCESS_TOKEN
+import bot.db_service as db
+import bot.log as log
+import bot.metrics as metrics
+import bot.ratings as ratings
+
+from bot.catalog import Product, get_product_catalog
+from bot.conversation_state import ConversationState, get_conversation_state_store
+from bot.fast_sentiment import get_tiered_classifier
 from bot.models import Conversation, Person, Review
+from bot.outbound import OutboundDeliveryError, get_outbound_sender
+from bot.profiles import get_profile_enricher
+from bot.settings import CONVERSATION_STATE_ENABLED
 
 
-MESSAGES_URL = 'https://graph.facebook.com/v15.0/me/messages'
-PROFILE_URL_TEMPLATE = 'https://graph.facebook.com/{}'
+CONVERSATION_STATE_FIELDS = (
+    Conversation.review_requested_at,
+    Conversation.product_selected_at,
+    Conversation.review_recieved_at,
+    Conversation.declined_review_at,
+)
 DECLINE_MESSAGE = 'NO'
 SOLICIT_REVIEW_REPLY_TEMPLATE = 'Please take a moment to let us know how we did, or reply NO if you\'d rather not.'
 SOLICIT_REVIEW_PROACTIVE_TEMPLATE = 'Hey {}!  Please take a moment to let us know what you thought of your experience with us, or reply NO if you\'d rather not.'
-PRODUCT_CHOOSE_TEMPLATE = 'Which product would you like to provide a review for? Please respond with the number of your chosen product: {}'
-
-
-tokenizer = AutoTokenizer.from_pretrained("nlptown/bert-base-multilingual-uncased-sentiment")
-model = AutoModelForSequenceClassification.from_pretrained("nlptown/bert-base-multilingual-uncased-sentiment")
-sentiment_classifier = pipeline('sentiment-analysis', model=model, tokenizer=tokenizer)
 
 
 @dataclass(frozen=True)
@@ -54,181 +62,375 @@ class OutgoingMessage:
         }
 
 
-@dataclass(frozen=True)
-class ProfileInfo:
-    person_id: int
-    first_name: str
-    last_name: str
-
-    @classmethod
-    def from_json(cls, obj, person_id: int):
-        return ProfileInfo(
-            person_id=person_id, 
-            first_name=obj['first_name'], 
-            last_name=obj['last_name']
-        )
-        
-
-@dataclass(frozen=True)
-class Product:
-    id: int
-    product_name: str
-    manufacturer: str
-    vehicle: str
-
-    @classmethod
-    def from_json(cls, obj):
-        return Product(
-            id=int(obj['id']), 
-            product_name=obj['productName'], 
-            manufacturer=obj['manufacturer'],
-            vehicle=obj['vehicle']
-        )
-        
-
-def get_products():
-    response = requests.get(url='https://62daf70dd1d97b9e0c49ca5d.mockapi.io/v1/products')
-    products = {}
-    for obj in response.json():
-        product = Product.from_json(obj)
-        products[product.id] = product
-    return products
+@metrics.timed('get_products')
+def get_products() -> Dict[int, Product]:
+    return get_product_catalog().get_products()
 
 
 def format_product_selection_message() -> str:
-    products = get_products()
-    product_strings = []
-    for id in products:
-        product = products[id]
-        product_strings.append('(%s: %s %s)' % (product.id, product.manufacturer, product.vehicle))
-    product_string = ', '.join(product_strings)
-    message = PRODUCT_CHOOSE_TEMPLATE.format(product_string)
-    return message
-    
-
-def handle_incoming_message(message: IncomingMessage):
-    print('Recieved incoming message')
-    create_or_update_conversation(message)
-
-
-def handle_outgoing_message(message: OutgoingMessage):
-    payload = message.to_api_payload()
-    headers = {'content-type': 'application/json'}
-    params = {'access_token': ACCESS_TOKEN}
-    response = requests.post(url=MESSAGES_URL, params=params, headers=headers, json=payload, timeout=3)
-    print(response.text)
-    
-
-def get_profile_info(person_id: int) -> ProfileInfo:
-    params = {
-        'fields': 'first_name,last_name', 
-        'access_token': ACCESS_TOKEN
-    }
-    url = PROFILE_URL_TEMPLATE.format(person_id)
-    response = requests.get(url=url, params=params, timeout=3)
-    info = ProfileInfo.from_json(response.json(), person_id)
-    print(info)
-    return info
-
-
-def get_or_create_person(person_id: int) -> Person:
-    person = Person.get_or_none(Person.id == person_id)
-    if person is not None:
-        return person
-    info = get_profile_info(person_id)
-    return Person.create(
-        id=person_id, 
-        first_name=info.first_name, 
-        last_name=info.last_name,
-        created_at=datetime.now()
-    )
+    return get_product_catalog().get_selection_message()
+
+
+async def handle_incoming_message(message: IncomingMessage):
+    # Everything logged while handling the message, including the reply, carries its message id.
+    with log.correlation(message.message_id):
+        log.event('message.received', sender_id=message.sender_id, text=message.text)
+        await create_or_update_conversation(message)
+
+
+@metrics.timed('handle_outgoing_message')
+async def handle_outgoing_message(message: OutgoingMessage):
+    """
+    Send a message through the outbound sender, which rate limits, batches and retries it.
+    Raises OutboundDeliveryError if it couldn't be delivered.
+    """
+    result = await get_outbound_sender().send(message.to_api_payload())
+    if not result.delivered:
+        raise OutboundDeliveryError('Message to %s not delivered after %s attempts: %s' % (
+            message.recipient_id, result.attempts, result.error))
     
 
-def create_or_update_conversation(message: IncomingMessage):
-    person = get_or_create_person(message.sender_id)
-    convo = Conversation.get_or_none(Conversation.person == person)
-    if convo is None:
-        convo = Conversation.create(person=person, started_at=datetime.now())
+def insert_missing_persons(person_ids: List[int]) -> None:
+    """
+    Create persons for any of `person_ids` that don't exist yet, without names: those are only needed
+    for proactive solicitations, so they are filled in by the profile enricher rather than fetched
+    before the first reply.
+    """
+    now = datetime.now()
+    Person.insert_many([
+        {'id': person_id, 'created_at': now} for person_id in dict.fromkeys(person_ids)
+    ]).on_conflict_ignore().execute()
+
+
+def enrich_new_persons(convos: Iterable[Conversation]) -> None:
+    get_profile_enricher().enqueue(convo.person_id for convo in convos if convo.person.first_name is None)
+
+
+def find_conversation(person_id: int) -> Optional[Conversation]:
+    """
+    Load a person's conversation together with the person in a single query.
+    """
+    return (Conversation
+        .select(Conversation, Person)
+        .join(Person)
+        .where(Conversation.person == person_id)
+        .first())
+
+
+async def get_or_create_conversation(person_id: int) -> Conversation:
+    """
+    Known senders cost a single query. New senders go through insert_missing_conversations(), so
+    concurrent first messages can't create duplicate conversations.
+    """
+    convo = await db.run(find_conversation, person_id)
+    if convo is not None:
+        return convo
+    convo = await db.run(_insert_conversation, person_id)
+    enrich_new_persons([convo])
+    return convo
+
+
+def _insert_conversation(person_id: int) -> Conversation:
+    insert_missing_persons([person_id])
+    insert_missing_conversations([person_id])
+    return find_conversation(person_id)
+
+
+def insert_missing_conversations(person_ids: List[int]) -> None:
+    """
+    Start a conversation for each of `person_ids` (who must exist) that has none.
+
+    The persons' rows are locked while checking, since conversations is partitioned and no unique
+    index can stop two transactions from both inserting a conversation for the same person.
+    """
+    with db.atomic():
+        list(Person.select(Person.id).where(Person.id.in_(person_ids)).order_by(Person.id).for_update())
+        existing = {
+            convo.person_id
+            for convo in Conversation.select(Conversation.person).where(Conversation.person.in_(person_ids))
+        }
+        now = datetime.now()
+        rows = [{'person': person_id, 'started_at': now} for person_id in dict.fromkeys(person_ids) if person_id not in existing]
+        if rows:
+            Conversation.insert_many(rows).execute()
+
+
+def find_conversations(person_ids: List[int]) -> Dict[int, Conversation]:
+    """
+    Load the conversations of several persons, together with the persons, in a single query.
+    """
+    convos = (Conversation
+        .select(Conversation, Person)
+        .join(Person)
+        .where(Conversation.person.in_(person_ids)))
+    return {convo.person_id: convo for convo in convos}
+
+
+async def get_or_create_conversations(person_ids: List[int]) -> Dict[int, Conversation]:
+    """
+    Bulk get_or_create_conversation(): one query when every sender is known. Persons and
+    conversations of new senders are bulk inserted.
+    """
+    convos = await db.run(find_conversations, person_ids)
+    missing = [person_id for person_id in person_ids if person_id not in convos]
+    if not missing:
+        return convos
+    created = await db.run(_insert_persons_and_conversations, missing)
+    enrich_new_persons(created.values())
+    convos.update(created)
+    return convos
+
+
+def _insert_persons_and_conversations(person_ids: List[int]) -> Dict[int, Conversation]:
+    insert_missing_persons(person_ids)
+    insert_missing_conversations(person_ids)
+    return find_conversations(person_ids)
+
+
+def transition_conversation(convo: Conversation, **changes) -> bool:
+    """
+    Persist a state transition with a single UPDATE ... RETURNING of only the changed columns.
+
+    The update only applies if the conversation is still in the state `convo` was read in, so a
+    transition decided on stale state can't overwrite a concurrent one. Returns False in that case.
+    """
+    # started_at lets Postgres skip every other partition.
+    guard = (Conversation.id == convo.id) & (Conversation.started_at == convo.started_at)
+    for column in CONVERSATION_STATE_FIELDS:
+        value = getattr(convo, column.name)
+        guard &= column.is_null() if value is None else column == value
+    updated = Conversation.update(**changes).where(guard).returning(Conversation.id).execute()
+    if not list(updated):
+        log.warning('conversation.transition_dropped', conversation_id=convo.id, changes=changes)
+        return False
+    for name, value in changes.items():
+        setattr(convo, name, value)
+    return True
+
+
+@dataclass
+class ConversationStep:
+    """
+    What an incoming message does to its conversation: the reply to send, the state transition
+    to apply, and the review text to score and record, if any.
+    """
+    convo: Union[Conversation, ConversationState]
+    message: IncomingMessage
+    reply: str
+    changes: Dict[str, Any] = field(default_factory=dict)
+    review_text: Optional[str] = None
+
+
+def plan_step(convo: Union[Conversation, ConversationState], message: IncomingMessage) -> ConversationStep:
+    step = ConversationStep(convo=convo, message=message, reply='Now get lost')
     if convo.review_requested_at is None:
         if 'thank' in message.text.lower():
-            solicit_review_in_conversation(convo)
+            step.reply = format_product_selection_message()
+            step.changes = {'review_requested_at': datetime.now()}
         else:
-            reply = OutgoingMessage(recipient_id=message.sender_id, text='...')
-            handle_outgoing_message(reply)
+            step.reply = '...'
     elif convo.product_selected_at is None:
-        handle_product_selection(message.text, convo)
+        product = parse_product_selection(message.text)
+        if product is not None:
+            step.reply = 'And what did you think of the %s?' % product.vehicle
+            step.changes = {'product_selected_at': datetime.now(), 'selected_product_id': product.id}
+        else:
+            step.reply = 'Please respond with the number of the product you would like to review'
     elif convo.review_recieved_at is None and convo.declined_review_at is None:
         if message.text.strip().lower() == 'no':
-            convo.declined_review_at = datetime.now()
-            convo.save()
-            reply = OutgoingMessage(recipient_id=message.sender_id, text='Aw :(')
-            handle_outgoing_message(reply)
+            step.reply = 'Aw :('
+            step.changes = {'declined_review_at': datetime.now()}
         else:
-            process_review(message.text, convo)
-    else:
-        reply = OutgoingMessage(recipient_id=message.sender_id, text='Now get lost')
-        handle_outgoing_message(reply)
-        
+            step.reply = 'Thanks for the feedback!'
+            step.changes = {'review_recieved_at': datetime.now()}
+            step.review_text = message.text
+    return step
 
-def handle_product_selection(msg: str, convo: Conversation):
-    try:
-        id = int(msg)
-        product = get_products()[id]
-        reply = OutgoingMessage(recipient_id=convo.person.id, text='And what did you think of the %s?' % product.vehicle)
-        handle_outgoing_message(reply)
-        convo.product_selected_at = datetime.now()
-        convo.selected_product_id = id
-        convo.save()
 
+def parse_product_selection(text: str) -> Optional[Product]:
+    try:
+        return get_products().get(int(text))
     except ValueError:
-        reply = OutgoingMessage(recipient_id=convo.person.id, text='Please respond with the number of the product you would like to review')
-        handle_outgoing_message(reply)
-    
+        return None
 
-def solicit_review_in_conversation(convo: Conversation):
-    outgoing = OutgoingMessage(recipient_id=convo.person.id, text=format_product_selection_message())
-    handle_outgoing_message(outgoing)
-    convo.review_requested_at = datetime.now()
-    convo.save()
-
-
-def solicit_review_proactively(person_id: int):
-    person = get_or_create_person(person_id)
-    convo = Conversation.get_or_none(Conversation.person == person)
-    if convo is None:
-        convo = Conversation.create(person=person, started_at=datetime.now())
-    solicitation_message = SOLICIT_REVIEW_PROACTIVE_TEMPLATE.format(person.first_name)
-    outgoing = OutgoingMessage(recipient_id=convo.person.id, text=solicitation_message, is_response=False)
-    handle_outgoing_message(outgoing)
-    convo.review_requested_at = datetime.now()
-    convo.review_recieved_at = None
-    convo.declined_review_at = None
-    convo.save()
-
-
-def process_review(raw_review_message: str, convo: Conversation):
-    estimated_review_stars = extract_sentiment(raw_review_message)
-    Review.create(
-        conversation=convo, 
-        person=convo.person, 
-        product_id=convo.selected_product_id,
-        created_at=datetime.now(), 
-        estimated_review_stars=estimated_review_stars,
-        raw_message=raw_review_message
-    )
-    
-    convo.review_recieved_at = datetime.now()
-    convo.save()
-    reply = OutgoingMessage(recipient_id=convo.person.id, text='Thanks for the feedback!')
-    handle_outgoing_message(reply)
+
+def needs_product_catalog(convo: Union[Conversation, ConversationState], message: IncomingMessage) -> bool:
+    """
+    Whether plan_step() will read the product catalog for `message`: a 'thank' that gets the
+    product selection message, or a reply to it.
+    """
+    if convo.review_requested_at is None:
+        return 'thank' in message.text.lower()
+    return convo.product_selected_at is None
+
+
+async def load_product_catalog(pairs: Iterable[Tuple[Union[Conversation, ConversationState], IncomingMessage]]) -> None:
+    """
+    Make sure the product catalog is loaded if any of the (conversation, message) pairs needs it,
+    so plan_step() never loads it on the event loop. Steps that don't use the catalog, like the
+    '...' reply to a new sender, don't depend on the products API. Raises CatalogUnavailableError.
+    """
+    if any(needs_product_catalog(convo, message) for convo, message in pairs):
+        await get_product_catalog().load()
+
+
+async def create_or_update_conversation(message: IncomingMessage):
+    if CONVERSATION_STATE_ENABLED:
+        convo = (await load_conversation_states([message.sender_id]))[message.sender_id]
+    else:
+        convo = await get_or_create_conversation(message.sender_id)
+    await load_product_catalog([(convo, message)])
+    await apply_steps([plan_step(convo, message)])
+
+
+async def load_conversation_states(person_ids: List[int]) -> Dict[int, ConversationState]:
+    """
+    The in-memory state of each sender's conversation. Conversations the state store doesn't hold
+    are loaded or created with get_or_create_conversations().
+    """
+    store = get_conversation_state_store()
+    states = {}
+    for person_id in person_ids:
+        state = store.get(person_id)
+        if state is not None:
+            states[person_id] = state
+    missing = [person_id for person_id in person_ids if person_id not in states]
+    if missing:
+        for person_id, convo in (await get_or_create_conversations(missing)).items():
+            states[person_id] = store.put(convo)
+    return states
+
+
+async def handle_incoming_messages(messages: List[IncomingMessage]) -> None:
+    """
+    Handle a whole delivery together rather than message by message.
+
+    Messages are handled in rounds holding at most one message per sender, so each sender's
+    messages still apply in order. Each round loads or creates every conversation involved with
+    bulk queries, then goes through apply_steps().
+    """
+    for round in sender_rounds(messages):
+        for message in round:
+            with log.correlation(message.message_id):
+                log.event('message.received', sender_id=message.sender_id, text=message.text)
+        sender_ids = [message.sender_id for message in round]
+        if CONVERSATION_STATE_ENABLED:
+            convos = await load_conversation_states(sender_ids)
+        else:
+            convos = await get_or_create_conversations(sender_ids)
+        await load_product_catalog([(convos[message.sender_id], message) for message in round])
+        await apply_steps([plan_step(convos[message.sender_id], message) for message in round])
+
+
+def sender_rounds(messages: List[IncomingMessage]) -> List[List[IncomingMessage]]:
+    """
+    Split messages into rounds where round k holds the k-th message of each sender, in delivery order.
+    """
+    rounds: List[List[IncomingMessage]] = []
+    seen: Dict[int, int] = {}
+    for message in messages:
+        index = seen.get(message.sender_id, 0)
+        seen[message.sender_id] = index + 1
+        if index == len(rounds):
+            rounds.append([])
+        rounds[index].append(message)
+    return rounds
+
+
+async def apply_steps(steps: List[ConversationStep]) -> None:
+    """
+    Score every review in `steps` concurrently, so the inference engine batches them into one
+    forward pass. Then apply every transition and bulk insert the reviews in one transaction, and
+    finally send the replies concurrently.
+
+    With the conversation state store enabled, transitions only change the in-memory states, and
+    are written behind; steps with reviews still wait for their transaction.
+    """
+    review_steps = [step for step in steps if step.review_text is not None]
+    scores = await asyncio.gather(*[extract_sentiment(step.review_text) for step in review_steps])
+    stars_by_step = {id(step): stars for step, stars in zip(review_steps, scores)}
+    if CONVERSATION_STATE_ENABLED:
+        await _update_states(steps, stars_by_step)
+    else:
+        await db.run(_persist_steps, steps, stars_by_step)
+    await asyncio.gather(*[_send_reply(step) for step in steps])
+
+
+def _persist_steps(steps: List[ConversationStep], stars_by_step: Dict[int, float]) -> None:
+    with db.atomic():
+        applied = [step for step in steps if step.changes and transition_conversation(step.convo, **step.changes)]
+        _insert_reviews(applied, stars_by_step)
+
+
+async def _update_states(steps: List[ConversationStep], stars_by_step: Dict[int, float]) -> None:
+    store = get_conversation_state_store()
+    for step in steps:
+        if step.changes:
+            store.update(step.convo, **step.changes)
+    review_steps = [step for step in steps if step.review_text is not None]
+    if review_steps:
+        # Committed with every pending transition, including the reviews' own.
+        await store.flush(also=lambda written: _insert_reviews(
+            [step for step in review_steps if step.convo.id in written], stars_by_step))
+
+
+def _insert_reviews(steps: List[ConversationStep], stars_by_step: Dict[int, float]) -> None:
+    created_at = datetime.now()
+    reviews = [
+        {
+            'conversation_id': step.convo.id,
+            'person': step.convo.person_id,
+            'product_id': step.convo.selected_product_id,
+            'created_at': created_at,
+            'estimated_review_stars': stars_by_step[id(step)],
+            'raw_message': step.review_text,
+        }
+        for step in steps if step.review_text is not None
+    ]
+    if reviews:
+        Review.insert_many(reviews).execute()
+        for review in reviews:
+            ratings.record_review(review['product_id'], review['estimated_review_stars'], created_at)
+
+
+async def _send_reply(step: ConversationStep) -> None:
+    with log.correlation(step.message.message_id):
+        try:
+            await handle_outgoing_message(OutgoingMessage(recipient_id=step.message.sender_id, text=step.reply))
+        except OutboundDeliveryError:
+            # Already logged and recorded by the sender. The transition is committed, so handling
+            # the message again wouldn't send the same reply.
+            pass
+
+
+async def solicit_review_proactively(person_id: int):
+    convo = await get_or_create_conversation(person_id)
+    first_name = convo.person.first_name
+    if first_name is None:
+        # The profile enricher hasn't filled the name in yet, so fetch it now.
+        first_name = (await get_profile_enricher().get(person_id)).first_name
+    solicitation_message = SOLICIT_REVIEW_PROACTIVE_TEMPLATE.format(first_name)
+    outgoing = OutgoingMessage(recipient_id=convo.person_id, text=solicitation_message, is_response=False)
+    await handle_outgoing_message(outgoing)
+    await db.run(_restart_review, convo)
+    if CONVERSATION_STATE_ENABLED:
+        # A held state predates the restart. Its pending transitions conflict with it and are dropped.
+        await get_conversation_state_store().evict(person_id)
+
+
+def _restart_review(convo: Conversation) -> None:
+    # Proactive solicitation restarts the review regardless of the conversation's current state.
+    # It also counts as the follow-up of the restarted stage: Messenger's 24 hour window runs from the
+    # person's last message, not from this one, so only their reply makes the conversation due again.
+    now = datetime.now()
+    (Conversation
+        .update(review_requested_at=now, review_recieved_at=None, declined_review_at=None, followed_up_at=now)
+        .where((Conversation.id == convo.id) & (Conversation.started_at == convo.started_at))
+        .execute())
 
     
-def extract_sentiment(text: str) -> float:
-    review_classification = sentiment_classifier(text, top_k=5)
-    weighted_average_stars = 0.0
-    for label_score in review_classification:
-        stars = int(label_score['label'][0])
-        score = label_score['score']
-        weighted_average_stars += stars * score
-    return weighted_average_stars
-    
+@metrics.timed('extract_sentiment')
+async def extract_sentiment(text: str) -> float:
+    # Texts the lexicon is confident about skip the model. Of the rest, repeated texts skip
+    # inference entirely, and the others share batched forward passes through the model.
+    return await get_tiered_classifier().classify(text)
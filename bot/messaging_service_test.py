@@ -1,10 +1,15 @@
+import asyncio
 from datetime import datetime
 import pytest
 
 import bot.messaging_service as messaging
 
-from bot.models import Conversation, Person, Review
-from typing import List
+from bot.catalog import ProductCatalog, format_product_selection_message
+from bot.constants import ACCESS_TOKEN
+from bot.conversation_state import close_conversation_state_store
+from bot.models import Conversation, OutboundMessage, Person, ProductRating, ProductRatingDay, Review
+from bot.outbound import MESSAGES_URL
+from typing import Dict
 from unittest import mock
 
 @pytest.fixture(scope='function', autouse=True)
@@ -12,20 +17,22 @@ def clear_database():
     try:
         yield
     finally:
+        ProductRatingDay.delete().execute()
+        ProductRating.delete().execute()
         Review.delete().execute()
         Conversation.delete().execute()
         Person.delete().execute()
+        OutboundMessage.delete().execute()
 
 
 def test_handle_outgoing_message():
-    mock_response = mock.MagicMock
-    mock_response.text = 'sample response'
+    mock_response = mock.MagicMock(status_code=200, text='{"recipient_id": "1", "message_id": "m1"}')
     outgoing = messaging.OutgoingMessage(1, 'message', True)
-    with mock.patch('bot.messaging_service.requests.post', return_value=mock_response) as mock_post:
-        messaging.handle_outgoing_message(outgoing)
+    with mock.patch('bot.graph_api.GraphApiClient.post', return_value=mock_response) as mock_post:
+        asyncio.run(messaging.handle_outgoing_message(outgoing))
         mock_post.assert_called_once_with(
-            url=messaging.MESSAGES_URL,
-            params={'access_token': messaging.ACCESS_TOKEN},
+            url=MESSAGES_URL,
+            params={'access_token': ACCESS_TOKEN},
             headers={'content-type': 'application/json'},
             json={
                 'recipient': {'id': 1},
@@ -40,32 +47,24 @@ def test_handle_incoming_message__e2e_review_provided():
     assert len(Conversation.select()) == 0
     assert len(Review.select()) == 0
 
-    profile_response = mock.MagicMock
-    profile_response.json = lambda: {
-        'first_name': 'Fake',
-        'last_name': 'Person'
-    }
+    products = {1: messaging.Product(id=1, product_name='Name', manufacturer='Maker', vehicle='Car')}
 
     with (mock.patch('bot.messaging_service.handle_outgoing_message') as mock_outgoing, 
-        mock.patch('bot.messaging_service.requests.get', return_value=profile_response) as mock_get):
+        mock.patch('bot.profiles.ProfileEnricher.enqueue') as mock_enqueue,
+        stub_catalog(products)):
 
         # First message
-        messaging.handle_incoming_message(incoming('Hi!')) 
+        asyncio.run(messaging.handle_incoming_message(incoming('Hi!'))) 
 
         mock_outgoing.assert_called_once_with(messaging.OutgoingMessage(1, '...'))
-        mock_get.assert_called_once_with(
-            url='https://graph.facebook.com/1',
-            params={
-                'fields': 'first_name,last_name',
-                'access_token': messaging.ACCESS_TOKEN
-            }
-        )
+        # The name is fetched in the background, after the reply.
+        assert list(mock_enqueue.call_args.args[0]) == [1]
         mock_outgoing.reset_mock()
-        mock_get.reset_mock()
+        mock_enqueue.reset_mock()
 
         [persisted_person] = list(Person.select())
-        assert persisted_person.first_name == 'Fake'
-        assert persisted_person.last_name == 'Person'
+        assert persisted_person.first_name is None
+        assert persisted_person.last_name is None
         
         [persisted_conversation] = list(Conversation.select())
         assert persisted_conversation.person == persisted_person
@@ -77,27 +76,39 @@ def test_handle_incoming_message__e2e_review_provided():
         assert len(Review.select()) == 0
 
         # Second message (review trigger)
-        messaging.handle_incoming_message(incoming('Thank you!')) 
+        asyncio.run(messaging.handle_incoming_message(incoming('Thank you!'))) 
 
-        mock_outgoing.assert_called_once_with(messaging.OutgoingMessage(1, messaging.SOLICIT_REVIEW_REPLY_TEMPLATE))
-        mock_get.assert_not_called()
+        mock_outgoing.assert_called_once_with(messaging.OutgoingMessage(1, format_product_selection_message(products)))
+        mock_enqueue.assert_not_called()
         mock_outgoing.reset_mock()
-        mock_get.reset_mock()
+        mock_enqueue.reset_mock()
         
         [persisted_conversation] = list(Conversation.select())
         assert persisted_conversation.person == persisted_person
         assert persisted_conversation.started_at is not None
         assert persisted_conversation.review_requested_at is not None
+        assert persisted_conversation.product_selected_at is None
         assert persisted_conversation.review_recieved_at is None
         assert persisted_conversation.declined_review_at is None
 
         assert len(Review.select()) == 0
 
-        # Third message (review itself)
-        messaging.handle_incoming_message(incoming('Incredible, just incredible')) 
+        # Third message (product selection)
+        asyncio.run(messaging.handle_incoming_message(incoming('1'))) 
+
+        mock_outgoing.assert_called_once_with(messaging.OutgoingMessage(1, 'And what did you think of the Car?'))
+        mock_enqueue.assert_not_called()
+        mock_outgoing.reset_mock()
+
+        [persisted_conversation] = list(Conversation.select())
+        assert persisted_conversation.product_selected_at is not None
+        assert persisted_conversation.selected_product_id == 1
+
+        # Fourth message (review itself)
+        asyncio.run(messaging.handle_incoming_message(incoming('Incredible, just incredible'))) 
 
         mock_outgoing.assert_called_once_with(messaging.OutgoingMessage(1, 'Thanks for the feedback!'))
-        mock_get.assert_not_called()
+        mock_enqueue.assert_not_called()
         
         [persisted_conversation] = list(Conversation.select())
         assert persisted_conversation.person == persisted_person
@@ -117,32 +128,24 @@ def test_handle_incoming_message__e2e_review_declined():
     assert len(Conversation.select()) == 0
     assert len(Review.select()) == 0
 
-    profile_response = mock.MagicMock
-    profile_response.json = lambda: {
-        'first_name': 'Fake',
-        'last_name': 'Person'
-    }
+    products = {1: messaging.Product(id=1, product_name='Name', manufacturer='Maker', vehicle='Car')}
 
     with (mock.patch('bot.messaging_service.handle_outgoing_message') as mock_outgoing, 
-        mock.patch('bot.messaging_service.requests.get', return_value=profile_response) as mock_get):
+        mock.patch('bot.profiles.ProfileEnricher.enqueue') as mock_enqueue,
+        stub_catalog(products)):
 
         # First message
-        messaging.handle_incoming_message(incoming('Hi!')) 
+        asyncio.run(messaging.handle_incoming_message(incoming('Hi!'))) 
 
         mock_outgoing.assert_called_once_with(messaging.OutgoingMessage(1, '...'))
-        mock_get.assert_called_once_with(
-            url='https://graph.facebook.com/1',
-            params={
-                'fields': 'first_name,last_name',
-                'access_token': messaging.ACCESS_TOKEN
-            }
-        )
+        # The name is fetched in the background, after the reply.
+        assert list(mock_enqueue.call_args.args[0]) == [1]
         mock_outgoing.reset_mock()
-        mock_get.reset_mock()
+        mock_enqueue.reset_mock()
 
         [persisted_person] = list(Person.select())
-        assert persisted_person.first_name == 'Fake'
-        assert persisted_person.last_name == 'Person'
+        assert persisted_person.first_name is None
+        assert persisted_person.last_name is None
         
         [persisted_conversation] = list(Conversation.select())
         assert persisted_conversation.person == persisted_person
@@ -154,27 +157,39 @@ def test_handle_incoming_message__e2e_review_declined():
         assert len(Review.select()) == 0
 
         # Second message (review trigger)
-        messaging.handle_incoming_message(incoming('Thank you!')) 
+        asyncio.run(messaging.handle_incoming_message(incoming('Thank you!'))) 
 
-        mock_outgoing.assert_called_once_with(messaging.OutgoingMessage(1, messaging.SOLICIT_REVIEW_REPLY_TEMPLATE))
-        mock_get.assert_not_called()
+        mock_outgoing.assert_called_once_with(messaging.OutgoingMessage(1, format_product_selection_message(products)))
+        mock_enqueue.assert_not_called()
         mock_outgoing.reset_mock()
-        mock_get.reset_mock()
+        mock_enqueue.reset_mock()
         
         [persisted_conversation] = list(Conversation.select())
         assert persisted_conversation.person == persisted_person
         assert persisted_conversation.started_at is not None
         assert persisted_conversation.review_requested_at is not None
+        assert persisted_conversation.product_selected_at is None
         assert persisted_conversation.review_recieved_at is None
         assert persisted_conversation.declined_review_at is None
 
         assert len(Review.select()) == 0
 
-        # Third message (review decline)
-        messaging.handle_incoming_message(incoming('No')) 
+        # Third message (product selection)
+        asyncio.run(messaging.handle_incoming_message(incoming('1'))) 
+
+        mock_outgoing.assert_called_once_with(messaging.OutgoingMessage(1, 'And what did you think of the Car?'))
+        mock_enqueue.assert_not_called()
+        mock_outgoing.reset_mock()
+
+        [persisted_conversation] = list(Conversation.select())
+        assert persisted_conversation.product_selected_at is not None
+        assert persisted_conversation.selected_product_id == 1
+
+        # Fourth message (review decline)
+        asyncio.run(messaging.handle_incoming_message(incoming('No'))) 
 
         mock_outgoing.assert_called_once_with(messaging.OutgoingMessage(1, 'Aw :('))
-        mock_get.assert_not_called()
+        mock_enqueue.assert_not_called()
         
         [persisted_conversation] = list(Conversation.select())
         assert persisted_conversation.person == persisted_person
@@ -186,9 +201,119 @@ def test_handle_incoming_message__e2e_review_declined():
         assert len(Review.select()) == 0
 
 
-def incoming(message: str) -> messaging.IncomingMessage:
+def test_handle_incoming_message__greets_new_senders_while_the_products_api_is_down():
+    def fetch():
+        raise ConnectionError('products API is down')
+
+    with (mock.patch('bot.messaging_service.handle_outgoing_message') as mock_outgoing,
+        mock.patch('bot.messaging_service.get_product_catalog', return_value=ProductCatalog(fetch=fetch)),
+        mock.patch('bot.profiles.ProfileEnricher.enqueue')):
+
+        asyncio.run(messaging.handle_incoming_message(incoming('Hi!')))
+
+    mock_outgoing.assert_called_once_with(messaging.OutgoingMessage(1, '...'))
+
+
+def test_sender_rounds__keeps_each_senders_order():
+    messages = [incoming('a1', 1), incoming('b1', 2), incoming('a2', 1), incoming('a3', 1), incoming('b2', 2)]
+
+    rounds = messaging.sender_rounds(messages)
+
+    assert [[message.text for message in round] for round in rounds] == [['a1', 'b1'], ['a2', 'b2'], ['a3']]
+
+
+def test_handle_incoming_messages__batches_a_delivery():
+    products = {1: messaging.Product(id=1, product_name='Name', manufacturer='Maker', vehicle='Car')}
+    messages = [
+        incoming('Thank you!', 1), incoming('Thank you!', 2),
+        incoming('1', 1), incoming('1', 2),
+        incoming('Great', 1), incoming('No', 2),
+    ]
+
+    with (mock.patch('bot.messaging_service.handle_outgoing_message') as mock_outgoing,
+        mock.patch('bot.messaging_service.extract_sentiment', new=mock.AsyncMock(return_value=4.5)) as mock_sentiment,
+        stub_catalog(products),
+        mock.patch('bot.profiles.ProfileEnricher.enqueue') as mock_enqueue):
+
+        asyncio.run(messaging.handle_incoming_messages(messages))
+
+    assert [sorted(call.args[0]) for call in mock_enqueue.call_args_list] == [[1, 2]]
+    mock_sentiment.assert_awaited_once_with('Great')
+    replies = [call.args[0] for call in mock_outgoing.call_args_list]
+    selection = format_product_selection_message(products)
+    assert [reply.text for reply in replies if reply.recipient_id == 1] == [selection, 'And what did you think of the Car?', 'Thanks for the feedback!']
+    assert [reply.text for reply in replies if reply.recipient_id == 2] == [selection, 'And what did you think of the Car?', 'Aw :(']
+
+    convos = {convo.person_id: convo for convo in Conversation.select()}
+    assert convos[1].review_recieved_at is not None
+    assert convos[2].declined_review_at is not None
+    [review] = list(Review.select())
+    assert review.person_id == 1
+    assert review.product_id == 1
+    assert float(review.estimated_review_stars) == 4.5
+    assert ProductRating.get(ProductRating.product_id == 1).review_count == 1
+
+
+def test_handle_incoming_message__e2e_with_conversation_state_store():
+    products = {1: messaging.Product(id=1, product_name='Name', manufacturer='Maker', vehicle='Car')}
+
+    async def converse():
+        for text in ('Thank you!', '1', 'Great'):
+            await messaging.handle_incoming_message(incoming(text))
+        await close_conversation_state_store()
+
+    with (mock.patch('bot.messaging_service.CONVERSATION_STATE_ENABLED', True),
+        mock.patch('bot.messaging_service.handle_outgoing_message') as mock_outgoing,
+        mock.patch('bot.messaging_service.extract_sentiment', new=mock.AsyncMock(return_value=4.5)),
+        stub_catalog(products),
+        mock.patch('bot.profiles.ProfileEnricher.enqueue')):
+
+        asyncio.run(converse())
+
+    assert [call.args[0].text for call in mock_outgoing.call_args_list] == [
+        format_product_selection_message(products), 'And what did you think of the Car?', 'Thanks for the feedback!']
+    [convo] = list(Conversation.select())
+    assert convo.selected_product_id == 1
+    assert convo.review_recieved_at is not None
+    [review] = list(Review.select())
+    assert review.conversation_id == convo.id
+    assert review.product_id == 1
+
+
+def test_solicit_review_proactively__fetches_a_missing_name():
+    Person.create(id=1, created_at=datetime.now())
+    profile_response = mock.MagicMock(status_code=200, text='{"first_name": "Fake", "last_name": "Person"}')
+
+    with (mock.patch('bot.messaging_service.handle_outgoing_message') as mock_outgoing,
+        mock.patch('bot.graph_api.GraphApiClient.get', return_value=profile_response) as mock_get):
+
+        asyncio.run(messaging.solicit_review_proactively(1))
+
+    mock_get.assert_called_once_with(
+        url='https://graph.facebook.com/1',
+        params={
+            'fields': 'first_name,last_name',
+            'access_token': ACCESS_TOKEN
+        }
+    )
+    mock_outgoing.assert_called_once_with(
+        messaging.OutgoingMessage(1, messaging.SOLICIT_REVIEW_PROACTIVE_TEMPLATE.format('Fake'), is_response=False))
+    person = Person.get(Person.id == 1)
+    assert (person.first_name, person.last_name) == ('Fake', 'Person')
+    [convo] = list(Conversation.select())
+    assert convo.review_requested_at is not None
+
+
+def stub_catalog(products: Dict[int, messaging.Product]):
+    """
+    Serve `products` instead of the products API.
+    """
+    return mock.patch('bot.messaging_service.get_product_catalog', return_value=ProductCatalog(fetch=lambda: products))
+
+
+def incoming(message: str, sender_id: int = 1) -> messaging.IncomingMessage:
     return messaging.IncomingMessage(
-        sender_id=1,
+        sender_id=sender_id,
         recipient_id=0,
         timestamp=datetime(2022, 10, 20, 11, 22, 33),
         message_id='<messageid>',
@@ -0,0 +1,274 @@
+import abc
+import bisect
+import contextlib
+import functools
+import inspect
+import threading
+import time
+
+from typing import Callable, ContextManager, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from bot.settings import METRICS_ENABLED
+
+
+# Seconds. Spans sub-millisecond signature checks up to slow Graph API calls and model inference.
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64)
+
+LabelValues = Tuple[str, ...]
+
+
+class Metric(abc.ABC):
+    """
+    A metric family in the Prometheus text exposition format, with one series per label combination.
+    Updates take a lock, so they are safe from the event loop and from worker threads alike.
+    """
+
+    type = ''
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def render(self) -> Iterator[str]:
+        yield '# HELP %s %s' % (self.name, self.help)
+        yield '# TYPE %s %s' % (self.name, self.type)
+        yield from self._samples()
+
+    @abc.abstractmethod
+    def _samples(self) -> Iterator[str]:
+        ...
+
+    def _key(self, labels: Dict[str, str]) -> LabelValues:
+        if set(labels) != set(self.labelnames):
+            raise ValueError('%s expects labels %s, got %s' % (self.name, self.labelnames, sorted(labels)))
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _format_labels(self, values: LabelValues, extra: Optional[Tuple[str, str]] = None) -> str:
+        pairs = list(zip(self.labelnames, values))
+        if extra is not None:
+            pairs.append(extra)
+        if not pairs:
+            return ''
+        return '{%s}' % ','.join('%s="%s"' % (name, _escape(value)) for name, value in pairs)
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, help, labelnames)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels: str) -> float:
+        return self._values.get(self._key(labels), 0.0)
+
+    def _samples(self) -> Iterator[str]:
+        with self._lock:
+            values = list(self._values.items())
+        for key, value in values:
+            yield '%s%s %s' % (self.name, self._format_labels(key), _format_value(value))
+
+
+class Gauge(Metric):
+    """
+    A value that goes up and down. Either set directly, or read from `function` at scrape time.
+    """
+
+    type = 'gauge'
+
+    def __init__(self, name: str, help: str, function: Optional[Callable[[], float]] = None):
+        super().__init__(name, help)
+        self._value = 0.0
+        self._function = function
+
+    def inc(self, amount: float = 1.0) -> None:
+        with self._lock:
+            self._value += amount
+
+    def dec(self, amount: float = 1.0) -> None:
+        self.inc(-amount)
+
+    def set(self, value: float) -> None:
+        with self._lock:
+            self._value = value
+
+    def value(self) -> float:
+        return self._function() if self._function is not None else self._value
+
+    @contextlib.contextmanager
+    def track(self) -> Iterator[None]:
+        self.inc()
+        try:
+            yield
+        finally:
+            self.dec()
+
+    def _samples(self) -> Iterator[str]:
+        yield '%s %s' % (self.name, _format_value(self.value()))
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self._buckets = tuple(sorted(buckets))
+        # Per series: a count per bucket (plus one for +Inf), and the sum of observed values.
+        self._counts: Dict[LabelValues, List[int]] = {}
+        self._sums: Dict[LabelValues, float] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        index = bisect.bisect_left(self._buckets, value)
+        with self._lock:
+            counts = self._counts.get(key)
+            if counts is None:
+                counts = self._counts[key] = [0] * (len(self._buckets) + 1)
+                self._sums[key] = 0.0
+            counts[index] += 1
+            self._sums[key] += value
+
+    def count(self, **labels: str) -> int:
+        return sum(self._counts.get(self._key(labels), []))
+
+    def _samples(self) -> Iterator[str]:
+        with self._lock:
+            series = [(key, list(counts), self._sums[key]) for key, counts in self._counts.items()]
+        for key, counts, total in series:
+            cumulative = 0
+            for bound, count in zip(self._buckets + (float('inf'),), counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else _format_value(bound)
+                yield '%s_bucket%s %s' % (self.name, self._format_labels(key, ('le', le)), cumulative)
+            yield '%s_sum%s %s' % (self.name, self._format_labels(key), _format_value(total))
+            yield '%s_count%s %s' % (self.name, self._format_labels(key), cumulative)
+
+
+class Registry:
+
+    def __init__(self):
+        self._metrics: List[Metric] = []
+
+    def register(self, metric: Metric) -> Metric:
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+STAGE_DURATION = REGISTRY.register(Histogram(
+    'bot_stage_duration_seconds', 'Time spent in each stage of handling a message.', ['stage']))
+HTTP_REQUEST_DURATION = REGISTRY.register(Histogram(
+    'bot_http_request_duration_seconds', 'Time to handle HTTP requests, by endpoint.', ['endpoint']))
+HTTP_REQUESTS_IN_FLIGHT = REGISTRY.register(Gauge(
+    'bot_http_requests_in_flight', 'HTTP requests currently being handled.'))
+STAGE_ERRORS = REGISTRY.register(Counter(
+    'bot_stage_errors_total', 'Stages that raised an exception.', ['stage']))
+GRAPH_API_REQUESTS = REGISTRY.register(Counter(
+    'bot_graph_api_requests_total', 'Outbound Graph API requests, by method and outcome.', ['method', 'outcome']))
+INFERENCE_BATCH_SIZE = REGISTRY.register(Histogram(
+    'bot_inference_batch_size', 'Texts per classifier forward pass.', buckets=BATCH_SIZE_BUCKETS))
+SENTIMENT_TIER_SCORES = REGISTRY.register(Counter(
+    'bot_sentiment_tier_scores_total', 'Sentiment scores by the tier that produced them, fast (lexicon) or model.', ['tier']))
+SENTIMENT_CACHE_LOOKUPS = REGISTRY.register(Counter(
+    'bot_sentiment_cache_lookups_total', 'Sentiment score lookups, by the cache tier that hit, or miss.', ['result']))
+OUTBOUND_MESSAGES = REGISTRY.register(Counter(
+    'bot_outbound_messages_total', 'Outbound messages by final outcome, delivered or failed.', ['outcome']))
+OUTBOUND_BATCH_SIZE = REGISTRY.register(Histogram(
+    'bot_outbound_batch_size', 'Send API calls per Graph API request.', buckets=BATCH_SIZE_BUCKETS))
+FOLLOWUPS = REGISTRY.register(Counter(
+    'bot_followups_total', 'Follow-ups of stalled conversations, by stage and outcome.', ['stage', 'outcome']))
+CONVERSATION_STATE_LOOKUPS = REGISTRY.register(Counter(
+    'bot_conversation_state_lookups_total', 'In-memory conversation state lookups, by hit or miss.', ['result']))
+CONVERSATION_STATE_FLUSH_SIZE = REGISTRY.register(Histogram(
+    'bot_conversation_state_flush_size', 'Conversations written per write-behind flush.', buckets=BATCH_SIZE_BUCKETS))
+
+
+def register_db_pool_gauges(database) -> None:
+    """
+    Expose the connection pool's usage, read when scraped.
+    """
+    REGISTRY.register(Gauge(
+        'bot_db_pool_connections_in_use', 'Pooled DB connections checked out.',
+        function=lambda: len(database._in_use)))
+    REGISTRY.register(Gauge(
+        'bot_db_pool_connections_idle', 'Open pooled DB connections waiting to be reused.',
+        function=lambda: len(database._connections)))
+    REGISTRY.register(Gauge(
+        'bot_db_pool_max_connections', 'Maximum pooled DB connections.',
+        function=lambda: database._max_connections))
+
+
+def render() -> str:
+    return REGISTRY.render()
+
+
+_NO_TIMING = contextlib.nullcontext()
+
+
+def time_stage(stage: str) -> ContextManager:
+    """
+    Context manager recording the duration of `stage`, and counting it as an error if it raises.
+    """
+    if not METRICS_ENABLED:
+        return _NO_TIMING
+    return _time_stage(stage)
+
+
+@contextlib.contextmanager
+def _time_stage(stage: str) -> Iterator[None]:
+    started = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        STAGE_ERRORS.inc(stage=stage)
+        raise
+    finally:
+        STAGE_DURATION.observe(time.perf_counter() - started, stage=stage)
+
+
+def timed(stage: str) -> Callable:
+    """
+    Decorator recording the duration of every call to a function or coroutine function as `stage`.
+    With metrics disabled the function is returned undecorated.
+    """
+    def decorate(func: Callable) -> Callable:
+        if not METRICS_ENABLED:
+            return func
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def timed_coroutine(*args, **kwargs):
+                with _time_stage(stage):
+                    return await func(*args, **kwargs)
+            return timed_coroutine
+
+        @functools.wraps(func)
+        def timed_function(*args, **kwargs):
+            with _time_stage(stage):
+                return func(*args, **kwargs)
+        return timed_function
+    return decorate
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
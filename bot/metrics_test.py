@@ -0,0 +1,64 @@
+import asyncio
+import pytest
+
+import bot.metrics as metrics
+
+
+def test_counter__renders_one_series_per_label_set():
+    counter = metrics.Counter('test_total', 'Test counter.', ['outcome'])
+    counter.inc(outcome='ok')
+    counter.inc(2, outcome='ok')
+    counter.inc(outcome='error')
+
+    assert list(counter.render()) == [
+        '# HELP test_total Test counter.',
+        '# TYPE test_total counter',
+        'test_total{outcome="ok"} 3',
+        'test_total{outcome="error"} 1',
+    ]
+
+
+def test_counter__rejects_wrong_labels():
+    counter = metrics.Counter('test_total', 'Test counter.', ['outcome'])
+    with pytest.raises(ValueError):
+        counter.inc(method='GET')
+
+
+def test_histogram__renders_cumulative_buckets():
+    histogram = metrics.Histogram('test_seconds', 'Test histogram.', ['stage'], buckets=(0.1, 1.0))
+    for value in (0.05, 0.1, 0.5, 2.0):
+        histogram.observe(value, stage='a')
+
+    assert list(histogram.render())[2:] == [
+        'test_seconds_bucket{stage="a",le="0.1"} 2',
+        'test_seconds_bucket{stage="a",le="1"} 3',
+        'test_seconds_bucket{stage="a",le="+Inf"} 4',
+        'test_seconds_sum{stage="a"} 2.65',
+        'test_seconds_count{stage="a"} 4',
+    ]
+
+
+def test_gauge__reads_function_at_scrape_time():
+    values = [3]
+    gauge = metrics.Gauge('test_gauge', 'Test gauge.', function=lambda: values[0])
+    values[0] = 5
+
+    assert list(gauge.render())[-1] == 'test_gauge 5'
+
+
+def test_timed__records_duration_and_errors():
+    @metrics.timed('test_stage')
+    async def succeed():
+        return 1
+
+    @metrics.timed('test_stage')
+    def fail():
+        raise RuntimeError()
+
+    assert asyncio.run(succeed()) == 1
+    with pytest.raises(RuntimeError):
+        fail()
+
+    assert metrics.STAGE_DURATION.count(stage='test_stage') == 2
+    assert metrics.STAGE_ERRORS.value(stage='test_stage') == 1
+    assert 'bot_stage_duration_seconds_count{stage="test_stage"} 2' in metrics.render()
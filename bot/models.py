@@ -1,14 +1,25 @@
 import bot.db_service as db
+import bot.log as log
+import bot.partitions as partitions
 import uuid
 
 from typing import List
 
 from peewee import (
+    BigAutoField,
     BigIntegerField,
+    BooleanField,
+    CompositeKey,
+    DateField,
     DateTimeField,
+    Entity,
     ForeignKeyField,
+    IntegerField,
     Model,
     DecimalField,
+    DoubleField,
+    NodeList,
+    SQL,
     TextField,
     UUIDField,
 )
@@ -27,40 +38,244 @@ class Person(Model):
 
 
 class Conversation(Model):
+    """
+    Partitioned by month of started_at, see bot.partitions. A unique index can't cover person_id
+    alone, so messaging_service.insert_missing_conversations() keeps it to one conversation per person.
+    """
 
     class Meta:
         database = db.get_db_instance()
         table_name = 'conversations'
+        # Postgres requires the partition key in the primary key.
+        primary_key = CompositeKey('id', 'started_at')
+        table_settings = ['PARTITION BY RANGE (started_at)']
+        partition_key = 'started_at'
 
-    id = UUIDField(primary_key=True, default=uuid.uuid4)
-    person = ForeignKeyField(Person, index=True, unique=False)
+    id = UUIDField(default=uuid.uuid4)
+    person = ForeignKeyField(Person)
     selected_product_id = BigIntegerField(null=True)
     started_at = DateTimeField()
     review_requested_at = DateTimeField(null=True)
     product_selected_at = DateTimeField(null=True)
     review_recieved_at = DateTimeField(null=True)
     declined_review_at = DateTimeField(null=True)
-    
+    # When bot.followups last reminded the person of a stalled conversation, or a proactive
+    # solicitation restarted it.
+    followed_up_at = DateTimeField(null=True)
+
+
+# Conversations waiting on the person for a product selection, or for the review itself, that haven't
+# been followed up since. Partial indexes on these hold only such conversations, so finding the due
+# ones (see bot.followups) costs in proportion to how many are waiting rather than to the table size.
+AWAITING_PRODUCT = (
+    Conversation.review_requested_at.is_null(False)
+    & Conversation.product_selected_at.is_null()
+    & Conversation.review_recieved_at.is_null()
+    & Conversation.declined_review_at.is_null()
+    & (Conversation.followed_up_at.is_null() | (Conversation.followed_up_at < Conversation.review_requested_at)))
+AWAITING_REVIEW = (
+    Conversation.product_selected_at.is_null(False)
+    & Conversation.review_recieved_at.is_null()
+    & Conversation.declined_review_at.is_null()
+    & (Conversation.followed_up_at.is_null() | (Conversation.followed_up_at < Conversation.product_selected_at)))
+Conversation.add_index(Conversation.index(
+    Conversation.review_requested_at, where=AWAITING_PRODUCT, name='conversations_awaiting_product'))
+Conversation.add_index(Conversation.index(
+    Conversation.product_selected_at, where=AWAITING_REVIEW, name='conversations_awaiting_review'))
+
+
 
 class Review(Model):
+    """
+    Partitioned by month of created_at, see bot.partitions.
+    """
 
     class Meta:
         database = db.get_db_instance()
         table_name = 'reviews'
+        primary_key = CompositeKey('id', 'created_at')
+        table_settings = ['PARTITION BY RANGE (created_at)']
+        partition_key = 'created_at'
 
-    id = UUIDField(primary_key=True, default=uuid.uuid4)
-    conversation = ForeignKeyField(Conversation, index=True, unique=False)
+    id = UUIDField(default=uuid.uuid4)
+    # Not a foreign key: a key into conversations would have to include started_at, and the
+    # conversation may have been archived before its reviews.
+    conversation_id = UUIDField(index=True)
     person = ForeignKeyField(Person, index=True, unique=False)
     product_id = BigIntegerField()
-    created_at = DateTimeField()
+    # Indexed for exports filtered and ordered by creation time.
+    created_at = DateTimeField(index=True)
     estimated_review_stars = DecimalField(max_digits=4, decimal_places=3)
     raw_message = TextField()
+
+
+class WebhookJob(Model):
+    """
+    An incoming message acknowledged by the webhook but not yet processed.
+    Rows are deleted once processed; rows with failed_at set have exhausted their retries.
+    """
+
+    class Meta:
+        database = db.get_db_instance()
+        table_name = 'webhook_jobs'
+
+    id = BigAutoField(primary_key=True)
+    sender_id = BigIntegerField()
+    recipient_id = BigIntegerField()
+    message_id = TextField()
+    text = TextField()
+    sent_at = DateTimeField()
+    enqueued_at = DateTimeField()
+    attempts = IntegerField(default=0)
+    locked_until = DateTimeField(null=True)
+    failed_at = DateTimeField(null=True)
+    last_error = TextField(null=True)
+
+
+# Consumers look for the oldest pending job of each sender, so only index the pending ones.
+WebhookJob.add_index(WebhookJob.index(WebhookJob.sender_id, WebhookJob.id, where=WebhookJob.failed_at.is_null()))
+
+
+class ProcessedMessage(Model):
+    """
+    Messenger message ids (mid) that have already been accepted, used to drop redelivered webhooks.
+    """
+
+    class Meta:
+        database = db.get_db_instance()
+        table_name = 'processed_messages'
+
+    message_id = TextField(primary_key=True)
+    received_at = DateTimeField(index=True)
+
+
+class SentimentCacheEntry(Model):
+    """
+    Weighted star score of previously classified review texts, keyed by a hash of the normalized text.
+    """
+
+    class Meta:
+        database = db.get_db_instance()
+        table_name = 'sentiment_cache'
+
+    text_hash = TextField(primary_key=True)
+    estimated_review_stars = DoubleField()
+    created_at = DateTimeField()
+
+
+class ProductRating(Model):
+    """
+    All-time rating aggregates per product, maintained alongside every Review insert.
+    """
+
+    class Meta:
+        database = db.get_db_instance()
+        table_name = 'product_ratings'
+
+    product_id = BigIntegerField(primary_key=True)
+    review_count = BigIntegerField()
+    stars_sum = DoubleField()
+    stars_sum_squares = DoubleField()
+    # Histogram of reviews by estimated stars, rounded to the nearest whole star.
+    stars_1 = BigIntegerField()
+    stars_2 = BigIntegerField()
+    stars_3 = BigIntegerField()
+    stars_4 = BigIntegerField()
+    stars_5 = BigIntegerField()
+    last_review_at = DateTimeField()
+
+
+class ProductRatingDay(Model):
+    """
+    Per-day rating aggregates per product, for rolling-window stats.
+    """
+
+    class Meta:
+        database = db.get_db_instance()
+        table_name = 'product_rating_days'
+        primary_key = CompositeKey('product_id', 'day')
+
+    product_id = BigIntegerField()
+    day = DateField()
+    review_count = BigIntegerField()
+    stars_sum = DoubleField()
+
+
+
+class OutboundMessage(Model):
+    """
+    The outcome of every message sent through bot.outbound, once delivered or given up on.
+    """
+
+    class Meta:
+        database = db.get_db_instance()
+        table_name = 'outbound_messages'
+
+    id = BigAutoField(primary_key=True)
+    recipient_id = BigIntegerField(index=True)
+    messaging_type = TextField()
+    delivered = BooleanField()
+    attempts = IntegerField()
+    # The Messenger message id (mid) of delivered messages.
+    graph_message_id = TextField(null=True)
+    error = TextField(null=True)
+    queued_at = DateTimeField(index=True)
+    completed_at = DateTimeField()
     
     
-MODELS: List[Model] = [Person, Conversation, Review]
+MODELS: List[Model] = [
+    Person,
+    Conversation,
+    Review,
+    WebhookJob,
+    ProcessedMessage,
+    SentimentCacheEntry,
+    ProductRating,
+    ProductRatingDay,
+    OutboundMessage,
+]
+
+PARTITIONED_MODELS: List[Model] = [
+    Conversation,
+    Review,
+]
     
 
 def create_tables():
     for model in MODELS:
         if not model.table_exists():
-            model.create_table(safe=True)
\ No newline at end of file
+            model.create_table(safe=True)
+        else:
+            # Pick up columns and indexes added since the table was created.
+            add_missing_columns(model)
+            model._schema.create_indexes(safe=True)
+    ensure_partitions()
+
+
+def add_missing_columns(model: Model) -> None:
+    """
+    Add the nullable columns of `model` that its table doesn't have yet. On a partitioned table
+    they are added to every partition.
+    """
+    database = model._meta.database
+    existing = {column.name for column in database.get_columns(model._meta.table_name, model._meta.schema)}
+    table = Entity(model._meta.schema, model._meta.table_name) if model._meta.schema else Entity(model._meta.table_name)
+    for field in model._meta.sorted_fields:
+        if field.column_name in existing or not field.null:
+            continue
+        ctx = database.get_sql_context()
+        sql, params = ctx.sql(NodeList((SQL('ALTER TABLE'), table, SQL('ADD COLUMN IF NOT EXISTS'), field.ddl(ctx)))).query()
+        db.execute_sql(sql, params)
+        log.event('model.column_added', table=model._meta.table_name, column=field.column_name)
+
+
+def ensure_partitions():
+    """
+    Create the partitions of every partitioned table for this month and the next few.
+    """
+    for model in PARTITIONED_MODELS:
+        if partitions.is_partitioned(model):
+            partitions.ensure_partitions(model)
+        else:
+            log.warning('partition.table_not_partitioned', table=model._meta.table_name,
+                hint='run scripts/partition_tables.py')
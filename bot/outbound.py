@@ -0,0 +1,336 @@
+import asyncio
+import json
+import random
+import weakref
+
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Any, Coroutine, Dict, List, Optional, Set, Tuple
+from urllib.parse import urlencode
+
+import bot.db_service as db
+import bot.log as log
+import bot.metrics as metrics
+
+from bot.constants import ACCESS_TOKEN
+from bot.graph_api import get_graph_api_client
+from bot.models import OutboundMessage
+from bot.rate_limit import TokenBucket
+from bot.settings import (
+    GRAPH_API_BASE_URL,
+    OUTBOUND_BACKOFF_BASE_SECS,
+    OUTBOUND_BACKOFF_MAX_SECS,
+    OUTBOUND_BATCH_SIZE,
+    OUTBOUND_BATCH_WAIT_MS,
+    OUTBOUND_BURST,
+    OUTBOUND_MAX_ATTEMPTS,
+    OUTBOUND_QUEUE_SIZE,
+    OUTBOUND_RATE_PER_SEC,
+)
+
+
+GRAPH_API_VERSION_URL = GRAPH_API_BASE_URL + '/v15.0'
+MESSAGES_URL = GRAPH_API_VERSION_URL + '/me/messages'
+# Graph API batch requests are posted to the version root.
+BATCH_URL = GRAPH_API_VERSION_URL + '/'
+# The Graph API accepts at most 50 requests per batch.
+MAX_BATCH_SIZE = 50
+# Graph API error codes for application, user and page rate limits, and Messenger's send limit.
+THROTTLING_ERROR_CODES = frozenset({4, 17, 32, 613})
+
+DELIVERED = 'delivered'
+RETRY = 'retry'
+THROTTLED = 'throttled'
+FAILED = 'failed'
+
+# Per sent message: the HTTP status (None if the batch never got to it) and the parsed JSON body.
+SendResponse = Tuple[Optional[int], Any]
+
+
+class OutboundDeliveryError(Exception):
+    """
+    The Send API rejected a message, or kept failing until its retries ran out.
+    """
+
+
+@dataclass(frozen=True)
+class SendResult:
+    delivered: bool
+    attempts: int
+    # The Messenger message id (mid), once delivered.
+    message_id: Optional[str] = None
+    error: Optional[str] = None
+
+
+def classify_response(status: Optional[int], body: Any) -> str:
+    """
+    What to do about one Send API response: DELIVERED; RETRY on server errors, transient errors and
+    requests a batch didn't get to; THROTTLED on rate limits; FAILED otherwise.
+    """
+    error = body.get('error') if isinstance(body, dict) else None
+    if status == 200 and error is None:
+        return DELIVERED
+    if status == 429 or (error is not None and error.get('code') in THROTTLING_ERROR_CODES):
+        return THROTTLED
+    if status is None or status >= 500 or (error is not None and error.get('is_transient')):
+        return RETRY
+    return FAILED
+
+
+def backoff_secs(attempt: int, base_secs: float, max_secs: float) -> float:
+    # Full jitter: retries of messages that failed together spread out instead of failing together again.
+    return random.uniform(0, min(max_secs, base_secs * 2 ** (attempt - 1)))
+
+
+async def post_batch(calls: List[Dict[str, str]], access_token: str = ACCESS_TOKEN) -> List[SendResponse]:
+    """
+    Make up to MAX_BATCH_SIZE Graph API calls in one batch request, returning each call's response.
+    """
+    response = await get_graph_api_client().request(
+        'POST',
+        BATCH_URL,
+        params={'access_token': access_token},
+        data={'batch': json.dumps(calls), 'include_headers': 'false'},
+    )
+    if response.status_code != 200:
+        # The batch as a whole failed, so did each call in it.
+        return [(response.status_code, parse_json(response.text))] * len(calls)
+    # One result per call, in order. Calls the batch didn't get to (it timed out) are null.
+    results = response.json()
+    results += [None] * (len(calls) - len(results))
+    return [(result['code'], parse_json(result.get('body'))) if result is not None else (None, None) for result in results]
+
+
+def batch_request(payload: Dict[str, Any]) -> Dict[str, str]:
+    """
+    One Send API call within a Graph API batch request. Its body is form encoded, with JSON values.
+    """
+    body = {key: value if isinstance(value, str) else json.dumps(value) for key, value in payload.items()}
+    return {'method': 'POST', 'relative_url': 'me/messages', 'body': urlencode(body)}
+
+
+@dataclass
+class _QueuedSend:
+    payload: Dict[str, Any]
+    future: asyncio.Future
+    queued_at: datetime
+    # Of the message being replied to, for the events logged about this one.
+    correlation_id: Optional[str] = None
+    attempts: int = 0
+
+
+class OutboundSender:
+    """
+    Delivers Send API messages for one page (access token) from a queue.
+
+    Messages queued close together are sent in one Graph API batch request of up to `batch_size`
+    calls, paced by a token bucket of `rate_per_sec` calls per second. Calls failing with a server
+    error or a rate limit are retried up to `max_attempts` times, with jittered exponential backoff;
+    a rate limit also holds off the whole page for the backoff. The final outcome of every message
+    is recorded in outbound_messages.
+    """
+
+    def __init__(
+        self,
+        access_token: str = ACCESS_TOKEN,
+        rate_per_sec: float = OUTBOUND_RATE_PER_SEC,
+        burst: float = OUTBOUND_BURST,
+        batch_size: int = OUTBOUND_BATCH_SIZE,
+        batch_wait_secs: float = OUTBOUND_BATCH_WAIT_MS / 1000.0,
+        max_attempts: int = OUTBOUND_MAX_ATTEMPTS,
+        backoff_base_secs: float = OUTBOUND_BACKOFF_BASE_SECS,
+        backoff_max_secs: float = OUTBOUND_BACKOFF_MAX_SECS,
+        queue_size: int = OUTBOUND_QUEUE_SIZE,
+    ):
+        self._access_token = access_token
+        self._bucket = TokenBucket(rate_per_sec, burst)
+        # A batch takes one token per call, so it can't be larger than the bucket.
+        self._batch_size = max(1, min(batch_size, MAX_BATCH_SIZE, int(self._bucket.capacity)))
+        self._batch_wait_secs = batch_wait_secs
+        self._max_attempts = max_attempts
+        self._backoff_base_secs = backoff_base_secs
+        self._backoff_max_secs = backoff_max_secs
+        self._queue: 'asyncio.Queue[_QueuedSend]' = asyncio.Queue(maxsize=queue_size)
+        self._runner: Optional[asyncio.Task] = None
+        self._deliveries: Set[asyncio.Task] = set()
+        self._retries: Set[asyncio.Task] = set()
+
+    async def send(self, payload: Dict[str, Any]) -> SendResult:
+        """
+        Queue a Send API payload and wait for its final outcome.
+        """
+        if self._runner is None:
+            # Batches mix messages of different callers, so their tasks don't inherit this one's context.
+            self._runner = log.start_uncorrelated_task(self._run(), name='outbound-sender')
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put(_QueuedSend(
+            payload=payload, future=future, queued_at=datetime.now(), correlation_id=log.current_correlation_id()))
+        return await future
+
+    async def close(self) -> None:
+        """
+        Stop sending. Requests already sent are waited for; queued and retrying messages fail.
+        """
+        for task in [self._runner, *self._retries]:
+            if task is not None:
+                task.cancel()
+        await asyncio.gather(*[task for task in [self._runner, *self._retries] if task is not None], return_exceptions=True)
+        await asyncio.gather(*self._deliveries, return_exceptions=True)
+        while not self._queue.empty():
+            item = self._queue.get_nowait()
+            _resolve(item, _closed_result(item))
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            try:
+                deadline = loop.time() + self._batch_wait_secs
+                while len(batch) < self._batch_size:
+                    remaining = deadline - loop.time()
+                    try:
+                        if remaining > 0:
+                            batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+                        else:
+                            batch.append(self._queue.get_nowait())
+                    except (asyncio.TimeoutError, asyncio.QueueEmpty):
+                        break
+                await self._bucket.acquire(len(batch))
+            except asyncio.CancelledError:
+                for item in batch:
+                    _resolve(item, _closed_result(item))
+                raise
+            self._spawn(self._deliveries, self._deliver(batch))
+
+    async def _deliver(self, batch: List[_QueuedSend]) -> None:
+        for item in batch:
+            item.attempts += 1
+        metrics.OUTBOUND_BATCH_SIZE.observe(len(batch))
+        try:
+            responses = await (self._post_one(batch[0]) if len(batch) == 1 else self._post_batch(batch))
+        except Exception as e:
+            log.warning('outbound.request_failed', batch_size=len(batch), error=str(e))
+            responses = [(None, None)] * len(batch)
+
+        finished = []
+        hold_secs = None
+        for item, (status, body) in zip(batch, responses):
+            outcome = classify_response(status, body)
+            if outcome == DELIVERED:
+                message_id = body.get('message_id') if isinstance(body, dict) else None
+                finished.append((item, SendResult(delivered=True, attempts=item.attempts, message_id=message_id)))
+            elif outcome == FAILED or item.attempts >= self._max_attempts:
+                finished.append((item, SendResult(delivered=False, attempts=item.attempts, error=_error_message(status, body))))
+            else:
+                delay = backoff_secs(item.attempts, self._backoff_base_secs, self._backoff_max_secs)
+                if outcome == THROTTLED:
+                    hold_secs = max(hold_secs or 0.0, delay)
+                self._spawn(self._retries, self._retry_later(item, delay))
+        if hold_secs is not None:
+            # Back off the whole page, so the next batches don't run into the limit as well.
+            log.warning('outbound.throttled', hold_secs=hold_secs)
+            self._bucket.drain(hold_secs)
+        await self._finish(finished)
+
+    async def _post_one(self, item: _QueuedSend) -> List[SendResponse]:
+        response = await get_graph_api_client().post(
+            url=MESSAGES_URL,
+            params={'access_token': self._access_token},
+            headers={'content-type': 'application/json'},
+            json=item.payload,
+        )
+        return [(response.status_code, parse_json(response.text))]
+
+    async def _post_batch(self, batch: List[_QueuedSend]) -> List[SendResponse]:
+        return await post_batch([batch_request(item.payload) for item in batch], self._access_token)
+
+    async def _retry_later(self, item: _QueuedSend, delay_secs: float) -> None:
+        try:
+            await asyncio.sleep(delay_secs)
+            await self._queue.put(item)
+        except asyncio.CancelledError:
+            _resolve(item, _closed_result(item))
+            raise
+
+    async def _finish(self, finished: List[Tuple[_QueuedSend, SendResult]]) -> None:
+        if not finished:
+            return
+        for item, result in finished:
+            recipient_id = item.payload['recipient']['id']
+            with log.correlation(item.correlation_id):
+                if result.delivered:
+                    metrics.OUTBOUND_MESSAGES.inc(outcome='delivered')
+                    log.event('message.sent', recipient_id=recipient_id, attempts=result.attempts)
+                else:
+                    metrics.OUTBOUND_MESSAGES.inc(outcome='failed')
+                    log.warning('message.send_failed', recipient_id=recipient_id, attempts=result.attempts, error=result.error)
+            _resolve(item, result)
+        try:
+            await db.run(record_outcomes, finished, datetime.now())
+        except Exception:
+            log.error('outbound.record_failed', messages=len(finished))
+
+    def _spawn(self, tasks: Set[asyncio.Task], coroutine: Coroutine) -> None:
+        task = asyncio.create_task(coroutine)
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+
+
+def record_outcomes(finished: List[Tuple[_QueuedSend, SendResult]], completed_at: datetime) -> None:
+    OutboundMessage.insert_many([
+        {
+            'recipient_id': item.payload['recipient']['id'],
+            'messaging_type': item.payload.get('messaging_type', ''),
+            'delivered': result.delivered,
+            'attempts': result.attempts,
+            'graph_message_id': result.message_id,
+            'error': result.error,
+            'queued_at': item.queued_at,
+            'completed_at': completed_at,
+        }
+        for item, result in finished
+    ]).execute()
+
+
+def _resolve(item: _QueuedSend, result: SendResult) -> None:
+    # The caller may have stopped waiting.
+    if not item.future.done():
+        item.future.set_result(result)
+
+
+def _closed_result(item: _QueuedSend) -> SendResult:
+    return SendResult(delivered=False, attempts=item.attempts, error='Outbound sender closed')
+
+
+def parse_json(text: Optional[str]) -> Any:
+    try:
+        return json.loads(text) if text else None
+    except ValueError:
+        return None
+
+
+def _error_message(status: Optional[int], body: Any) -> str:
+    error = body.get('error') if isinstance(body, dict) else None
+    if error is not None:
+        return 'HTTP %s: %s' % (status, error.get('message', error))
+    return 'HTTP %s' % status if status is not None else 'No response'
+
+
+_senders: 'weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, OutboundSender]' = weakref.WeakKeyDictionary()
+
+
+def get_outbound_sender() -> OutboundSender:
+    """
+    The sender of the running event loop, whose queue and rate limiter belong to that loop.
+    """
+    loop = asyncio.get_running_loop()
+    sender = _senders.get(loop)
+    if sender is None:
+        sender = _senders[loop] = OutboundSender()
+    return sender
+
+
+async def close_outbound_sender() -> None:
+    sender = _senders.pop(asyncio.get_running_loop(), None)
+    if sender is not None:
+        await sender.close()
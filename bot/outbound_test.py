@@ -0,0 +1,186 @@
+import asyncio
+import io
+import json
+import threading
+
+import pytest
+
+import bot.log as log
+import bot.outbound as outbound
+
+from bot.models import OutboundMessage
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Tuple
+from urllib.parse import parse_qs
+
+
+class StubSendApi(ThreadingHTTPServer):
+    """
+    Send API stand-in answering single and batch requests. `failures` maps a recipient id to the
+    (status, body) responses to give its first calls, before it succeeds.
+    """
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), StubHandler)
+        self.lock = threading.Lock()
+        self.requests: List[List[int]] = []
+        self.failures: Dict[int, List[Tuple[int, Dict[str, Any]]]] = {}
+
+    @property
+    def url(self) -> str:
+        return 'http://127.0.0.1:%s/v15.0' % self.server_address[1]
+
+    def answer(self, recipient_id: int) -> Tuple[int, Dict[str, Any]]:
+        with self.lock:
+            failures = self.failures.get(recipient_id)
+            if failures:
+                return failures.pop(0)
+        return 200, {'recipient_id': str(recipient_id), 'message_id': 'm%s' % recipient_id}
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        server: StubSendApi = self.server
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        if self.path.startswith('/v15.0/me/messages'):
+            recipient_id = json.loads(body)['recipient']['id']
+            server.requests.append([recipient_id])
+            self._respond(*server.answer(recipient_id))
+            return
+        calls = json.loads(parse_qs(body.decode())['batch'][0])
+        recipient_ids = [json.loads(parse_qs(call['body'])['recipient'][0])['id'] for call in calls]
+        server.requests.append(recipient_ids)
+        results = []
+        for recipient_id in recipient_ids:
+            status, answer = server.answer(recipient_id)
+            results.append({'code': status, 'body': json.dumps(answer)})
+        self._respond(200, results)
+
+    def _respond(self, status: int, obj: Any):
+        body = json.dumps(obj).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def send_api(monkeypatch):
+    server = StubSendApi()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setattr(outbound, 'MESSAGES_URL', server.url + '/me/messages')
+    monkeypatch.setattr(outbound, 'BATCH_URL', server.url + '/')
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture(scope='function', autouse=True)
+def clear_database():
+    try:
+        yield
+    finally:
+        OutboundMessage.delete().execute()
+
+
+def payload(recipient_id: int) -> Dict[str, Any]:
+    return {'recipient': {'id': recipient_id}, 'message': {'text': 'hi'}, 'messaging_type': 'RESPONSE'}
+
+
+def send_all(sender: outbound.OutboundSender, recipient_ids: List[int]) -> List[outbound.SendResult]:
+    async def run():
+        try:
+            return await asyncio.gather(*[sender.send(payload(recipient_id)) for recipient_id in recipient_ids])
+        finally:
+            await sender.close()
+    return asyncio.run(run())
+
+
+def test_classify_response():
+    assert outbound.classify_response(200, {'message_id': 'm'}) == outbound.DELIVERED
+    assert outbound.classify_response(429, None) == outbound.THROTTLED
+    assert outbound.classify_response(400, {'error': {'code': 613}}) == outbound.THROTTLED
+    assert outbound.classify_response(503, None) == outbound.RETRY
+    assert outbound.classify_response(None, None) == outbound.RETRY
+    assert outbound.classify_response(400, {'error': {'code': 2, 'is_transient': True}}) == outbound.RETRY
+    assert outbound.classify_response(400, {'error': {'code': 100}}) == outbound.FAILED
+
+
+def test_batch_request__form_encodes_json_values():
+    request = outbound.batch_request(payload(7))
+    assert request['relative_url'] == 'me/messages'
+    body = parse_qs(request['body'])
+    assert json.loads(body['recipient'][0]) == {'id': 7}
+    assert body['messaging_type'] == ['RESPONSE']
+
+
+def test_sender__coalesces_queued_messages_into_batch_requests(send_api):
+    sender = outbound.OutboundSender(batch_size=3, batch_wait_secs=0.2)
+
+    results = send_all(sender, [1, 2, 3, 4])
+
+    assert [result.message_id for result in results] == ['m1', 'm2', 'm3', 'm4']
+    assert send_api.requests == [[1, 2, 3], [4]]
+    assert OutboundMessage.select().where(OutboundMessage.delivered).count() == 4
+
+
+def test_sender__retries_server_errors_and_rate_limits(send_api):
+    send_api.failures = {
+        2: [(500, {'error': {'message': 'oops'}})],
+        3: [(400, {'error': {'code': 613, 'message': 'Calls to this api have exceeded the rate limit.'}})],
+    }
+    sender = outbound.OutboundSender(batch_size=3, batch_wait_secs=0.05, backoff_base_secs=0.01)
+
+    results = send_all(sender, [1, 2, 3])
+
+    assert all(result.delivered for result in results)
+    assert [result.attempts for result in results] == [1, 2, 2]
+
+
+def test_sender__gives_up_on_client_errors_and_after_max_attempts(send_api):
+    send_api.failures = {
+        1: [(400, {'error': {'code': 100, 'message': 'No matching user found'}})],
+        2: [(500, {})] * 3,
+    }
+    sender = outbound.OutboundSender(batch_size=2, batch_wait_secs=0.05, max_attempts=3, backoff_base_secs=0.01)
+
+    results = send_all(sender, [1, 2])
+
+    assert [(result.delivered, result.attempts) for result in results] == [(False, 1), (False, 3)]
+    assert 'No matching user found' in results[0].error
+    [recorded] = OutboundMessage.select().where(OutboundMessage.recipient_id == 1)
+    assert not recorded.delivered
+
+
+def test_sender__logs_each_outcome_under_its_callers_correlation_id(send_api):
+    send_api.failures = {recipient_id: [(400, {'error': {'code': 100}})] for recipient_id in (1, 2)}
+    sender = outbound.OutboundSender(batch_size=2, batch_wait_secs=0.05)
+
+    async def send(recipient_id: int, correlation_id: str):
+        with log.correlation(correlation_id):
+            return await sender.send(payload(recipient_id))
+
+    async def run():
+        try:
+            return await asyncio.gather(send(1, 'mid.a'), send(2, 'mid.b'))
+        finally:
+            await sender.close()
+
+    stream = io.StringIO()
+    log.shutdown_logging()
+    log.configure_logging(stream)
+    try:
+        asyncio.run(run())
+    finally:
+        log.shutdown_logging()
+
+    lines = [json.loads(line) for line in stream.getvalue().splitlines()]
+    failed = {line['recipient_id']: line.get('correlation_id') for line in lines if line['event'] == 'message.send_failed'}
+    assert send_api.requests == [[1, 2]]
+    assert failed == {1: 'mid.a', 2: 'mid.b'}
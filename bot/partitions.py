@@ -0,0 +1,252 @@
+import asyncio
+import gzip
+import os
+import re
+
+from dataclasses import dataclass
+from datetime import date
+from typing import List, Optional, Sequence, Type
+
+import bot.db_service as db
+import bot.log as log
+
+from peewee import Model
+
+from bot.settings import (
+    PARTITION_LOCK_TIMEOUT_SECS,
+    PARTITION_MAINTENANCE_INTERVAL_SECS,
+    PARTITION_PREMAKE_MONTHS,
+)
+
+
+# Partitioned models declare their range partition key in Meta, next to the matching table_settings:
+#
+#     class Meta:
+#         primary_key = CompositeKey('id', 'created_at')
+#         table_settings = ['PARTITION BY RANGE (created_at)']
+#         partition_key = 'created_at'
+#
+# Each table has one partition per calendar month, named <table>_pYYYY_MM, and a <table>_default
+# partition catching rows outside every monthly one.
+
+
+@dataclass(frozen=True)
+class Partition:
+    name: str
+    # Rows with start <= key < end.
+    start: date
+    end: date
+    # False for partitions detached by an archival run that didn't finish.
+    attached: bool
+
+
+def month_start(day: date) -> date:
+    return date(day.year, day.month, 1)
+
+
+def add_months(day: date, months: int) -> date:
+    index = day.year * 12 + day.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(table: str, start: date) -> str:
+    return '%s_p%04d_%02d' % (table, start.year, start.month)
+
+
+def default_partition_name(table: str) -> str:
+    return '%s_default' % table
+
+
+def is_partitioned(model: Type[Model]) -> bool:
+    cursor = db.execute_sql(
+        'SELECT c.relkind FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace '
+        'WHERE c.relname = %s AND n.nspname = COALESCE(%s, current_schema())',
+        (model._meta.table_name, model._meta.schema))
+    row = cursor.fetchone()
+    return row is not None and row[0] == 'p'
+
+
+def list_partitions(model: Type[Model]) -> List[Partition]:
+    """
+    Monthly partitions of `model`, attached or left detached, oldest first.
+    """
+    table = model._meta.table_name
+    cursor = db.execute_sql(
+        "SELECT c.relname, c.relispartition FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace "
+        "WHERE c.relkind = 'r' AND left(c.relname, %s) = %s AND n.nspname = COALESCE(%s, current_schema())",
+        (len(table) + 2, table + '_p', model._meta.schema))
+    pattern = re.compile(r'^%s_p(\d{4})_(\d{2})$' % re.escape(table))
+    partitions = []
+    for name, attached in cursor.fetchall():
+        match = pattern.match(name)
+        if match is None:
+            continue
+        start = date(int(match.group(1)), int(match.group(2)), 1)
+        partitions.append(Partition(name=name, start=start, end=add_months(start, 1), attached=attached))
+    return sorted(partitions, key=lambda partition: partition.start)
+
+
+def ensure_partitions(
+    model: Type[Model],
+    today: Optional[date] = None,
+    months_ahead: int = PARTITION_PREMAKE_MONTHS,
+    since: Optional[date] = None,
+) -> List[str]:
+    """
+    Create the default partition of `model`, and its monthly partitions from the month of `since`
+    (this month by default) through `months_ahead` months after this one. Returns the names of the
+    partitions created. Safe to run concurrently from several processes.
+    """
+    today = today or date.today()
+    first = month_start(since or today)
+    last = add_months(month_start(today), months_ahead)
+    table = model._meta.table_name
+    created = []
+    with db.atomic():
+        # Serialize with other processes maintaining the same table.
+        db.execute_sql('SELECT pg_advisory_xact_lock(hashtext(%s))', (_ref(model, table),))
+        existing = {partition.name for partition in list_partitions(model)}
+        db.execute_sql('CREATE TABLE IF NOT EXISTS %s PARTITION OF %s DEFAULT' % (
+            _ref(model, default_partition_name(table)), _ref(model, table)))
+        start = first
+        while start <= last:
+            name = partition_name(table, start)
+            if name not in existing:
+                _create_partition(model, start)
+                created.append(name)
+            start = add_months(start, 1)
+    for name in created:
+        log.event('partition.created', table=table, partition=name)
+    return created
+
+
+def _create_partition(model: Type[Model], start: date) -> None:
+    table = model._meta.table_name
+    key = _quote(model._meta.partition_key)
+    end = add_months(start, 1)
+    partition = _ref(model, partition_name(table, start))
+    db.execute_sql('CREATE TABLE %s (LIKE %s INCLUDING DEFAULTS INCLUDING CONSTRAINTS)' % (partition, _ref(model, table)))
+    # Attaching fails if the default partition holds rows of the new range, so move them over first.
+    db.execute_sql(
+        'WITH moved AS (DELETE FROM %s WHERE %s >= %%s AND %s < %%s RETURNING *) INSERT INTO %s SELECT * FROM moved' % (
+            _ref(model, default_partition_name(table)), key, key, partition),
+        (start, end))
+    db.execute_sql("ALTER TABLE %s ATTACH PARTITION %s FOR VALUES FROM ('%s') TO ('%s')" % (
+        _ref(model, table), partition, start.isoformat(), end.isoformat()))
+
+
+def archive_partitions(model: Type[Model], before: date, directory: str, dry_run: bool = False) -> List[str]:
+    """
+    Archive the monthly partitions of `model` holding only rows from before `before`: detach each
+    one, so queries on the table no longer touch it, COPY it to <directory>/<partition>.csv.gz, and
+    drop it. Returns the archived partition names.
+
+    A partition whose export failed stays detached, and is exported by the next run.
+    """
+    archived = []
+    for partition in list_partitions(model):
+        if partition.end > before:
+            continue
+        archived.append(partition.name)
+        if dry_run:
+            continue
+        if partition.attached:
+            detach_partition(model, partition.name)
+        path = export_table(model, partition.name, directory)
+        db.execute_sql('DROP TABLE %s' % _ref(model, partition.name))
+        log.event('partition.archived', table=model._meta.table_name, partition=partition.name, path=path)
+    return archived
+
+
+def detach_partition(model: Type[Model], name: str) -> None:
+    with db.atomic():
+        # Detaching locks the whole table; give up rather than queue every query behind a long one.
+        db.execute_sql("SET LOCAL lock_timeout = '%ss'" % PARTITION_LOCK_TIMEOUT_SECS)
+        db.execute_sql('ALTER TABLE %s DETACH PARTITION %s' % (_ref(model, model._meta.table_name), _ref(model, name)))
+
+
+def export_table(model: Type[Model], name: str, directory: str) -> str:
+    """
+    Write the table `name` to <directory>/<name>.csv.gz, with a header row. The file only appears
+    under its final name once completely written and synced.
+    """
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, '%s.csv.gz' % name)
+    temp_path = path + '.tmp'
+    with open(temp_path, 'wb') as output:
+        with gzip.GzipFile(filename='%s.csv' % name, mode='wb', fileobj=output) as compressed:
+            cursor = db.get_db_instance().cursor()
+            cursor.copy_expert('COPY %s TO STDOUT WITH (FORMAT csv, HEADER)' % _ref(model, name), compressed)
+        output.flush()
+        os.fsync(output.fileno())
+    os.replace(temp_path, path)
+    return path
+
+
+def convert_to_partitioned(model: Type[Model]) -> int:
+    """
+    Replace the unpartitioned table of `model` created by an older version with a partitioned one
+    holding the same rows, in one transaction. Writes to the table block until it commits.
+    Returns the number of rows copied.
+    """
+    table = model._meta.table_name
+    old_table = '%s_unpartitioned' % table
+    key = _quote(model._meta.partition_key)
+    columns = ', '.join(_quote(field.column_name) for field in model._meta.sorted_fields)
+    with db.atomic():
+        db.execute_sql('LOCK TABLE %s IN ACCESS EXCLUSIVE MODE' % _ref(model, table))
+        db.execute_sql('ALTER TABLE %s RENAME TO %s' % (_ref(model, table), _quote(old_table)))
+        # Free up the index (and primary key) names for the new table.
+        cursor = db.execute_sql(
+            'SELECT indexname FROM pg_indexes WHERE tablename = %s AND schemaname = COALESCE(%s, current_schema())',
+            (old_table, model._meta.schema))
+        for (index,) in cursor.fetchall():
+            db.execute_sql('ALTER INDEX %s RENAME TO %s' % (_ref(model, index), _quote('%s_unpartitioned' % index)))
+        model.create_table(safe=False)
+        (oldest,) = db.execute_sql('SELECT MIN(%s) FROM %s' % (key, _ref(model, old_table))).fetchone()
+        ensure_partitions(model, since=oldest.date() if oldest is not None else None)
+        cursor = db.execute_sql('INSERT INTO %s (%s) SELECT %s FROM %s' % (
+            _ref(model, table), columns, columns, _ref(model, old_table)))
+        copied = cursor.rowcount
+        # CASCADE drops foreign keys from other old tables into this one.
+        db.execute_sql('DROP TABLE %s CASCADE' % _ref(model, old_table))
+    return copied
+
+
+_maintenance_task: Optional[asyncio.Task] = None
+
+
+def start_maintenance(models: Sequence[Type[Model]], interval_secs: float = PARTITION_MAINTENANCE_INTERVAL_SECS) -> None:
+    """
+    Keep creating upcoming partitions of `models` on the running event loop, every `interval_secs`.
+    """
+    global _maintenance_task
+    _maintenance_task = asyncio.create_task(_maintain(models, interval_secs), name='partition-maintenance')
+
+
+async def stop_maintenance() -> None:
+    global _maintenance_task
+    if _maintenance_task is None:
+        return
+    _maintenance_task.cancel()
+    await asyncio.gather(_maintenance_task, return_exceptions=True)
+    _maintenance_task = None
+
+
+async def _maintain(models: Sequence[Type[Model]], interval_secs: float) -> None:
+    while True:
+        await asyncio.sleep(interval_secs)
+        for model in models:
+            try:
+                await db.run(ensure_partitions, model)
+            except Exception:
+                log.error('partition.maintenance_failed', table=model._meta.table_name)
+
+
+def _quote(name: str) -> str:
+    return '"%s"' % name.replace('"', '""')
+
+
+def _ref(model: Type[Model], name: str) -> str:
+    schema = model._meta.schema
+    return '%s.%s' % (_quote(schema), _quote(name)) if schema else _quote(name)
@@ -0,0 +1,65 @@
+import gzip
+import pytest
+
+import bot.db_service as db
+import bot.partitions as partitions
+
+from bot.models import Person, Review
+from datetime import date, datetime
+
+
+@pytest.fixture(scope='function', autouse=True)
+def clear_database():
+    try:
+        yield
+    finally:
+        Review.delete().execute()
+        Person.delete().execute()
+
+
+def test_add_months():
+    assert partitions.add_months(date(2022, 11, 1), 1) == date(2022, 12, 1)
+    assert partitions.add_months(date(2022, 12, 1), 1) == date(2023, 1, 1)
+    assert partitions.add_months(date(2023, 1, 1), -13) == date(2021, 12, 1)
+
+
+def test_partition_name():
+    assert partitions.partition_name('reviews', date(2022, 3, 1)) == 'reviews_p2022_03'
+
+
+def test_ensure_partitions__moves_rows_out_of_the_default_partition():
+    create_review('early', datetime(2021, 3, 15))
+
+    created = partitions.ensure_partitions(Review, today=date(2021, 3, 1), months_ahead=1)
+
+    assert created == ['reviews_p2021_03', 'reviews_p2021_04']
+    assert count_rows('reviews_p2021_03') == 1
+    assert count_rows('reviews_default') == 0
+    assert partitions.ensure_partitions(Review, today=date(2021, 3, 1), months_ahead=1) == []
+
+
+def test_archive_partitions__exports_and_drops_old_partitions(tmp_path):
+    partitions.ensure_partitions(Review, today=date(2021, 5, 1), months_ahead=1)
+    create_review('old', datetime(2021, 5, 2))
+    create_review('recent', datetime(2021, 6, 2))
+
+    archived = partitions.archive_partitions(Review, date(2021, 6, 1), str(tmp_path))
+
+    assert 'reviews_p2021_05' in archived
+    assert 'reviews_p2021_06' not in archived
+    assert [review.raw_message for review in Review.select()] == ['recent']
+    with gzip.open(tmp_path / 'reviews_p2021_05.csv.gz', 'rt') as archive:
+        lines = archive.read().splitlines()
+    assert lines[0].split(',')[0] == 'id'
+    assert len(lines) == 2 and 'old' in lines[1]
+    assert 'reviews_p2021_05' not in [partition.name for partition in partitions.list_partitions(Review)]
+
+
+def create_review(message: str, created_at: datetime):
+    person, _ = Person.get_or_create(id=1, defaults={'created_at': datetime.now()})
+    Review.create(conversation_id='00000000-0000-0000-0000-000000000001', person=person, product_id=7,
+        created_at=created_at, estimated_review_stars=4, raw_message=message)
+
+
+def count_rows(table: str) -> int:
+    return db.execute_sql('SELECT COUNT(*) FROM pytest.%s' % table).fetchone()[0]
@@ -0,0 +1,290 @@
+import asyncio
+import weakref
+
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Optional, Set
+
+import bot.db_service as db
+import bot.log as log
+import bot.metrics as metrics
+
+from bot.constants import ACCESS_TOKEN
+from bot.graph_api import get_graph_api_client
+from bot.models import Person
+from bot.outbound import DELIVERED, FAILED, MAX_BATCH_SIZE, SendResponse, backoff_secs, classify_response, parse_json, post_batch
+from bot.settings import (
+    GRAPH_API_BASE_URL,
+    PROFILE_BACKOFF_BASE_SECS,
+    PROFILE_BACKOFF_MAX_SECS,
+    PROFILE_BATCH_SIZE,
+    PROFILE_BATCH_WAIT_MS,
+    PROFILE_CACHE_SIZE,
+    PROFILE_FETCH_CONCURRENCY,
+    PROFILE_MAX_ATTEMPTS,
+    PROFILE_QUEUE_SIZE,
+)
+
+
+PROFILE_URL_TEMPLATE = GRAPH_API_BASE_URL + '/{}'
+PROFILE_FIELDS = 'first_name,last_name'
+
+
+class ProfileUnavailableError(Exception):
+    """
+    A person's profile couldn't be fetched.
+    """
+
+
+@dataclass(frozen=True)
+class ProfileInfo:
+    person_id: int
+    first_name: str
+    last_name: str
+
+    @classmethod
+    def from_json(cls, obj, person_id: int):
+        return ProfileInfo(
+            person_id=person_id,
+            first_name=obj['first_name'],
+            last_name=obj['last_name']
+        )
+
+
+@metrics.timed('fetch_profiles')
+async def fetch_profiles(person_ids: List[int]) -> List[SendResponse]:
+    """
+    Look up the profiles of up to MAX_BATCH_SIZE persons: a plain request for one, a batch request
+    for several. Returns each profile's response, in order.
+    """
+    if len(person_ids) == 1:
+        params = {
+            'fields': PROFILE_FIELDS,
+            'access_token': ACCESS_TOKEN
+        }
+        response = await get_graph_api_client().get(url=PROFILE_URL_TEMPLATE.format(person_ids[0]), params=params)
+        return [(response.status_code, parse_json(response.text))]
+    calls = [{'method': 'GET', 'relative_url': '%s?fields=%s' % (person_id, PROFILE_FIELDS)} for person_id in person_ids]
+    return await post_batch(calls)
+
+
+def save_profiles(profiles: List[ProfileInfo]) -> None:
+    with db.atomic():
+        for info in profiles:
+            Person.update(first_name=info.first_name, last_name=info.last_name).where(Person.id == info.person_id).execute()
+
+
+class ProfileEnricher:
+    """
+    Fills in the names of persons, who are created without them so that replying to a new sender
+    never waits on the profile API.
+
+    enqueue() returns straight away: ids queued within `batch_wait_secs` of each other are fetched
+    in one Graph API batch request of up to `batch_size` profiles. get_many() fetches profiles on
+    demand, for callers that need the names now. Either way at most `concurrency` requests are in
+    flight, profiles failing with a server error or a rate limit are retried up to `max_attempts`
+    times with jittered exponential backoff, and fetched names are written to persons.
+
+    Up to `cache_size` fetched profiles are kept, and concurrent lookups of the same person share a
+    single fetch. Queued ids are lost on shutdown; those names are fetched on demand when needed.
+    """
+
+    def __init__(
+        self,
+        batch_size: int = PROFILE_BATCH_SIZE,
+        batch_wait_secs: float = PROFILE_BATCH_WAIT_MS / 1000.0,
+        concurrency: int = PROFILE_FETCH_CONCURRENCY,
+        max_attempts: int = PROFILE_MAX_ATTEMPTS,
+        backoff_base_secs: float = PROFILE_BACKOFF_BASE_SECS,
+        backoff_max_secs: float = PROFILE_BACKOFF_MAX_SECS,
+        cache_size: int = PROFILE_CACHE_SIZE,
+        queue_size: int = PROFILE_QUEUE_SIZE,
+    ):
+        self._batch_size = max(1, min(batch_size, MAX_BATCH_SIZE))
+        self._batch_wait_secs = batch_wait_secs
+        self._limit = asyncio.Semaphore(concurrency)
+        self._max_attempts = max_attempts
+        self._backoff_base_secs = backoff_base_secs
+        self._backoff_max_secs = backoff_max_secs
+        self._cache_size = cache_size
+        self._cache: 'OrderedDict[int, ProfileInfo]' = OrderedDict()
+        # Per person being fetched, a future of their profile, or None if it is unavailable.
+        self._in_flight: Dict[int, asyncio.Future] = {}
+        self._queue: 'asyncio.Queue[int]' = asyncio.Queue(maxsize=queue_size)
+        self._runner: Optional[asyncio.Task] = None
+        self._fetches: Set[asyncio.Task] = set()
+
+    def enqueue(self, person_ids: Iterable[int]) -> None:
+        """
+        Fetch the profiles of `person_ids` in the background.
+        """
+        if self._runner is None:
+            self._runner = log.start_uncorrelated_task(self._run(), name='profile-enricher')
+        for person_id in person_ids:
+            if person_id in self._cache or person_id in self._in_flight:
+                continue
+            try:
+                self._queue.put_nowait(person_id)
+            except asyncio.QueueFull:
+                log.warning('profile.enqueue_dropped', person_id=person_id)
+
+    async def get(self, person_id: int) -> ProfileInfo:
+        """
+        A person's profile, fetched now unless cached. Raises ProfileUnavailableError.
+        """
+        info = (await self.get_many([person_id])).get(person_id)
+        if info is None:
+            raise ProfileUnavailableError('Profile of %s unavailable' % person_id)
+        return info
+
+    async def get_many(self, person_ids: Iterable[int]) -> Dict[int, ProfileInfo]:
+        """
+        The profiles of `person_ids`, fetched now unless cached. Unavailable profiles are left out.
+        """
+        profiles: Dict[int, ProfileInfo] = {}
+        futures: Dict[int, asyncio.Future] = {}
+        missing = []
+        for person_id in dict.fromkeys(person_ids):
+            info = self._get_cached(person_id)
+            if info is not None:
+                profiles[person_id] = info
+            elif person_id in self._in_flight:
+                futures[person_id] = self._in_flight[person_id]
+            else:
+                missing.append(person_id)
+        for start in range(0, len(missing), self._batch_size):
+            futures.update(self._start_fetch(missing[start:start + self._batch_size]))
+        for person_id, future in futures.items():
+            info = await asyncio.shield(future)
+            if info is not None:
+                profiles[person_id] = info
+        return profiles
+
+    async def close(self) -> None:
+        """
+        Stop fetching. Queued ids are dropped, and fetches in progress cancelled.
+        """
+        tasks = [task for task in [self._runner, *self._fetches] if task is not None]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        # Fetches cancelled before they started never resolved their futures.
+        for future in self._in_flight.values():
+            if not future.done():
+                future.set_result(None)
+        self._in_flight.clear()
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self._batch_wait_secs
+            while len(batch) < self._batch_size:
+                remaining = deadline - loop.time()
+                try:
+                    if remaining > 0:
+                        batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+                    else:
+                        batch.append(self._queue.get_nowait())
+                except (asyncio.TimeoutError, asyncio.QueueEmpty):
+                    break
+            # Profiles may have been fetched on demand while their ids were queued.
+            person_ids = [
+                person_id for person_id in dict.fromkeys(batch)
+                if person_id not in self._cache and person_id not in self._in_flight
+            ]
+            if person_ids:
+                self._start_fetch(person_ids)
+
+    def _start_fetch(self, person_ids: List[int]) -> Dict[int, asyncio.Future]:
+        loop = asyncio.get_running_loop()
+        futures = {person_id: loop.create_future() for person_id in person_ids}
+        self._in_flight.update(futures)
+        # Concurrent lookups share the fetch, so it isn't tagged with the correlation id of the first.
+        task = log.start_uncorrelated_task(self._fetch(futures))
+        self._fetches.add(task)
+        task.add_done_callback(self._fetches.discard)
+        return futures
+
+    async def _fetch(self, futures: Dict[int, asyncio.Future]) -> None:
+        profiles: Dict[int, Optional[ProfileInfo]] = {}
+        try:
+            pending = list(futures)
+            attempts = 0
+            while pending:
+                attempts += 1
+                async with self._limit:
+                    try:
+                        responses = await fetch_profiles(pending)
+                    except Exception as e:
+                        log.warning('profile.request_failed', profiles=len(pending), error=str(e))
+                        responses = [(None, None)] * len(pending)
+                retry = []
+                for person_id, (status, body) in zip(pending, responses):
+                    outcome = classify_response(status, body)
+                    if outcome == DELIVERED:
+                        profiles[person_id] = _profile_info(person_id, body)
+                    elif outcome == FAILED or attempts >= self._max_attempts:
+                        log.warning('profile.fetch_failed', person_id=person_id, attempts=attempts, status=status, body=body)
+                        profiles[person_id] = None
+                    else:
+                        retry.append(person_id)
+                pending = retry
+                if pending:
+                    await asyncio.sleep(backoff_secs(attempts, self._backoff_base_secs, self._backoff_max_secs))
+
+            fetched = [info for info in profiles.values() if info is not None]
+            if fetched:
+                try:
+                    await db.run(save_profiles, fetched)
+                except Exception:
+                    log.error('profile.save_failed', profiles=len(fetched))
+                for info in fetched:
+                    self._put_cached(info)
+        finally:
+            for person_id, future in futures.items():
+                self._in_flight.pop(person_id, None)
+                if not future.done():
+                    future.set_result(profiles.get(person_id))
+
+    def _get_cached(self, person_id: int) -> Optional[ProfileInfo]:
+        info = self._cache.get(person_id)
+        if info is not None:
+            self._cache.move_to_end(person_id)
+        return info
+
+    def _put_cached(self, info: ProfileInfo) -> None:
+        self._cache[info.person_id] = info
+        self._cache.move_to_end(info.person_id)
+        while len(self._cache) > self._cache_size:
+            self._cache.popitem(last=False)
+
+
+def _profile_info(person_id: int, body: Dict) -> Optional[ProfileInfo]:
+    try:
+        info = ProfileInfo.from_json(body, person_id)
+    except KeyError:
+        log.warning('profile.incomplete', person_id=person_id, fields=sorted(body))
+        return None
+    log.event('profile.fetched', person_id=person_id, first_name=info.first_name, last_name=info.last_name)
+    return info
+
+
+_enrichers: 'weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, ProfileEnricher]' = weakref.WeakKeyDictionary()
+
+
+def get_profile_enricher() -> ProfileEnricher:
+    """
+    The enricher of the running event loop, whose queue and tasks belong to that loop.
+    """
+    loop = asyncio.get_running_loop()
+    enricher = _enrichers.get(loop)
+    if enricher is None:
+        enricher = _enrichers[loop] = ProfileEnricher()
+    return enricher
+
+
+async def close_profile_enricher() -> None:
+    enricher = _enrichers.pop(asyncio.get_running_loop(), None)
+    if enricher is not None:
+        await enricher.close()
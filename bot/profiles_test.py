@@ -0,0 +1,166 @@
+import asyncio
+import json
+import threading
+
+import pytest
+
+import bot.outbound as outbound
+import bot.profiles as profiles
+
+from bot.models import Person
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Tuple
+from urllib.parse import parse_qs, urlsplit
+
+
+class StubProfileApi(ThreadingHTTPServer):
+    """
+    Profile API stand-in answering single and batch lookups. `failures` maps a person id to the
+    (status, body) responses to give its first lookups, before it succeeds.
+    """
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), StubHandler)
+        self.lock = threading.Lock()
+        self.requests: List[List[int]] = []
+        self.failures: Dict[int, List[Tuple[int, Dict[str, Any]]]] = {}
+
+    @property
+    def url(self) -> str:
+        return 'http://127.0.0.1:%s' % self.server_address[1]
+
+    def answer(self, person_id: int) -> Tuple[int, Dict[str, Any]]:
+        with self.lock:
+            failures = self.failures.get(person_id)
+            if failures:
+                return failures.pop(0)
+        return 200, {'first_name': 'First%s' % person_id, 'last_name': 'Last%s' % person_id}
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        server: StubProfileApi = self.server
+        person_id = int(urlsplit(self.path).path.strip('/'))
+        server.requests.append([person_id])
+        self._respond(*server.answer(person_id))
+
+    def do_POST(self):
+        server: StubProfileApi = self.server
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        calls = json.loads(parse_qs(body.decode())['batch'][0])
+        person_ids = [int(urlsplit(call['relative_url']).path) for call in calls]
+        server.requests.append(person_ids)
+        results = []
+        for person_id in person_ids:
+            status, answer = server.answer(person_id)
+            results.append({'code': status, 'body': json.dumps(answer)})
+        self._respond(200, results)
+
+    def _respond(self, status: int, obj: Any):
+        body = json.dumps(obj).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def profile_api(monkeypatch):
+    server = StubProfileApi()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setattr(profiles, 'PROFILE_URL_TEMPLATE', server.url + '/{}')
+    monkeypatch.setattr(outbound, 'BATCH_URL', server.url + '/')
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture(scope='function', autouse=True)
+def clear_database():
+    try:
+        yield
+    finally:
+        Person.delete().execute()
+
+
+def create_persons(person_ids: List[int]) -> None:
+    Person.insert_many([{'id': person_id, 'created_at': datetime.now()} for person_id in person_ids]).execute()
+
+
+def test_enqueue__fetches_queued_profiles_in_one_batch_request(profile_api):
+    create_persons([1, 2, 3])
+
+    async def run():
+        enricher = profiles.ProfileEnricher(batch_wait_secs=0.05)
+        try:
+            enricher.enqueue([1, 2, 3])
+            await asyncio.sleep(0.1)
+            # Waits for the background fetch instead of starting another one.
+            return await enricher.get_many([1, 2, 3])
+        finally:
+            await enricher.close()
+
+    fetched = asyncio.run(run())
+
+    assert profile_api.requests == [[1, 2, 3]]
+    assert fetched[2].first_name == 'First2'
+    assert {person.id: person.first_name for person in Person.select()} == {1: 'First1', 2: 'First2', 3: 'First3'}
+
+
+def test_get_many__retries_server_errors_and_leaves_out_unavailable_profiles(profile_api):
+    create_persons([1, 2, 3])
+    profile_api.failures = {
+        2: [(500, {'error': {'message': 'oops'}})],
+        3: [(400, {'error': {'code': 100, 'message': 'Unsupported get request'}})],
+    }
+
+    async def run():
+        enricher = profiles.ProfileEnricher(backoff_base_secs=0.01)
+        try:
+            return await enricher.get_many([1, 2, 3]), await enricher.get_many([1, 2])
+        finally:
+            await enricher.close()
+
+    fetched, cached = asyncio.run(run())
+
+    assert sorted(fetched) == [1, 2]
+    assert cached == fetched
+    assert profile_api.requests == [[1, 2, 3], [2]]
+    assert Person.get(Person.id == 3).first_name is None
+
+
+def test_get__shares_concurrent_fetches_of_the_same_person(profile_api):
+    create_persons([1])
+
+    async def run():
+        enricher = profiles.ProfileEnricher()
+        try:
+            return await asyncio.gather(enricher.get(1), enricher.get(1))
+        finally:
+            await enricher.close()
+
+    first, second = asyncio.run(run())
+
+    assert first == second == profiles.ProfileInfo(person_id=1, first_name='First1', last_name='Last1')
+    assert profile_api.requests == [[1]]
+
+
+def test_get__raises_when_the_profile_is_unavailable(profile_api):
+    profile_api.failures = {1: [(400, {'error': {'code': 100}})]}
+
+    async def run():
+        enricher = profiles.ProfileEnricher()
+        try:
+            return await enricher.get(1)
+        finally:
+            await enricher.close()
+
+    with pytest.raises(profiles.ProfileUnavailableError):
+        asyncio.run(run())
@@ -0,0 +1,58 @@
+import asyncio
+import time
+
+from typing import Callable, Optional
+
+
+class TokenBucket:
+    """
+    Token bucket rate limiter for coroutines: allows bursts of up to `burst` acquisitions,
+    refilled at `rate_per_sec`. Waiters are served in FIFO order.
+    """
+
+    def __init__(
+        self,
+        rate_per_sec: float,
+        burst: Optional[float] = None,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        if rate_per_sec <= 0:
+            raise ValueError('rate_per_sec must be positive')
+        self._rate_per_sec = rate_per_sec
+        self._capacity = burst if burst is not None else max(1.0, rate_per_sec)
+        self._tokens = self._capacity
+        self._clock = clock
+        self._updated_at = clock()
+        self._lock = asyncio.Lock()
+
+    @property
+    def rate_per_sec(self) -> float:
+        return self._rate_per_sec
+
+    @property
+    def capacity(self) -> float:
+        return self._capacity
+
+    def drain(self, hold_secs: float = 0.0) -> None:
+        """
+        Empty the bucket, and hold off acquisitions for a further `hold_secs`.
+        """
+        self._refill()
+        self._tokens = min(self._tokens, -hold_secs * self._rate_per_sec)
+
+    def try_acquire(self, tokens: float = 1.0) -> bool:
+        self._refill()
+        if self._tokens >= tokens:
+            self._tokens -= tokens
+            return True
+        return False
+
+    async def acquire(self, tokens: float = 1.0) -> None:
+        async with self._lock:
+            while not self.try_acquire(tokens):
+                await asyncio.sleep((tokens - self._tokens) / self._rate_per_sec)
+
+    def _refill(self) -> None:
+        now = self._clock()
+        self._tokens = min(self._capacity, self._tokens + (now - self._updated_at) * self._rate_per_sec)
+        self._updated_at = now
@@ -0,0 +1,139 @@
+import math
+
+from datetime import date, datetime, timedelta
+from typing import Any, Dict, Optional
+
+import bot.db_service as db
+
+from peewee import EXCLUDED, fn
+
+from bot.models import ProductRating, ProductRatingDay, Review
+
+
+ROLLING_WINDOWS_DAYS = (7, 30)
+STAR_BUCKETS = (
+    ProductRating.stars_1,
+    ProductRating.stars_2,
+    ProductRating.stars_3,
+    ProductRating.stars_4,
+    ProductRating.stars_5,
+)
+
+
+def star_bucket(stars: float) -> int:
+    # Round half up, matching FLOOR(stars + 0.5) in rebuild().
+    return min(5, max(1, math.floor(stars + 0.5)))
+
+
+def record_review(product_id: int, stars: float, created_at: datetime) -> None:
+    """
+    Add a review to its product's aggregates. Call this in the transaction that creates the Review.
+    """
+    # Aggregate the value as stored in reviews.estimated_review_stars, so rebuild() gives the same sums.
+    stars = round(stars, 3)
+    bucket = star_bucket(stars)
+    row: Dict[Any, Any] = {
+        ProductRating.product_id: product_id,
+        ProductRating.review_count: 1,
+        ProductRating.stars_sum: stars,
+        ProductRating.stars_sum_squares: stars * stars,
+        ProductRating.last_review_at: created_at,
+    }
+    for i, field in enumerate(STAR_BUCKETS, start=1):
+        row[field] = 1 if i == bucket else 0
+    increments = [ProductRating.review_count, ProductRating.stars_sum, ProductRating.stars_sum_squares, *STAR_BUCKETS]
+    update = {field: field + getattr(EXCLUDED, field.column_name) for field in increments}
+    update[ProductRating.last_review_at] = fn.GREATEST(ProductRating.last_review_at, EXCLUDED.last_review_at)
+    (ProductRating
+        .insert(row)
+        .on_conflict(conflict_target=[ProductRating.product_id], update=update)
+        .execute())
+
+    (ProductRatingDay
+        .insert(product_id=product_id, day=created_at.date(), review_count=1, stars_sum=stars)
+        .on_conflict(
+            conflict_target=[ProductRatingDay.product_id, ProductRatingDay.day],
+            update={
+                ProductRatingDay.review_count: ProductRatingDay.review_count + EXCLUDED.review_count,
+                ProductRatingDay.stars_sum: ProductRatingDay.stars_sum + EXCLUDED.stars_sum,
+            })
+        .execute())
+
+
+def get_product_rating(product_id: int, today: Optional[date] = None) -> Optional[Dict[str, Any]]:
+    """
+    Rating summary for a product, read from the aggregates in two primary-key lookups
+    regardless of how many reviews it has.
+    """
+    rating = ProductRating.get_or_none(ProductRating.product_id == product_id)
+    if rating is None:
+        return None
+    today = today or date.today()
+    longest_window = max(ROLLING_WINDOWS_DAYS)
+    days = list(ProductRatingDay
+        .select()
+        .where(
+            (ProductRatingDay.product_id == product_id)
+            & (ProductRatingDay.day > today - timedelta(days=longest_window))))
+
+    mean = rating.stars_sum / rating.review_count
+    variance = max(0.0, rating.stars_sum_squares / rating.review_count - mean * mean)
+    rolling = {}
+    for window in ROLLING_WINDOWS_DAYS:
+        in_window = [day for day in days if day.day > today - timedelta(days=window)]
+        count = sum(day.review_count for day in in_window)
+        total = sum(day.stars_sum for day in in_window)
+        rolling['%sd' % window] = {
+            'review_count': count,
+            'average_stars': total / count if count else None,
+        }
+    return {
+        'product_id': product_id,
+        'review_count': rating.review_count,
+        'average_stars': mean,
+        'stddev_stars': math.sqrt(variance),
+        'histogram': {str(i): getattr(rating, field.name) for i, field in enumerate(STAR_BUCKETS, start=1)},
+        'last_review_at': rating.last_review_at.isoformat(),
+        'rolling': rolling,
+    }
+
+
+def rebuild() -> None:
+    """
+    Recompute every aggregate from the reviews table, in one transaction.
+    Reviews already archived by scripts/archive_partitions.py no longer count.
+    """
+    stars = Review.estimated_review_stars
+    bucket = fn.LEAST(5, fn.GREATEST(1, fn.FLOOR(stars + 0.5)))
+    with db.atomic():
+        ProductRating.delete().execute()
+        ProductRatingDay.delete().execute()
+        ProductRating.insert_from(
+            Review
+                .select(
+                    Review.product_id,
+                    fn.COUNT(Review.id),
+                    fn.SUM(stars),
+                    fn.SUM(stars * stars),
+                    *[fn.COUNT(Review.id).filter(bucket == i) for i in range(1, 6)],
+                    fn.MAX(Review.created_at))
+                .group_by(Review.product_id),
+            fields=[
+                ProductRating.product_id,
+                ProductRating.review_count,
+                ProductRating.stars_sum,
+                ProductRating.stars_sum_squares,
+                *STAR_BUCKETS,
+                ProductRating.last_review_at,
+            ]).execute()
+        day = fn.DATE(Review.created_at)
+        ProductRatingDay.insert_from(
+            Review
+                .select(Review.product_id, day, fn.COUNT(Review.id), fn.SUM(stars))
+                .group_by(Review.product_id, day),
+            fields=[
+                ProductRatingDay.product_id,
+                ProductRatingDay.day,
+                ProductRatingDay.review_count,
+                ProductRatingDay.stars_sum,
+            ]).execute()
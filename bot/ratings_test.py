@@ -0,0 +1,60 @@
+import pytest
+
+import bot.ratings as ratings
+
+from bot.models import Conversation, Person, ProductRating, ProductRatingDay, Review
+from datetime import date, datetime
+
+
+@pytest.fixture(scope='function', autouse=True)
+def clear_database():
+    try:
+        yield
+    finally:
+        ProductRatingDay.delete().execute()
+        ProductRating.delete().execute()
+        Review.delete().execute()
+        Conversation.delete().execute()
+        Person.delete().execute()
+
+
+def test_star_bucket__rounds_half_up_and_clamps():
+    assert ratings.star_bucket(1.2) == 1
+    assert ratings.star_bucket(2.5) == 3
+    assert ratings.star_bucket(4.49) == 4
+    assert ratings.star_bucket(5.0) == 5
+
+
+def test_get_product_rating__none_without_reviews():
+    assert ratings.get_product_rating(1) is None
+
+
+def test_get_product_rating__summarizes_recorded_reviews():
+    ratings.record_review(1, 5.0, datetime(2022, 10, 20, 12))
+    ratings.record_review(1, 3.0, datetime(2022, 10, 1, 12))
+    ratings.record_review(1, 1.0, datetime(2022, 8, 1, 12))
+    ratings.record_review(2, 4.0, datetime(2022, 10, 20, 12))
+
+    rating = ratings.get_product_rating(1, today=date(2022, 10, 20))
+
+    assert rating['review_count'] == 3
+    assert rating['average_stars'] == pytest.approx(3.0)
+    assert rating['stddev_stars'] == pytest.approx((8 / 3) ** 0.5)
+    assert rating['histogram'] == {'1': 1, '2': 0, '3': 1, '4': 0, '5': 1}
+    assert rating['last_review_at'] == datetime(2022, 10, 20, 12).isoformat()
+    assert rating['rolling']['7d'] == {'review_count': 1, 'average_stars': pytest.approx(5.0)}
+    assert rating['rolling']['30d'] == {'review_count': 2, 'average_stars': pytest.approx(4.0)}
+
+
+def test_rebuild__matches_incremental_aggregates():
+    person = Person.create(id=1, first_name='Jane', last_name='Doe', created_at=datetime.now())
+    convo = Conversation.create(person=person, started_at=datetime.now())
+    for stars, created_at in [(4.5, datetime(2022, 10, 20, 12)), (2.25, datetime(2022, 10, 19, 12))]:
+        Review.create(conversation_id=convo.id, person=person, product_id=7, created_at=created_at,
+            estimated_review_stars=stars, raw_message='review')
+        ratings.record_review(7, stars, created_at)
+    incremental = ratings.get_product_rating(7, today=date(2022, 10, 20))
+
+    ratings.rebuild()
+
+    assert ratings.get_product_rating(7, today=date(2022, 10, 20)) == incremental
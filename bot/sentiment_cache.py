@@ -0,0 +1,133 @@
+import asyncio
+import hashlib
+import re
+
+from collections import OrderedDict
+from dataclasses import asdict, dataclass
+from datetime import datetime
+from typing import Awaitable, Callable, Dict, Optional
+
+import bot.db_service as db
+import bot.metrics as metrics
+
+from bot.models import SentimentCacheEntry
+from bot.settings import INFERENCE_BACKEND, SENTIMENT_CACHE_PERSISTENT, SENTIMENT_CACHE_SIZE
+
+
+_WHITESPACE = re.compile(r'\s+')
+
+
+def normalize_text(text: str) -> str:
+    # The model is uncased, so case and whitespace differences don't change its output.
+    return _WHITESPACE.sub(' ', text).strip().lower()
+
+
+# Part of every key. Bumped to 2 when lexicon estimates stopped being cached, so rows that may hold
+# them are never read.
+KEY_VERSION = 2
+
+
+def text_hash(text: str, backend: str = INFERENCE_BACKEND) -> str:
+    """
+    Cache key for a review text. Includes the inference backend, whose scores differ slightly.
+    """
+    return hashlib.sha256(('v%s:%s:%s' % (KEY_VERSION, backend, normalize_text(text))).encode()).hexdigest()
+
+
+@dataclass
+class SentimentCacheStats:
+    memory_hits: int = 0
+    persistent_hits: int = 0
+    misses: int = 0
+
+
+class SentimentCache:
+    """
+    Two-tier cache of weighted star scores keyed by text_hash(): a size-bounded LRU in process,
+    optionally backed by the sentiment_cache table shared by every worker. Concurrent lookups of the
+    same uncached text share a single computation.
+    """
+
+    def __init__(self, max_size: int = SENTIMENT_CACHE_SIZE, persistent: bool = SENTIMENT_CACHE_PERSISTENT):
+        self._max_size = max_size
+        self._persistent = persistent
+        self._memory: 'OrderedDict[str, float]' = OrderedDict()
+        self._in_flight: Dict[str, asyncio.Future] = {}
+        self.stats = SentimentCacheStats()
+
+    async def get_or_compute(self, text: str, compute: Callable[[str], Awaitable[float]]) -> float:
+        key = text_hash(text)
+        stars = self._get_memory(key)
+        if stars is not None:
+            self.stats.memory_hits += 1
+            metrics.SENTIMENT_CACHE_LOOKUPS.inc(result='memory')
+            return stars
+        if key in self._in_flight:
+            self.stats.memory_hits += 1
+            metrics.SENTIMENT_CACHE_LOOKUPS.inc(result='memory')
+            return await asyncio.shield(self._in_flight[key])
+
+        future = asyncio.get_running_loop().create_future()
+        self._in_flight[key] = future
+        try:
+            stars = await self._get_persistent(key)
+            if stars is not None:
+                self.stats.persistent_hits += 1
+                metrics.SENTIMENT_CACHE_LOOKUPS.inc(result='persistent')
+            else:
+                self.stats.misses += 1
+                metrics.SENTIMENT_CACHE_LOOKUPS.inc(result='miss')
+                stars = await compute(text)
+                await self._put_persistent(key, stars)
+            self._put_memory(key, stars)
+            future.set_result(stars)
+            return stars
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # Mark the exception as retrieved, it is re-raised here and to any waiters.
+            future.exception()
+            raise
+        finally:
+            del self._in_flight[key]
+
+    def stats_dict(self) -> Dict[str, int]:
+        return asdict(self.stats)
+
+    def _get_memory(self, key: str) -> Optional[float]:
+        stars = self._memory.get(key)
+        if stars is not None:
+            self._memory.move_to_end(key)
+        return stars
+
+    def _put_memory(self, key: str, stars: float) -> None:
+        self._memory[key] = stars
+        self._memory.move_to_end(key)
+        if len(self._memory) > self._max_size:
+            self._memory.popitem(last=False)
+
+    async def _get_persistent(self, key: str) -> Optional[float]:
+        if not self._persistent:
+            return None
+        entry = await db.run(SentimentCacheEntry.get_or_none, SentimentCacheEntry.text_hash == key)
+        return entry.estimated_review_stars if entry is not None else None
+
+    async def _put_persistent(self, key: str, stars: float) -> None:
+        if not self._persistent:
+            return
+        query = (SentimentCacheEntry
+            .insert(text_hash=key, estimated_review_stars=stars, created_at=datetime.now())
+            .on_conflict_ignore())
+        await db.run(query.execute)
+
+
+_cache: Optional[SentimentCache] = None
+
+
+def get_sentiment_cache() -> SentimentCache:
+    global _cache
+    if _cache is None:
+        _cache = SentimentCache()
+    return _cache
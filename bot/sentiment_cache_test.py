@@ -0,0 +1,87 @@
+import asyncio
+import pytest
+
+import bot.metrics as metrics
+
+from bot.models import SentimentCacheEntry
+from bot.sentiment_cache import SentimentCache, normalize_text, text_hash
+from typing import List
+
+
+@pytest.fixture(scope='function', autouse=True)
+def clear_database():
+    try:
+        yield
+    finally:
+        SentimentCacheEntry.delete().execute()
+
+
+class FakeClassifier:
+
+    def __init__(self):
+        self.texts: List[str] = []
+
+    async def __call__(self, text: str) -> float:
+        self.texts.append(text)
+        await asyncio.sleep(0)
+        return float(len(text))
+
+
+def test_normalize_text():
+    assert normalize_text('  Good   service\nThanks ') == 'good service thanks'
+    assert text_hash('Great!') == text_hash(' great! ')
+    assert text_hash('Great!', backend='fp32') != text_hash('Great!', backend='int8')
+
+
+def test_memory_tier__skips_repeated_texts():
+    cache = SentimentCache(max_size=10, persistent=False)
+    classifier = FakeClassifier()
+    memory_hits = metrics.SENTIMENT_CACHE_LOOKUPS.value(result='memory')
+    misses = metrics.SENTIMENT_CACHE_LOOKUPS.value(result='miss')
+
+    async def run():
+        return [await cache.get_or_compute(text, classifier) for text in ['great', 'GREAT ', 'good']]
+
+    assert asyncio.run(run()) == [5.0, 5.0, 4.0]
+    assert classifier.texts == ['great', 'good']
+    assert cache.stats_dict() == {'memory_hits': 1, 'persistent_hits': 0, 'misses': 2}
+    assert metrics.SENTIMENT_CACHE_LOOKUPS.value(result='memory') == memory_hits + 1
+    assert metrics.SENTIMENT_CACHE_LOOKUPS.value(result='miss') == misses + 2
+
+
+def test_memory_tier__coalesces_concurrent_misses():
+    cache = SentimentCache(max_size=10, persistent=False)
+    classifier = FakeClassifier()
+
+    async def run():
+        return await asyncio.gather(*[cache.get_or_compute('great', classifier) for _ in range(5)])
+
+    assert asyncio.run(run()) == [5.0] * 5
+    assert classifier.texts == ['great']
+
+
+def test_memory_tier__evicts_least_recently_used():
+    cache = SentimentCache(max_size=1, persistent=False)
+    classifier = FakeClassifier()
+
+    async def run():
+        for text in ['great', 'good', 'great']:
+            await cache.get_or_compute(text, classifier)
+
+    asyncio.run(run())
+    assert classifier.texts == ['great', 'good', 'great']
+
+
+def test_persistent_tier__shared_between_caches():
+    classifier = FakeClassifier()
+
+    async def run():
+        await SentimentCache(persistent=True).get_or_compute('no complaints', classifier)
+        other = SentimentCache(persistent=True)
+        stars = await other.get_or_compute('no complaints', classifier)
+        return stars, other
+
+    stars, other = asyncio.run(run())
+    assert stars == 13.0
+    assert classifier.texts == ['no complaints']
+    assert other.stats.persistent_hits == 1
@@ -0,0 +1,201 @@
+"""
+Tunable runtime settings, read from the environment with sensible defaults.
+Secrets and connection parameters live in bot.constants.
+"""
+import os
+
+
+def _env_int(name: str, default: int) -> int:
+    return int(os.environ.get(name, default))
+
+
+def _env_float(name: str, default: float) -> float:
+    return float(os.environ.get(name, default))
+
+
+def _env_bool(name: str, default: bool) -> bool:
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ('1', 'true', 'yes', 'on')
+
+
+def _env_str(name: str, default: str) -> str:
+    return os.environ.get(name, default)
+
+
+# Sentiment inference
+INFERENCE_MAX_BATCH_SIZE = _env_int('INFERENCE_MAX_BATCH_SIZE', 16)
+INFERENCE_MAX_WAIT_MS = _env_float('INFERENCE_MAX_WAIT_MS', 10.0)
+# One of bot.inference.INFERENCE_BACKENDS; compare them with scripts/benchmark_inference.py.
+INFERENCE_BACKEND = _env_str('INFERENCE_BACKEND', 'fp32')
+# Intra-op threads used by torch, 0 for torch's default (one per core).
+INFERENCE_NUM_THREADS = _env_int('INFERENCE_NUM_THREADS', 0)
+# Load the model and run a dummy inference when the ASGI app starts, instead of on the first review.
+WARM_UP_CLASSIFIER = _env_bool('WARM_UP_CLASSIFIER', True)
+# Unix socket of the shared inference server (scripts/run_inference_server.py). When set, processes
+# send texts there instead of loading the model themselves; when empty, inference runs in process.
+INFERENCE_SOCKET = _env_str('INFERENCE_SOCKET', '')
+# Longest a process waits for the inference server to score a text.
+INFERENCE_REQUEST_TIMEOUT_SECS = _env_float('INFERENCE_REQUEST_TIMEOUT_SECS', 30.0)
+# Texts the inference server queues at once, across every client; beyond that requests are rejected.
+INFERENCE_SERVER_MAX_PENDING = _env_int('INFERENCE_SERVER_MAX_PENDING', 256)
+# Hypercorn worker processes. Only raise this with INFERENCE_SOCKET set, or each worker loads its own model,
+# and with CONVERSATION_STATE_ENABLED off: hypercorn refuses to start with both.
+HYPERCORN_WORKERS = _env_int('HYPERCORN_WORKERS', 1)
+
+# Product catalog
+PRODUCTS_URL = _env_str('PRODUCTS_URL', 'https://62daf70dd1d97b9e0c49ca5d.mockapi.io/v1/products')
+PRODUCT_CATALOG_TTL_SECS = _env_float('PRODUCT_CATALOG_TTL_SECS', 300.0)
+PRODUCT_CATALOG_RETRY_SECS = _env_float('PRODUCT_CATALOG_RETRY_SECS', 30.0)
+
+# Graph API
+GRAPH_API_BASE_URL = _env_str('GRAPH_API_BASE_URL', 'https://graph.facebook.com')
+GRAPH_API_MAX_CONNECTIONS = _env_int('GRAPH_API_MAX_CONNECTIONS', 32)
+GRAPH_API_MAX_CONNECTIONS_PER_HOST = _env_int('GRAPH_API_MAX_CONNECTIONS_PER_HOST', 16)
+GRAPH_API_TIMEOUT_SECS = _env_float('GRAPH_API_TIMEOUT_SECS', 3.0)
+
+# Outbound Send API delivery, see bot.outbound
+# Send API calls per second and burst, per process: divide the page's limit between worker processes.
+OUTBOUND_RATE_PER_SEC = _env_float('OUTBOUND_RATE_PER_SEC', 100.0)
+OUTBOUND_BURST = _env_float('OUTBOUND_BURST', 100.0)
+# Queued messages sent together in one Graph API batch request (at most 50).
+OUTBOUND_BATCH_SIZE = _env_int('OUTBOUND_BATCH_SIZE', 50)
+# Longest a message waits for others to share its batch request.
+OUTBOUND_BATCH_WAIT_MS = _env_float('OUTBOUND_BATCH_WAIT_MS', 20.0)
+# Attempts per message on 5xx, 429 and throttling errors, with jittered exponential backoff in between.
+OUTBOUND_MAX_ATTEMPTS = _env_int('OUTBOUND_MAX_ATTEMPTS', 5)
+OUTBOUND_BACKOFF_BASE_SECS = _env_float('OUTBOUND_BACKOFF_BASE_SECS', 0.5)
+OUTBOUND_BACKOFF_MAX_SECS = _env_float('OUTBOUND_BACKOFF_MAX_SECS', 30.0)
+# Messages waiting to be sent; senders wait while it is full.
+OUTBOUND_QUEUE_SIZE = _env_int('OUTBOUND_QUEUE_SIZE', 10000)
+
+# Profile enrichment of new senders, see bot.profiles
+# Persons are created without names; their profiles are fetched in the background, in Graph API
+# batch requests of up to PROFILE_BATCH_SIZE (at most 50) ids.
+PROFILE_BATCH_SIZE = _env_int('PROFILE_BATCH_SIZE', 50)
+# Longest a new sender's id waits for others to share its batch request.
+PROFILE_BATCH_WAIT_MS = _env_float('PROFILE_BATCH_WAIT_MS', 200.0)
+# Batch requests in flight at once.
+PROFILE_FETCH_CONCURRENCY = _env_int('PROFILE_FETCH_CONCURRENCY', 4)
+# Attempts per profile on 5xx, 429 and throttling errors, with jittered exponential backoff in between.
+PROFILE_MAX_ATTEMPTS = _env_int('PROFILE_MAX_ATTEMPTS', 4)
+PROFILE_BACKOFF_BASE_SECS = _env_float('PROFILE_BACKOFF_BASE_SECS', 1.0)
+PROFILE_BACKOFF_MAX_SECS = _env_float('PROFILE_BACKOFF_MAX_SECS', 60.0)
+# Fetched profiles kept in process.
+PROFILE_CACHE_SIZE = _env_int('PROFILE_CACHE_SIZE', 10000)
+# Ids waiting to be fetched; further ids are dropped, and fetched on demand when their name is needed.
+PROFILE_QUEUE_SIZE = _env_int('PROFILE_QUEUE_SIZE', 10000)
+
+# Webhook job queue
+# When enabled the webhook only enqueues incoming messages, and consumers process them in the background.
+WEBHOOK_QUEUE_ENABLED = _env_bool('WEBHOOK_QUEUE_ENABLED', True)
+# Handle each webhook delivery, or each batch of claimed jobs, together: bulk conversation loads,
+# one classifier batch, one transaction, and concurrent replies.
+WEBHOOK_BATCH_MODE = _env_bool('WEBHOOK_BATCH_MODE', False)
+WEBHOOK_QUEUE_CONSUMERS = _env_int('WEBHOOK_QUEUE_CONSUMERS', 4)
+WEBHOOK_QUEUE_BATCH_SIZE = _env_int('WEBHOOK_QUEUE_BATCH_SIZE', 16)
+WEBHOOK_QUEUE_POLL_INTERVAL_SECS = _env_float('WEBHOOK_QUEUE_POLL_INTERVAL_SECS', 0.5)
+WEBHOOK_QUEUE_VISIBILITY_TIMEOUT_SECS = _env_float('WEBHOOK_QUEUE_VISIBILITY_TIMEOUT_SECS', 60.0)
+WEBHOOK_QUEUE_MAX_ATTEMPTS = _env_int('WEBHOOK_QUEUE_MAX_ATTEMPTS', 5)
+WEBHOOK_QUEUE_RETRY_DELAY_SECS = _env_float('WEBHOOK_QUEUE_RETRY_DELAY_SECS', 5.0)
+
+# Per-sender message dispatcher
+DISPATCHER_SHARDS = _env_int('DISPATCHER_SHARDS', 16)
+DISPATCHER_SHARD_QUEUE_SIZE = _env_int('DISPATCHER_SHARD_QUEUE_SIZE', 64)
+
+# Proactive review campaigns
+CAMPAIGN_BATCH_SIZE = _env_int('CAMPAIGN_BATCH_SIZE', 500)
+CAMPAIGN_CONCURRENCY = _env_int('CAMPAIGN_CONCURRENCY', 16)
+CAMPAIGN_RATE_PER_SEC = _env_float('CAMPAIGN_RATE_PER_SEC', 50.0)
+
+# Follow-ups of stalled conversations, see bot.followups
+FOLLOWUPS_ENABLED = _env_bool('FOLLOWUPS_ENABLED', False)
+# A conversation is followed up once it has waited this long for a product selection or a review.
+FOLLOWUP_DELAY_SECS = _env_float('FOLLOWUP_DELAY_SECS', 6 * 60 * 60)
+# Conversations stalled for longer are marked as followed up without a message: Messenger only
+# allows messages within 24 hours of the person's last one.
+FOLLOWUP_MAX_AGE_SECS = _env_float('FOLLOWUP_MAX_AGE_SECS', 23 * 60 * 60)
+# Due conversations claimed per query, and follow-ups being sent at once.
+FOLLOWUP_BATCH_SIZE = _env_int('FOLLOWUP_BATCH_SIZE', 100)
+FOLLOWUP_CONCURRENCY = _env_int('FOLLOWUP_CONCURRENCY', 16)
+# How often each app process looks for due conversations once it has caught up.
+FOLLOWUP_POLL_INTERVAL_SECS = _env_float('FOLLOWUP_POLL_INTERVAL_SECS', 60.0)
+
+# In-memory conversation state with write-behind persistence, see bot.conversation_state
+# Only enable with a single app process handling messages: changes other processes make to a held
+# conversation go unseen until its state expires. Requires HYPERCORN_WORKERS=1.
+CONVERSATION_STATE_ENABLED = _env_bool('CONVERSATION_STATE_ENABLED', False)
+# Conversations held, least recently active evicted first.
+CONVERSATION_STATE_SIZE = _env_int('CONVERSATION_STATE_SIZE', 10000)
+# Longest a transition waits to be written; a crash loses at most this much. With the webhook queue,
+# jobs are only deleted once their transitions are written, so their messages are handled again.
+CONVERSATION_STATE_FLUSH_DELAY_MS = _env_float('CONVERSATION_STATE_FLUSH_DELAY_MS', 100.0)
+# Held states are reloaded from the database once this old.
+CONVERSATION_STATE_TTL_SECS = _env_float('CONVERSATION_STATE_TTL_SECS', 300.0)
+
+# Redelivered webhook deduplication
+DEDUP_CACHE_SIZE = _env_int('DEDUP_CACHE_SIZE', 100000)
+# Accepted message ids are kept this long, comfortably past Messenger's retries of a failed delivery.
+DEDUP_RETENTION_SECS = _env_float('DEDUP_RETENTION_SECS', 3 * 24 * 60 * 60)
+# How often each app process deletes the ids older than that.
+DEDUP_PRUNE_INTERVAL_SECS = _env_float('DEDUP_PRUNE_INTERVAL_SECS', 60 * 60)
+
+# Sentiment result cache
+SENTIMENT_CACHE_SIZE = _env_int('SENTIMENT_CACHE_SIZE', 10000)
+# Also share cached scores between workers through the sentiment_cache table.
+SENTIMENT_CACHE_PERSISTENT = _env_bool('SENTIMENT_CACHE_PERSISTENT', False)
+
+# Lexicon fast path in front of the sentiment model. Calibrate with scripts/calibrate_fast_sentiment.py before enabling.
+FAST_SENTIMENT_ENABLED = _env_bool('FAST_SENTIMENT_ENABLED', False)
+FAST_SENTIMENT_CONFIDENCE_THRESHOLD = _env_float('FAST_SENTIMENT_CONFIDENCE_THRESHOLD', 0.9)
+# Longer texts always go to the model.
+FAST_SENTIMENT_MAX_LENGTH = _env_int('FAST_SENTIMENT_MAX_LENGTH', 80)
+FAST_SENTIMENT_SLOPE = _env_float('FAST_SENTIMENT_SLOPE', 1.0)
+FAST_SENTIMENT_INTERCEPT = _env_float('FAST_SENTIMENT_INTERCEPT', 0.0)
+
+# Streaming review export
+# Rows fetched from the server-side cursor per round trip.
+EXPORT_CURSOR_ARRAY_SIZE = _env_int('EXPORT_CURSOR_ARRAY_SIZE', 2000)
+# Rows encoded into each chunk written to the output or response.
+EXPORT_CHUNK_ROWS = _env_int('EXPORT_CHUNK_ROWS', 500)
+# Encoded chunks buffered between the export's DB thread and a slow HTTP client.
+EXPORT_STREAM_QUEUE_SIZE = _env_int('EXPORT_STREAM_QUEUE_SIZE', 8)
+# Exports streamed at once, each holding a DB thread and connection throughout; others wait.
+EXPORT_MAX_CONCURRENT = _env_int('EXPORT_MAX_CONCURRENT', 2)
+# Bearer token required by GET /exports/reviews. The route is disabled while this is empty.
+EXPORT_API_TOKEN = _env_str('EXPORT_API_TOKEN', '')
+
+# Prometheus metrics on GET /metrics. When disabled, stage timing is skipped entirely.
+METRICS_ENABLED = _env_bool('METRICS_ENABLED', True)
+
+# Structured logging
+LOG_LEVEL = _env_str('LOG_LEVEL', 'INFO')
+# Fraction of each event type to keep, as "event=rate,...". Warnings and errors are always kept.
+LOG_SAMPLE_RATES = _env_str('LOG_SAMPLE_RATES', 'webhook.received=0.01,message.sent=0.1,profile.fetched=0.1')
+LOG_DEFAULT_SAMPLE_RATE = _env_float('LOG_DEFAULT_SAMPLE_RATE', 1.0)
+# Longer string fields are truncated.
+LOG_MAX_FIELD_LENGTH = _env_int('LOG_MAX_FIELD_LENGTH', 500)
+# Comma separated field names whose values are never written.
+LOG_REDACT_FIELDS = _env_str('LOG_REDACT_FIELDS', 'access_token,first_name,last_name')
+# Records buffered for the writer thread; further records are dropped until it catches up.
+LOG_QUEUE_SIZE = _env_int('LOG_QUEUE_SIZE', 10000)
+
+# Database access from the event loop, through bot.db_service.run (one thread per pooled connection)
+# Longest a DB call waits for a free connection before raising DbQueueTimeout.
+DB_QUEUE_TIMEOUT_SECS = _env_float('DB_QUEUE_TIMEOUT_SECS', 5.0)
+# DB calls allowed to wait for a connection at once; further calls fail immediately.
+DB_MAX_QUEUED = _env_int('DB_MAX_QUEUED', 1000)
+# Longest code outside the DB threads (scripts) waits for a pooled connection.
+DB_POOL_WAIT_SECS = _env_float('DB_POOL_WAIT_SECS', 10.0)
+
+# Monthly partitions of reviews and conversations, see bot.partitions
+# Months of partitions created ahead of the current one.
+PARTITION_PREMAKE_MONTHS = _env_int('PARTITION_PREMAKE_MONTHS', 3)
+# How often each app process creates upcoming partitions.
+PARTITION_MAINTENANCE_INTERVAL_SECS = _env_float('PARTITION_MAINTENANCE_INTERVAL_SECS', 6 * 60 * 60)
+# Longest archival waits for the table lock needed to detach a partition.
+PARTITION_LOCK_TIMEOUT_SECS = _env_int('PARTITION_LOCK_TIMEOUT_SECS', 5)
+# scripts/archive_partitions.py archives partitions older than this many whole months, into ARCHIVE_DIR.
+ARCHIVE_RETENTION_MONTHS = _env_int('ARCHIVE_RETENTION_MONTHS', 12)
+ARCHIVE_DIR = _env_str('ARCHIVE_DIR', 'archive')
@@ -1,6 +1,13 @@
+import asyncio
 import hashlib
 import hmac
 import json
+import bot.db_service as db
+import bot.dedup as dedup
+import bot.dispatcher as dispatcher
+import bot.job_queue as job_queue
+import bot.log as log
+import bot.metrics as metrics
 import bot.messaging_service as messaging
 
 from quart import Response, request
@@ -9,38 +16,87 @@ from bot.constants import (
     APP_SECRET,
     VERIFY_TOKEN
 )
+from bot.settings import WEBHOOK_BATCH_MODE, WEBHOOK_QUEUE_ENABLED
+from typing import List
 
 
 async def post() -> Response:
     payload = await request.get_data()
-    if not validate_payload(payload):
+    with metrics.time_stage('verify_signature'):
+        valid = validate_payload(payload)
+    if not valid:
         return 'FORBIDDEN', 403
 
     verification_response = handle_verification_request(request.args)
     if verification_response is not None:
         return verification_response
 
-    json_payload = json.loads(payload)
+    with metrics.time_stage('parse_payload'):
+        json_payload = json.loads(payload)
     if json_payload['object'] == 'page':
-        print(json_payload)
         if 'entry' not in json_payload:
             return 'INVALID', 400
+        messages = []
         for entry in json_payload['entry']:
             if 'messaging' not in entry:
                 return 'INVALID', 400
             for message_entry in entry['messaging']:
                 try:
-                    message = messaging.IncomingMessage.from_json(message_entry)
+                    messages.append(messaging.IncomingMessage.from_json(message_entry))
                 except Exception as e:
-                    print('Error parsing message [%s]' % e)
+                    log.warning('webhook.invalid_message', error=str(e), message=message_entry)
                     return 'INVALID', 400
-                messaging.handle_incoming_message(message)
+        log.event('webhook.received', message_ids=[message.message_id for message in messages], payload=json_payload)
+        if WEBHOOK_QUEUE_ENABLED:
+            if await db.run(enqueue_new_messages, messages):
+                job_queue.notify_consumers()
+        else:
+            await handle_new_messages(messages)
         return 'EVENT_RECIEVED', 200
     else:
-        print('Unexpected webhook type %s' % payload['page'])
+        log.warning('webhook.unexpected_object', object=json_payload['object'])
         return 'UNKNOWN', 404
     
 
+# Acknowledge as soon as the messages are durably queued; consumers do the actual work.
+# Redelivered messages are dropped, and the claim and the jobs are committed together.
+# Runs on a DB thread; returns the messages that were enqueued.
+def enqueue_new_messages(messages: List[messaging.IncomingMessage]) -> List[messaging.IncomingMessage]:
+    deduplicator = dedup.get_deduplicator()
+    new_messages: List[messaging.IncomingMessage] = []
+    try:
+        with db.atomic():
+            new_messages = deduplicator.filter_new(messages)
+            job_queue.enqueue_messages(new_messages)
+    except Exception:
+        deduplicator.forget_recent(new_messages)
+        raise
+    return new_messages
+
+
+# Handle messages before acknowledging them, dropping redelivered ones.
+# Submit in delivery order so each sender's messages stay ordered; senders run in parallel.
+# In batch mode the whole delivery is handled together instead, and fails or succeeds as a whole.
+async def handle_new_messages(messages: List[messaging.IncomingMessage]) -> None:
+    deduplicator = dedup.get_deduplicator()
+    messages = await db.run(deduplicator.filter_new, messages)
+    if WEBHOOK_BATCH_MODE:
+        try:
+            await messaging.handle_incoming_messages(messages)
+        except Exception:
+            await db.run(deduplicator.forget, messages)
+            raise
+        return
+    message_dispatcher = dispatcher.get_dispatcher()
+    handled = [await message_dispatcher.submit(message) for message in messages]
+    results = await asyncio.gather(*handled, return_exceptions=True)
+    errors = [result for result in results if isinstance(result, Exception)]
+    if errors:
+        # Let Messenger redeliver the messages that failed.
+        await db.run(deduplicator.forget, [message for message, result in zip(messages, results) if isinstance(result, Exception)])
+        raise errors[0]
+
+
 # Check the HMAC signature to ensure this webhook was signed with our app's secret key
 def validate_payload(payload) -> bool:
     hash_header = request.headers['X-Hub-Signature-256']
@@ -0,0 +1,35 @@
+#!/usr/local/bin/python
+
+import argparse
+import bot.models as models
+import bot.partitions as partitions
+import sys
+
+from datetime import date
+
+from bot.settings import ARCHIVE_DIR, ARCHIVE_RETENTION_MONTHS
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Detach the monthly partitions of reviews and conversations older than the retention period, '
+            'export each to a gzipped CSV file and drop it.')
+    parser.add_argument('--retention-months', type=int, default=ARCHIVE_RETENTION_MONTHS,
+        help='Keep this many whole months before the current one.')
+    parser.add_argument('--directory', default=ARCHIVE_DIR, help='Where to write <partition>.csv.gz files.')
+    parser.add_argument('--dry-run', action='store_true', help='Only list the partitions that would be archived.')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    before = partitions.add_months(partitions.month_start(date.today()), -args.retention_months)
+    for model in models.PARTITIONED_MODELS:
+        archived = partitions.archive_partitions(model, before, args.directory, dry_run=args.dry_run)
+        print('%s %s partitions of %s from before %s: %s' % (
+            'Would archive' if args.dry_run else 'Archived', len(archived), model._meta.table_name,
+            before.isoformat(), ', '.join(archived) or '-'))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,148 @@
+#!/usr/local/bin/python
+
+"""
+Compare sentiment inference backends on a sample review corpus.
+
+Each backend/thread-count configuration runs in its own subprocess so that model memory and torch's
+process-wide thread setting don't leak between runs. For each configuration we report load time,
+single-review latency, batched throughput, resident memory, and how far its weighted star scores
+drift from the fp32 scores on the same texts.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+from typing import Dict, List
+
+SAMPLE_REVIEWS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sample_reviews.txt')
+
+
+def read_corpus(path: str) -> List[str]:
+    with open(path) as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def percentile(values: List[float], pct: float) -> float:
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100.0 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def resident_memory_mb() -> float:
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) / 1024.0
+    return 0.0
+
+
+def run_worker(backend: str, threads: int, corpus_path: str, batch_size: int, repeats: int) -> Dict:
+    import bot.inference as inference
+
+    texts = read_corpus(corpus_path)
+
+    started = time.perf_counter()
+    classifier = inference.load_sentiment_classifier(backend, threads)
+    inference.classify_batch(texts[:1], classifier)  # The first forward pass is much slower than the rest.
+    load_secs = time.perf_counter() - started
+
+    latencies = []
+    for _ in range(repeats):
+        for text in texts:
+            started = time.perf_counter()
+            inference.classify_batch([text], classifier)
+            latencies.append((time.perf_counter() - started) * 1000.0)
+
+    scores: List[float] = []
+    started = time.perf_counter()
+    for _ in range(repeats):
+        scores = []
+        for i in range(0, len(texts), batch_size):
+            batch = inference.classify_batch(texts[i:i + batch_size], classifier)
+            scores.extend(inference.weighted_stars(label_scores) for label_scores in batch)
+    batched_secs = time.perf_counter() - started
+
+    return {
+        'backend': backend,
+        'threads': threads,
+        'load_secs': load_secs,
+        'latency_p50_ms': percentile(latencies, 50),
+        'latency_p95_ms': percentile(latencies, 95),
+        'latency_p99_ms': percentile(latencies, 99),
+        'throughput_per_sec': len(texts) * repeats / batched_secs,
+        'rss_mb': resident_memory_mb(),
+        'scores': scores,
+    }
+
+
+def run_configuration(args, backend: str, threads: int) -> Dict:
+    command = [
+        sys.executable, os.path.abspath(__file__), '--worker',
+        '--backends', backend,
+        '--threads', str(threads),
+        '--corpus', args.corpus,
+        '--batch-size', str(args.batch_size),
+        '--repeats', str(args.repeats),
+    ]
+    output = subprocess.run(command, check=True, stdout=subprocess.PIPE, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def report(results: List[Dict], max_drift: float) -> None:
+    reference = next((r['scores'] for r in results if r['backend'] == 'fp32'), None)
+    header = '%-8s %7s %8s %9s %9s %9s %10s %8s %10s %10s' % (
+        'backend', 'threads', 'load_s', 'p50_ms', 'p95_ms', 'p99_ms', 'reviews/s', 'rss_mb', 'mean_drift', 'max_drift')
+    print(header)
+    print('-' * len(header))
+    acceptable = []
+    for r in results:
+        if reference is not None:
+            drifts = [abs(a - b) for a, b in zip(r['scores'], reference)]
+            r['mean_drift'], r['max_drift'] = statistics.mean(drifts), max(drifts)
+        else:
+            r['mean_drift'] = r['max_drift'] = float('nan')
+        print('%-8s %7s %8.2f %9.1f %9.1f %9.1f %10.1f %8.0f %10.4f %10.4f' % (
+            r['backend'], r['threads'] or 'default', r['load_secs'], r['latency_p50_ms'], r['latency_p95_ms'],
+            r['latency_p99_ms'], r['throughput_per_sec'], r['rss_mb'], r['mean_drift'], r['max_drift']))
+        if r['max_drift'] <= max_drift:
+            acceptable.append(r)
+    if reference is None:
+        print('\nInclude the fp32 backend to measure drift.')
+    elif acceptable:
+        best = max(acceptable, key=lambda r: r['throughput_per_sec'])
+        print('\nFastest within max drift %.3f stars: INFERENCE_BACKEND=%s INFERENCE_NUM_THREADS=%s' % (
+            max_drift, best['backend'], best['threads']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark sentiment inference backends.')
+    parser.add_argument('--backends', default='fp32,int8', help='Comma separated list of backends to compare.')
+    parser.add_argument('--threads', default='0', help='Comma separated list of intra-op thread counts, 0 for the torch default.')
+    parser.add_argument('--corpus', default=SAMPLE_REVIEWS_PATH, help='Review texts, one per line.')
+    parser.add_argument('--batch-size', type=int, default=16)
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--max-drift', type=float, default=0.1, help='Largest acceptable star score difference from fp32.')
+    parser.add_argument('--output', help='Also write the raw results to this JSON file.')
+    parser.add_argument('--worker', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    backends = args.backends.split(',')
+    thread_counts = [int(threads) for threads in args.threads.split(',')]
+    if args.worker:
+        print(json.dumps(run_worker(backends[0], thread_counts[0], args.corpus, args.batch_size, args.repeats)))
+        return 0
+
+    results = [run_configuration(args, backend, threads) for backend in backends for threads in thread_counts]
+    report(results, args.max_drift)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,450 @@
+#!/usr/local/bin/python
+
+"""
+Load-test the webhook end to end with simulated review conversations.
+
+Each simulated person walks through a whole conversation (thank the page, pick a product, send a
+review), sending one correctly signed webhook per step and waiting for the bot's reply before the
+next step. The Graph API and the product API are replaced by local stub servers with configurable
+latency, and the classifier is either the real model or a stub with a fixed latency per batch.
+
+The app runs in-process through Quart's test client, or under hypercorn in a subprocess. Its tables
+live in a separate "benchmark" schema that is dropped afterwards. For each step we report p50, p95
+and p99 of the acknowledgement latency (the webhook POST) and of the reply latency (from the POST to
+the reply reaching the stub Send API), and overall throughput. Results can be saved as JSON and
+compared against a previous run with --baseline.
+"""
+
+import argparse
+import asyncio
+import hashlib
+import hmac
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Optional, Tuple
+from urllib.parse import parse_qs
+
+BENCHMARK_SCHEMA = 'benchmark'
+PAGE_ID = 1000
+PRODUCTS = [
+    {'id': str(i), 'productName': 'Product %s' % i, 'manufacturer': 'Maker %s' % i, 'vehicle': 'Vehicle %s' % i}
+    for i in range(1, 6)
+]
+REVIEWS = [
+    'The car was great, the staff were friendly and it was a smooth process overall',
+    'Terrible experience, the vehicle broke down twice in the first week',
+    'It was okay, nothing special but it did the job',
+    'Absolutely loved it, would recommend to anyone looking for a reliable car',
+    'Slow service and the car was not what was advertised',
+]
+STEPS = ('greeting', 'select_product', 'review')
+
+
+class StubServer(ThreadingHTTPServer):
+    """
+    Stand-in for the Graph API (profile and Send API) and the product API, answering after a fixed delay.
+    """
+
+    def __init__(self, latency_secs: float, on_message: Optional[Callable[[int, str], None]] = None):
+        super().__init__(('127.0.0.1', 0), StubHandler)
+        self.latency_secs = latency_secs
+        self.on_message = on_message
+
+    @property
+    def url(self) -> str:
+        return 'http://127.0.0.1:%s' % self.server_address[1]
+
+    def start(self) -> 'StubServer':
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self) -> None:
+        self.shutdown()
+        self.server_close()
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        if self.path.startswith('/products'):
+            self._respond(PRODUCTS)
+        else:
+            self._respond({'first_name': 'Load', 'last_name': 'Test'})
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        if self.path.startswith('/v15.0/me/messages'):
+            payloads = [json.loads(body)]
+            self._respond({'recipient_id': payloads[0]['recipient']['id'], 'message_id': 'stub'})
+        else:
+            # A Graph API batch request: profile lookups, or Send API calls with form encoded bodies of JSON values.
+            calls = json.loads(parse_qs(body.decode())['batch'][0])
+            payloads = []
+            results = []
+            for call in calls:
+                if call['method'] == 'GET':
+                    results.append({'code': 200, 'body': json.dumps({'first_name': 'Load', 'last_name': 'Test'})})
+                    continue
+                fields = parse_qs(call['body'])
+                payload = {'recipient': json.loads(fields['recipient'][0]), 'message': json.loads(fields['message'][0])}
+                payloads.append(payload)
+                results.append({'code': 200, 'body': json.dumps({'recipient_id': payload['recipient']['id'], 'message_id': 'stub'})})
+            self._respond(results)
+        server: StubServer = self.server
+        if server.on_message is not None:
+            for payload in payloads:
+                server.on_message(int(payload['recipient']['id']), payload['message']['text'])
+
+    def _respond(self, obj):
+        time.sleep(self.server.latency_secs)
+        body = json.dumps(obj).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def configure_environment(graph_url: str, products_url: str, args) -> None:
+    # Must run before anything imports bot.settings.
+    os.environ['GRAPH_API_BASE_URL'] = graph_url
+    os.environ['PRODUCTS_URL'] = products_url + '/products'
+    if args.classifier == 'stub':
+        os.environ['WARM_UP_CLASSIFIER'] = '0'
+
+
+def use_benchmark_schema() -> None:
+    import bot.db_service as db
+    import bot.models as models
+
+    db.execute_sql('CREATE SCHEMA IF NOT EXISTS %s;' % BENCHMARK_SCHEMA)
+    for model in models.MODELS:
+        model._meta.schema = BENCHMARK_SCHEMA
+    with db.atomic():
+        models.create_tables()
+
+
+def drop_benchmark_schema() -> None:
+    import bot.db_service as db
+
+    db.execute_sql('DROP SCHEMA IF EXISTS %s CASCADE;' % BENCHMARK_SCHEMA)
+
+
+def install_stub_classifier(latency_secs: float) -> None:
+    """
+    Replace the model with a stub that takes `latency_secs` per batch, behind the real batching engine.
+    """
+    import bot.inference as inference
+
+    def classify_batch(texts: List[str]) -> List[List[Dict]]:
+        time.sleep(latency_secs)
+        return [[{'label': '%s stars' % (len(text) % 5 + 1), 'score': 1.0}] for text in texts]
+
+    inference._engine = inference.BatchingInferenceEngine(classify_batch)
+
+
+def sign(body: bytes, app_secret: str) -> str:
+    # The X-Hub-Signature-256 scheme checked by bot.webhooks.validate_payload.
+    return 'sha256=' + hmac.new(app_secret.encode(), body, hashlib.sha256).hexdigest()
+
+
+def webhook_payload(sender_id: int, message_id: str, text: str) -> bytes:
+    timestamp = int(time.time() * 1000)
+    return json.dumps({
+        'object': 'page',
+        'entry': [{
+            'id': str(PAGE_ID),
+            'time': timestamp,
+            'messaging': [{
+                'sender': {'id': str(sender_id)},
+                'recipient': {'id': str(PAGE_ID)},
+                'timestamp': timestamp,
+                'message': {'mid': message_id, 'text': text},
+            }],
+        }],
+    }).encode()
+
+
+def conversation_messages(index: int) -> List[Tuple[str, str]]:
+    # Review texts are made unique so that the sentiment cache doesn't short-circuit the classifier.
+    review = '%s (order %s)' % (REVIEWS[index % len(REVIEWS)], index)
+    return list(zip(STEPS, ['Thank you!', PRODUCTS[index % len(PRODUCTS)]['id'], review]))
+
+
+class Replies:
+    """
+    Hands replies received by the stub Send API, on a server thread, to the person waiting for them.
+    """
+
+    def __init__(self):
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._waiting: Dict[int, asyncio.Future] = {}
+
+    def expect(self, recipient_id: int) -> asyncio.Future:
+        self._loop = asyncio.get_running_loop()
+        future = self._loop.create_future()
+        self._waiting[recipient_id] = future
+        return future
+
+    def on_message(self, recipient_id: int, text: str) -> None:
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._resolve, recipient_id, text)
+
+    def _resolve(self, recipient_id: int, text: str) -> None:
+        future = self._waiting.pop(recipient_id, None)
+        if future is not None and not future.done():
+            future.set_result(text)
+
+
+class LoadTest:
+
+    def __init__(self, post: Callable, replies: Replies, app_secret: str, args):
+        self._post = post
+        self._replies = replies
+        self._app_secret = app_secret
+        self._args = args
+        self._run_id = random.randrange(1, 10 ** 6)
+        self.ack_ms: Dict[str, List[float]] = {step: [] for step in STEPS}
+        self.reply_ms: Dict[str, List[float]] = {step: [] for step in STEPS}
+        self.errors = 0
+
+    async def run(self) -> float:
+        limit = asyncio.Semaphore(self._args.concurrency)
+
+        async def converse(index: int) -> None:
+            async with limit:
+                await self._converse(index)
+
+        started = time.perf_counter()
+        await asyncio.gather(*[converse(i) for i in range(self._args.conversations)])
+        return time.perf_counter() - started
+
+    async def _converse(self, index: int) -> None:
+        sender_id = self._run_id * 10 ** 7 + index
+        for step, text in conversation_messages(index):
+            body = webhook_payload(sender_id, 'mid.%s.%s.%s' % (self._run_id, index, step), text)
+            headers = {'Content-Type': 'application/json', 'X-Hub-Signature-256': sign(body, self._app_secret)}
+            reply = self._replies.expect(sender_id)
+            started = time.perf_counter()
+            try:
+                status = await self._post(body, headers)
+                self.ack_ms[step].append((time.perf_counter() - started) * 1000.0)
+                if status != 200:
+                    raise RuntimeError('Webhook returned %s' % status)
+                await asyncio.wait_for(reply, self._args.reply_timeout)
+                self.reply_ms[step].append((time.perf_counter() - started) * 1000.0)
+            except Exception as e:
+                self.errors += 1
+                print('Conversation %s failed at %s [%r]' % (index, step, e), file=sys.stderr)
+                return
+
+
+def percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return float('nan')
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100.0 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def summarize(test: LoadTest, elapsed_secs: float, args) -> Dict:
+    stages = {}
+    for step in STEPS:
+        for kind, samples in (('ack', test.ack_ms[step]), ('reply', test.reply_ms[step])):
+            stages['%s.%s' % (step, kind)] = {
+                'count': len(samples),
+                'p50_ms': percentile(samples, 50),
+                'p95_ms': percentile(samples, 95),
+                'p99_ms': percentile(samples, 99),
+            }
+    completed = len(test.reply_ms[STEPS[-1]])
+    messages = sum(len(samples) for samples in test.reply_ms.values())
+    return {
+        'config': {
+            'mode': args.mode,
+            'classifier': args.classifier,
+            'classifier_latency_ms': args.classifier_latency_ms,
+            'graph_latency_ms': args.graph_latency_ms,
+            'products_latency_ms': args.products_latency_ms,
+            'conversations': args.conversations,
+            'concurrency': args.concurrency,
+            'webhook_queue_enabled': os.environ.get('WEBHOOK_QUEUE_ENABLED', 'default'),
+        },
+        'started_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'elapsed_secs': elapsed_secs,
+        'conversations_per_sec': completed / elapsed_secs,
+        'messages_per_sec': messages / elapsed_secs,
+        'errors': test.errors,
+        'stages': stages,
+    }
+
+
+def report(results: Dict, baseline: Optional[Dict]) -> None:
+    print('%s conversations in %.1fs: %.1f conversations/s, %.1f messages/s, %s errors' % (
+        results['config']['conversations'], results['elapsed_secs'], results['conversations_per_sec'],
+        results['messages_per_sec'], results['errors']))
+    header = '%-22s %6s %9s %9s %9s' % ('stage', 'count', 'p50_ms', 'p95_ms', 'p99_ms')
+    if baseline is not None:
+        header += ' %9s %9s' % ('p50_diff', 'p99_diff')
+    print(header)
+    print('-' * len(header))
+    for name, stage in results['stages'].items():
+        line = '%-22s %6s %9.1f %9.1f %9.1f' % (name, stage['count'], stage['p50_ms'], stage['p95_ms'], stage['p99_ms'])
+        previous = (baseline or {}).get('stages', {}).get(name)
+        if previous is not None:
+            line += ' %9s %9s' % (change(previous['p50_ms'], stage['p50_ms']), change(previous['p99_ms'], stage['p99_ms']))
+        print(line)
+    if baseline is not None:
+        print('\nThroughput vs baseline: %s messages/s' % change(baseline['messages_per_sec'], results['messages_per_sec']))
+
+
+def change(before: float, after: float) -> str:
+    if not before or before != before or after != after:
+        return 'n/a'
+    return '%+.1f%%' % ((after - before) / before * 100.0)
+
+
+async def run_in_process(args, replies: Replies) -> Tuple[LoadTest, float]:
+    if args.classifier == 'stub':
+        install_stub_classifier(args.classifier_latency_ms / 1000.0)
+    from bot.asgi import app
+    from bot.constants import APP_SECRET
+
+    async with app.test_app() as test_app:
+        client = test_app.test_client()
+
+        async def post(body: bytes, headers: Dict[str, str]) -> int:
+            response = await client.post('/messenger-webhooks', data=body, headers=headers)
+            return response.status_code
+
+        test = LoadTest(post, replies, APP_SECRET, args)
+        elapsed = await test.run()
+    return test, elapsed
+
+
+async def run_over_hypercorn(args, replies: Replies) -> Tuple[LoadTest, float]:
+    from bot.constants import APP_SECRET
+    from bot.graph_api import GraphApiClient
+
+    port = free_port()
+    command = [
+        sys.executable, os.path.abspath(__file__), '--serve', str(port),
+        '--classifier', args.classifier,
+        '--classifier-latency-ms', str(args.classifier_latency_ms),
+    ]
+    server = subprocess.Popen(command, env=os.environ.copy())
+    client = GraphApiClient(max_connections=args.concurrency, max_connections_per_host=args.concurrency)
+    try:
+        url = 'http://127.0.0.1:%s' % port
+        await wait_until_serving(client, url, server)
+
+        async def post(body: bytes, headers: Dict[str, str]) -> int:
+            response = await client.request('POST', url + '/messenger-webhooks', data=body, headers=headers)
+            return response.status_code
+
+        test = LoadTest(post, replies, APP_SECRET, args)
+        elapsed = await test.run()
+    finally:
+        client.close()
+        server.terminate()
+        server.wait()
+    return test, elapsed
+
+
+async def wait_until_serving(client, url: str, server: subprocess.Popen, timeout_secs: float = 60.0) -> None:
+    deadline = time.monotonic() + timeout_secs
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError('hypercorn exited with %s' % server.returncode)
+        try:
+            if (await client.get(url + '/hello')).status_code == 200:
+                return
+        except Exception:
+            pass
+        await asyncio.sleep(0.2)
+    raise RuntimeError('hypercorn did not start serving within %ss' % timeout_secs)
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def serve(args) -> int:
+    """
+    Run the app under hypercorn, in the subprocess started by run_over_hypercorn().
+    """
+    from hypercorn.asyncio import serve as hypercorn_serve
+    from hypercorn.config import Config
+
+    use_benchmark_schema()
+    if args.classifier == 'stub':
+        install_stub_classifier(args.classifier_latency_ms / 1000.0)
+    from bot.asgi import app
+
+    config = Config()
+    config.bind = ['127.0.0.1:%s' % args.serve]
+    config.worker_class = 'asyncio'
+    asyncio.run(hypercorn_serve(app, config))
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load-test the Messenger webhook end to end.')
+    parser.add_argument('--mode', choices=('inprocess', 'hypercorn'), default='inprocess')
+    parser.add_argument('--conversations', type=int, default=200, help='Number of simulated review conversations.')
+    parser.add_argument('--concurrency', type=int, default=20, help='Conversations in progress at once.')
+    parser.add_argument('--classifier', choices=('stub', 'real'), default='stub')
+    parser.add_argument('--classifier-latency-ms', type=float, default=20.0, help='Latency of each stub classifier batch.')
+    parser.add_argument('--graph-latency-ms', type=float, default=50.0, help='Latency of the stub Graph API.')
+    parser.add_argument('--products-latency-ms', type=float, default=100.0, help='Latency of the stub product API.')
+    parser.add_argument('--reply-timeout', type=float, default=30.0, help='Seconds to wait for each reply.')
+    parser.add_argument('--output', help='Write the results to this JSON file.')
+    parser.add_argument('--baseline', help='Compare against the results JSON of a previous run.')
+    parser.add_argument('--keep-data', action='store_true', help='Keep the benchmark schema after the run.')
+    parser.add_argument('--serve', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve is not None:
+        return serve(args)
+
+    replies = Replies()
+    graph = StubServer(args.graph_latency_ms / 1000.0, replies.on_message).start()
+    products = StubServer(args.products_latency_ms / 1000.0).start()
+    configure_environment(graph.url, products.url, args)
+    try:
+        use_benchmark_schema()
+        run = run_in_process if args.mode == 'inprocess' else run_over_hypercorn
+        test, elapsed = asyncio.run(run(args, replies))
+    finally:
+        graph.stop()
+        products.stop()
+        if not args.keep_data:
+            drop_benchmark_schema()
+
+    results = summarize(test, elapsed, args)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    report(results, baseline)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    return 0 if test.errors == 0 else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
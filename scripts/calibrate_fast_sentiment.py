@@ -0,0 +1,117 @@
+#!/usr/local/bin/python
+
+"""
+Calibrate the lexicon fast path (bot.fast_sentiment) against the sentiment model on stored reviews.
+
+Fits the linear mapping from lexicon polarity to stars by least squares, then reports, for a range
+of confidence thresholds, how many short reviews would take the fast path and how far its stars
+would be from the model's. Prints the settings for the lowest threshold within --max-error.
+"""
+
+import argparse
+import statistics
+import sys
+
+import bot.inference as inference
+
+from bot.fast_sentiment import LexiconSentimentClassifier
+from bot.models import Review
+from bot.settings import FAST_SENTIMENT_MAX_LENGTH
+from typing import Iterator, List, Tuple
+
+THRESHOLDS = [0.5, 0.55, 0.6, 0.65, 0.7, 0.75, 0.8, 0.85, 0.9, 0.95, 1.0]
+
+
+def stored_reviews(limit: int, batch_size: int, use_stored_stars: bool) -> Iterator[Tuple[str, float]]:
+    """
+    Yield (text, model stars) pairs, re-running the model unless --use-stored-stars is given
+    (stored stars may already come from the fast path once it is enabled).
+    """
+    query = Review.select(Review.raw_message, Review.estimated_review_stars).order_by(Review.created_at.desc())
+    if limit > 0:
+        query = query.limit(limit)
+    batch: List[Review] = []
+    for review in query.iterator():
+        batch.append(review)
+        if len(batch) >= batch_size:
+            yield from _model_stars(batch, use_stored_stars)
+            batch = []
+    yield from _model_stars(batch, use_stored_stars)
+
+
+def _model_stars(reviews: List[Review], use_stored_stars: bool) -> Iterator[Tuple[str, float]]:
+    if not reviews:
+        return
+    if use_stored_stars:
+        stars = [float(review.estimated_review_stars) for review in reviews]
+    else:
+        results = inference.classify_batch([review.raw_message for review in reviews])
+        stars = [inference.weighted_stars(label_scores) for label_scores in results]
+    yield from zip([review.raw_message for review in reviews], stars)
+
+
+def fit_line(xs: List[float], ys: List[float]) -> Tuple[float, float]:
+    mean_x, mean_y = statistics.mean(xs), statistics.mean(ys)
+    variance = sum((x - mean_x) ** 2 for x in xs)
+    if variance == 0:
+        return 1.0, mean_y - 3.0 - mean_x
+    slope = sum((x - mean_x) * (y - mean_y) for x, y in zip(xs, ys)) / variance
+    # Predictions are 3 + slope * polarity + intercept.
+    return slope, mean_y - 3.0 - slope * mean_x
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Calibrate the lexicon sentiment fast path against the model.')
+    parser.add_argument('--limit', type=int, default=10000, help='Most recent reviews to use, 0 for all.')
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--max-length', type=int, default=FAST_SENTIMENT_MAX_LENGTH)
+    parser.add_argument('--max-error', type=float, default=0.5, help='Largest acceptable mean absolute error in stars.')
+    parser.add_argument('--use-stored-stars', action='store_true', help='Compare against stored stars instead of re-running the model.')
+    args = parser.parse_args()
+
+    lexicon = LexiconSentimentClassifier()
+    samples = []
+    total = 0
+    for text, model_stars in stored_reviews(args.limit, args.batch_size, args.use_stored_stars):
+        total += 1
+        if len(text) > args.max_length:
+            continue
+        scored = lexicon.polarity(text)
+        if scored is not None:
+            samples.append((scored[0], scored[1], model_stars))
+    if len(samples) < 2:
+        print('Not enough short reviews with lexicon matches (%s of %s reviews)' % (len(samples), total))
+        return 1
+
+    slope, intercept = fit_line([s[0] for s in samples], [s[2] for s in samples])
+    calibrated = LexiconSentimentClassifier(slope=slope, intercept=intercept)
+    print('Fitted %s of %s reviews: stars = 3 + %.3f * polarity + %.3f\n' % (len(samples), total, slope, intercept))
+    print('%9s %10s %10s %10s' % ('threshold', 'fast_rate', 'mae', 'max_error'))
+
+    chosen = None
+    for threshold in THRESHOLDS:
+        errors = [
+            abs(min(5.0, max(1.0, 3.0 + calibrated.slope * polarity + calibrated.intercept)) - model_stars)
+            for polarity, confidence, model_stars in samples if confidence >= threshold
+        ]
+        if not errors:
+            print('%9.2f %10.3f %10s %10s' % (threshold, 0.0, '-', '-'))
+            continue
+        mae = statistics.mean(errors)
+        print('%9.2f %10.3f %10.3f %10.3f' % (threshold, len(errors) / total, mae, max(errors)))
+        if chosen is None and mae <= args.max_error:
+            chosen = threshold
+
+    if chosen is None:
+        print('\nNo threshold keeps the mean error within %.2f stars; leave the fast path disabled.' % args.max_error)
+        return 1
+    print('\nSuggested settings:')
+    print('FAST_SENTIMENT_ENABLED=true')
+    print('FAST_SENTIMENT_CONFIDENCE_THRESHOLD=%s' % chosen)
+    print('FAST_SENTIMENT_MAX_LENGTH=%s' % args.max_length)
+    print('FAST_SENTIMENT_SLOPE=%.4f' % slope)
+    print('FAST_SENTIMENT_INTERCEPT=%.4f' % intercept)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
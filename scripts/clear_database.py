@@ -1,7 +1,12 @@
 #!/usr/local/bin/python
 
-from bot.models import Conversation, Person, Review
+from bot.models import Conversation, OutboundMessage, Person, ProcessedMessage, ProductRating, ProductRatingDay, Review, WebhookJob
 
+WebhookJob.delete().execute()
+OutboundMessage.delete().execute()
+ProcessedMessage.delete().execute()
+ProductRatingDay.delete().execute()
+ProductRating.delete().execute()
 Review.delete().execute()
 Conversation.delete().execute()
 Person.delete().execute()
\ No newline at end of file
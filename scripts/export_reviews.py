@@ -0,0 +1,36 @@
+#!/usr/local/bin/python
+
+import argparse
+import bot.export as export
+import sys
+
+from contextlib import closing
+from datetime import datetime
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Stream reviews, with their person and conversation, to a file.')
+    parser.add_argument('--from', dest='created_from', type=datetime.fromisoformat, help='Only reviews created at or after this ISO 8601 time.')
+    parser.add_argument('--until', dest='created_until', type=datetime.fromisoformat, help='Only reviews created before this ISO 8601 time.')
+    parser.add_argument('--product-id', type=int, help='Only reviews of this product.')
+    parser.add_argument('--format', choices=export.EXPORT_FORMATS, default='csv')
+    parser.add_argument('--gzip', action='store_true', help='Compress the output with gzip.')
+    parser.add_argument('--output', '-o', default='-', help='Output file, - for stdout (the default).')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    filters = export.ExportFilter(
+        created_from=args.created_from,
+        created_until=args.created_until,
+        product_id=args.product_id,
+    )
+    output = sys.stdout.buffer if args.output == '-' else open(args.output, 'wb')
+    with output, closing(export.export_reviews(filters, args.format, args.gzip)) as chunks:
+        for chunk in chunks:
+            output.write(chunk)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
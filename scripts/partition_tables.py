@@ -0,0 +1,15 @@
+#!/usr/local/bin/python
+
+import bot.models as models
+import bot.partitions as partitions
+
+# Converts tables created before reviews and conversations were partitioned. Writes to each table
+# block while its rows are copied, so run this during a quiet period.
+for model in models.PARTITIONED_MODELS:
+    if not model.table_exists() or partitions.is_partitioned(model):
+        print('%s needs no conversion' % model._meta.table_name)
+        continue
+    # The copy includes every column of the model.
+    models.add_missing_columns(model)
+    copied = partitions.convert_to_partitioned(model)
+    print('Partitioned %s, copied %s rows' % (model._meta.table_name, copied))
@@ -0,0 +1,8 @@
+#!/usr/local/bin/python
+
+import bot.ratings as ratings
+
+from bot.models import ProductRating
+
+ratings.rebuild()
+print('Rebuilt ratings for %s products' % ProductRating.select().count())
@@ -0,0 +1,41 @@
+#!/usr/local/bin/python
+
+import argparse
+import asyncio
+import bot.inference as inference
+import bot.log as log
+import sys
+
+from bot.inference_server import InferenceServer
+from bot.settings import INFERENCE_SERVER_MAX_PENDING, INFERENCE_SOCKET
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Load the sentiment model once and serve it to every process with INFERENCE_SOCKET set.')
+    parser.add_argument('--socket', default=INFERENCE_SOCKET, help='Unix socket path (default: INFERENCE_SOCKET).')
+    parser.add_argument('--max-pending', type=int, default=INFERENCE_SERVER_MAX_PENDING,
+        help='Texts queued at once before requests are rejected.')
+    args = parser.parse_args()
+    if not args.socket:
+        parser.error('Pass --socket or set INFERENCE_SOCKET')
+    return args
+
+
+def main():
+    args = parse_args()
+    log.configure_logging()
+    # Always in process: this is the process the others send their texts to.
+    engine = inference.BatchingInferenceEngine(inference.classify_batch)
+    # Load the model before accepting connections.
+    engine.classify(inference.WARM_UP_TEXT)
+    try:
+        asyncio.run(InferenceServer(engine, args.max_pending).serve(args.socket))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        engine.close()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,12 +1,48 @@
 #!/usr/local/bin/python
 
+import argparse
+import asyncio
+import bot.campaign as campaign
 import bot.messaging_service as messaging
 import sys
 
+from bot.settings import CAMPAIGN_BATCH_SIZE, CAMPAIGN_CONCURRENCY, CAMPAIGN_RATE_PER_SEC
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Proactively solicit reviews.')
+    parser.add_argument('person_id', type=int, nargs='?', help='Solicit a review from a single person.')
+    parser.add_argument('--campaign', metavar='FILE', help='Solicit reviews from every person id in FILE (one per line, - for stdin).')
+    parser.add_argument('--progress-file', help='Record reached ids here, and skip ids already recorded when resuming.')
+    parser.add_argument('--batch-size', type=int, default=CAMPAIGN_BATCH_SIZE)
+    parser.add_argument('--concurrency', type=int, default=CAMPAIGN_CONCURRENCY)
+    parser.add_argument('--rate', type=float, default=CAMPAIGN_RATE_PER_SEC, help='Maximum messages sent per second.')
+    args = parser.parse_args()
+    if (args.person_id is None) == (args.campaign is None):
+        parser.error('Pass either a person id or --campaign')
+    return args
+
+
+def run_campaign(args) -> int:
+    stream = sys.stdin if args.campaign == '-' else open(args.campaign)
+    with stream:
+        stats = asyncio.run(campaign.run_campaign(
+            campaign.read_person_ids(stream),
+            campaign.CampaignProgress(args.progress_file),
+            batch_size=args.batch_size,
+            concurrency=args.concurrency,
+            rate_per_sec=args.rate,
+        ))
+    print('Campaign finished: %s sent, %s skipped, %s failed' % (stats.sent, stats.skipped, stats.failed))
+    return 0 if stats.failed == 0 else 1
+
+
 def main():
-    person_id = int(sys.argv[1])
-    messaging.solicit_review_proactively(person_id)
+    args = parse_args()
+    if args.campaign is not None:
+        return run_campaign(args)
+    asyncio.run(messaging.solicit_review_proactively(args.person_id))
     return 0
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    sys.exit(main())